@@ -0,0 +1,85 @@
+"""
+Time ``Permission.bits``\ , ``Permission.int_to_perms`` and the
+``ModelPermissions`` decoders on random masks of up to 63 bits, against the
+octal string conversion they used to do.
+
+    python benchmarks/bit_decoding.py --masks 100000 --distinct 1000
+
+Models with more permissions than ``DECODE_TABLE_BITS`` remember the masks
+they decoded, so ``--distinct`` above ``DECODE_CACHE_SIZE`` shows the cost of
+decoding masks that are never seen twice.
+
+No database is needed.
+"""
+import random
+import sys
+import time
+from optparse import OptionParser
+
+from common import configure
+
+configure(debug=False)
+
+from objectpermissions.models import UserPermission, ModelPermissions
+
+OCT_BITS = {'0': [0,0,0], '1': [0,0,1], '2': [0,1,0], '3': [0,1,1],
+            '4': [1,0,0], '5': [1,0,1], '6': [1,1,0], '7': [1,1,1]}
+
+
+def octal_bits(a):
+    result = []
+    for c in filter(lambda char: char != 'L', oct(a))[1:]:
+        result += OCT_BITS[c]
+    return result
+
+
+def octal_int_to_perms(a):
+    result = []
+    bitlist = octal_bits(a)
+    for i in range(len(bitlist)):
+        result.insert(0, 1 << i)
+    return [i for i in map(lambda x, y: x * y, bitlist, result) if i != 0]
+
+
+def octal_as_int_list(mp, perm):
+    result = []
+    for key, val in mp.items():
+        if key & perm == key:
+            result.append(key)
+    return result
+
+
+def time_func(func, masks):
+    start = time.time()
+    for mask in masks:
+        func(mask)
+    return time.time() - start
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--masks', type='int', default=100000, help='Masks to decode per width')
+    parser.add_option('--distinct', type='int', default=1000,
+        help='Distinct masks among them; permission rows repeat a few masks')
+    parser.add_option('--seed', type='int', default=None, help='Seed the random generator')
+    options, args = parser.parse_args()
+    random.seed(options.seed)
+
+    sys.stdout.write('%-6s %-22s %12s %12s %8s\n' % ('bits', 'function', 'octal us', 'new us', 'speedup'))
+    for width in (4, 8, 12, 16, 31, 63):
+        pool = [random.getrandbits(width) for i in xrange(options.distinct)]
+        masks = [random.choice(pool) for i in xrange(options.masks)]
+        mp = ModelPermissions(['perm%s' % i for i in range(width)])
+        for name, old, new in (
+                ('bits', octal_bits, UserPermission.bits),
+                ('int_to_perms', octal_int_to_perms, UserPermission.int_to_perms),
+                ('as_int_list', lambda m: octal_as_int_list(mp, m), mp.as_int_list)):
+            for mask in masks[:1000]:
+                assert sorted(old(mask)) == sorted(new(mask))
+            old_time = time_func(old, masks)
+            new_time = time_func(new, masks)
+            sys.stdout.write('%-6d %-22s %12.3f %12.3f %7.1fx\n' % (width, name,
+                old_time / len(masks) * 1e6, new_time / len(masks) * 1e6, old_time / (new_time or 1e-9)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Helpers shared by the benchmarks: a throwaway SQLite database, timing and
+reporting.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DB_NAME = os.path.join(tempfile.gettempdir(), 'objectpermissions_bench.db')
+
+
+def configure(db_name=DB_NAME, debug=True):
+    """
+    Point Django at a fresh SQLite database. With ``debug`` the queries are
+    recorded, so they can be counted.
+    """
+    from django.conf import settings
+    if os.path.exists(db_name):
+        os.remove(db_name)
+    if not settings.configured:
+        settings.configure(
+            DEBUG=debug,
+            DATABASE_ENGINE='sqlite3',
+            DATABASE_NAME=db_name,
+            INSTALLED_APPS=(
+                'django.contrib.auth',
+                'django.contrib.contenttypes',
+                'django.contrib.sites',
+                'django.contrib.flatpages',
+                'objectpermissions',
+            ),
+        )
+
+
+def syncdb():
+    from django.core.management import call_command
+    call_command('syncdb', verbosity=0, interactive=False)
+
+
+def cleanup(db_name=DB_NAME):
+    from django.db import connection
+    connection.close()
+    if os.path.exists(db_name):
+        os.remove(db_name)
+
+
+def percentile(timings, p):
+    """
+    The ``p`` (0 to 1) percentile of the sorted ``timings``
+    """
+    if not timings:
+        return 0.0
+    return timings[min(len(timings) - 1, int(len(timings) * p))]
+
+
+class Timer(object):
+    """
+    Time each call of a function and count the queries it runs.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.timings = []
+        self.queries = 0
+
+    def run(self, func, *args, **kwargs):
+        from django.db import connection, reset_queries
+        reset_queries()
+        start = time.time()
+        result = func(*args, **kwargs)
+        self.timings.append(time.time() - start)
+        self.queries += len(connection.queries)
+        return result
+
+    def report(self, stream=sys.stdout):
+        timings = sorted(self.timings)
+        calls = len(timings) or 1
+        stream.write('%-28s %7d calls  p50 %8.3f ms  p95 %8.3f ms  p99 %8.3f ms  %6.2f queries/call\n' % (
+            self.name, len(timings), percentile(timings, 0.50) * 1000,
+            percentile(timings, 0.95) * 1000, percentile(timings, 0.99) * 1000,
+            float(self.queries) / calls))
@@ -0,0 +1,79 @@
+"""
+Generate users, groups, objects and a realistic spread of permissions.
+
+Object popularity follows a Pareto distribution: most objects are shared
+with a few users and groups, a few are shared with many. Lower permissions
+are granted far more often than higher ones, so most masks are "read" or
+"read + write".
+"""
+import random
+
+from django.contrib.auth.models import User, Group
+from django.contrib.contenttypes.models import ContentType
+
+from objectpermissions.models import UserPermission, GroupPermission
+from objectpermissions.utils import bulk_create
+
+
+def make_users(count, prefix='bench'):
+    bulk_create(User, [User(username='%s%d' % (prefix, i), email='', password='!',
+                             is_active=True) for i in range(count)])
+    return list(User.objects.filter(username__startswith=prefix).order_by('pk'))
+
+
+def make_groups(count, users, rng, groups_per_user=3, prefix='bench'):
+    """
+    Create ``count`` groups and put each user in up to ``groups_per_user`` of them
+    """
+    bulk_create(Group, [Group(name='%s%d' % (prefix, i)) for i in range(count)])
+    groups = list(Group.objects.filter(name__startswith=prefix).order_by('pk'))
+    for user in users:
+        memberships = rng.sample(groups, min(len(groups), rng.randint(0, groups_per_user)))
+        if memberships:
+            user.groups.add(*memberships)
+    return groups
+
+
+def make_objects(model, count, factory):
+    """
+    Create ``count`` instances of ``model`` with ``factory(i)``\ , a function
+    that returns an unsaved instance.
+    """
+    bulk_create(model, [factory(i) for i in range(count)])
+    return list(model.objects.order_by('pk'))
+
+
+def random_mask(model, rng):
+    """
+    A permission mask where each higher permission is less likely than the last
+    """
+    mask = 0
+    chance = 1.0
+    for value in model.perms.values():
+        if rng.random() < chance:
+            mask |= value
+        chance *= 0.4
+    return mask
+
+
+def make_grants(model, objects, users, groups, rng, users_per_object=3, groups_per_object=1):
+    """
+    Grant random permissions on each object to a Pareto-distributed number of
+    users and groups averaging about ``users_per_object`` and
+    ``groups_per_object``\ .
+    
+    :result: The number of rows created
+    """
+    ctype = ContentType.objects.get_for_model(model)
+    rows = []
+    for obj in objects:
+        for perm_model, field, principals, mean in (
+                (UserPermission, 'user_id', users, users_per_object),
+                (GroupPermission, 'group_id', groups, groups_per_object)):
+            count = min(len(principals), int(rng.paretovariate(2.0) * mean / 2.0))
+            for principal in rng.sample(principals, count):
+                rows.append(perm_model(content_type=ctype, object_id=obj.pk,
+                    permission=random_mask(model, rng), **{field: principal.pk}))
+    for perm_model in (UserPermission, GroupPermission):
+        bulk_create(perm_model, [row for row in rows if isinstance(row, perm_model)])
+    return len(rows)
@@ -0,0 +1,117 @@
+"""
+Compare the latency of permission lookups before and after adding the
+composite indexes, on a SQLite database with many permission rows.
+
+    python benchmarks/index_lookup.py --rows 10000000
+
+The tables are first created the way older versions did, with only the
+single column foreign key indexes, then the indexes from
+``objectpermissions.management`` are added.
+"""
+import random
+import sys
+import time
+from optparse import OptionParser
+
+from common import configure, cleanup, percentile
+
+configure(debug=False)
+
+from django.db import connection, transaction
+
+from objectpermissions.models import UserPermission, GroupPermission
+from objectpermissions.management import index_statements, create_indexes
+
+# The schema of older versions: no composite index, no uniqueness
+OLD_SCHEMA = [
+    'CREATE TABLE %(table)s (id integer NOT NULL PRIMARY KEY, permission integer NULL, '
+    'content_type_id integer NOT NULL, object_id integer unsigned NOT NULL, %(principal)s integer NULL)',
+    'CREATE INDEX %(table)s_content_type_id ON %(table)s (content_type_id)',
+    'CREATE INDEX %(table)s_%(principal)s ON %(table)s (%(principal)s)',
+]
+TABLES = (
+    (UserPermission._meta.db_table, 'user_id'),
+    (GroupPermission._meta.db_table, 'group_id'),
+)
+CONTENT_TYPES = 4
+CHUNK = 50000
+
+
+def create_old_tables(cursor):
+    for table, principal in TABLES:
+        cursor.execute('DROP TABLE IF EXISTS %s' % table)
+        for sql in OLD_SCHEMA:
+            cursor.execute(sql % {'table': table, 'principal': principal})
+
+
+def fill(cursor, table, principal, rows, principals):
+    """
+    Insert ``rows`` unique (content_type, object, principal) rows with a random
+    permission mask.
+    """
+    sql = 'INSERT INTO %s (permission, content_type_id, object_id, %s) VALUES (%%s, %%s, %%s, %%s)' % (
+        table, principal)
+    for start in xrange(0, rows, CHUNK):
+        batch = []
+        for i in xrange(start, min(start + CHUNK, rows)):
+            object_num, principal_id = divmod(i, principals)
+            batch.append((random.randint(1, 15), object_num % CONTENT_TYPES + 1,
+                          object_num // CONTENT_TYPES, principal_id + 1))
+        cursor.executemany(sql, batch)
+        transaction.commit_unless_managed()
+
+
+def time_lookups(cursor, table, principal, rows, principals, lookups):
+    sql = ('SELECT permission FROM %s WHERE content_type_id = %%s AND object_id = %%s '
+           'AND %s = %%s' % (table, principal))
+    timings = []
+    for i in xrange(lookups):
+        object_num, principal_id = divmod(random.randrange(rows), principals)
+        params = (object_num % CONTENT_TYPES + 1, object_num // CONTENT_TYPES, principal_id + 1)
+        start = time.time()
+        cursor.execute(sql, params)
+        cursor.fetchall()
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings
+
+
+def report(label, timings):
+    sys.stdout.write('%-28s p50 %9.3f ms  p95 %9.3f ms  p99 %9.3f ms\n' % (label,
+        percentile(timings, 0.50) * 1000, percentile(timings, 0.95) * 1000,
+        percentile(timings, 0.99) * 1000))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--rows', type='int', default=10000000,
+                      help='Rows in each permission table [default: %default]')
+    parser.add_option('--principals', type='int', default=1000,
+                      help='Users and groups with permissions [default: %default]')
+    parser.add_option('--lookups', type='int', default=1000,
+                      help='Lookups to time on each table [default: %default]')
+    options, args = parser.parse_args()
+    random.seed(0)
+
+    cursor = connection.cursor()
+    create_old_tables(cursor)
+    for table, principal in TABLES:
+        sys.stdout.write('Filling %s with %d rows\n' % (table, options.rows))
+        fill(cursor, table, principal, options.rows, options.principals)
+
+    results = []
+    for table, principal in TABLES:
+        results.append(('%s before' % table.split('_')[-1],
+                        time_lookups(cursor, table, principal, options.rows,
+                                     options.principals, options.lookups)))
+    create_indexes(index_statements(), verbosity=1)
+    for table, principal in TABLES:
+        results.append(('%s after' % table.split('_')[-1],
+                        time_lookups(cursor, table, principal, options.rows,
+                                     options.principals, options.lookups)))
+    for label, timings in results:
+        report(label, timings)
+    cleanup()
+
+if __name__ == '__main__':
+    main()
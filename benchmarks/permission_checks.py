@@ -0,0 +1,87 @@
+"""
+Time the permission checks and changes on a generated data set in SQLite and
+report latency percentiles and queries per call.
+
+    python benchmarks/permission_checks.py --users 500 --groups 50 --objects 5000
+
+Run it before and after a change to ``objectpermissions`` to spot regressions.
+"""
+import random
+import sys
+from optparse import OptionParser
+
+from common import configure, syncdb, cleanup, Timer
+
+configure()
+
+from django.contrib.flatpages.models import FlatPage
+
+import objectpermissions
+from objectpermissions.query import users_with_perm
+from generators import make_users, make_groups, make_objects, make_grants
+
+PERMISSIONS = ['read', 'write', 'own', 'delete']
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--users', type='int', default=200, help='[default: %default]')
+    parser.add_option('--groups', type='int', default=20, help='[default: %default]')
+    parser.add_option('--objects', type='int', default=2000, help='[default: %default]')
+    parser.add_option('--iterations', type='int', default=500,
+                      help='Calls timed for each check [default: %default]')
+    parser.add_option('--seed', type='int', default=0, help='[default: %default]')
+    options, args = parser.parse_args()
+    rng = random.Random(options.seed)
+
+    syncdb()
+    objectpermissions.register(FlatPage, PERMISSIONS)
+    users = make_users(options.users)
+    groups = make_groups(options.groups, users, rng)
+    pages = make_objects(FlatPage, options.objects, lambda i: FlatPage(
+        url='/bench/%d/' % i, title='Page %d' % i, content=''))
+    rows = make_grants(FlatPage, pages, users, groups, rng)
+    sys.stdout.write('%d users, %d groups, %d objects, %d permission rows\n\n' % (
+        len(users), len(groups), len(pages), rows))
+
+    timers = []
+    def timer(name):
+        timers.append(Timer(name))
+        return timers[-1]
+
+    check = timer('has_object_perm')
+    get = timer('get_object_perm')
+    for i in range(options.iterations):
+        user, page = rng.choice(users), rng.choice(pages)
+        check.run(user.has_object_perm, page, 'read')
+        get.run(user.get_object_perm, page)
+
+    objects = timer('get_objects_with_perms')
+    everyone = timer('all_with_perm')
+    holders = timer('users_with_perm')
+    for i in range(max(1, options.iterations // 10)):
+        objects.run(lambda: list(rng.choice(users).get_objects_with_perms(FlatPage, 'write')))
+        everyone.run(lambda: list(rng.choice(pages).user_perms_set.all_with_perm('read')))
+        holders.run(lambda: list(users_with_perm(rng.choice(pages), 'read')))
+
+    ids = [page.pk for page in pages]
+    loop = timer('has_object_perm x %d' % len(ids))
+    many = timer('check_many x %d' % len(ids))
+    for i in range(max(1, options.iterations // 100)):
+        user = rng.choice(users)
+        loop.run(lambda: [user.has_object_perm(page, 'read') for page in pages])
+        many.run(user.check_many, FlatPage, ids, 'read')
+
+    grant = timer('grant_object_perm')
+    revoke = timer('revoke_object_perm')
+    for i in range(options.iterations):
+        user, page = rng.choice(users), rng.choice(pages)
+        grant.run(user.grant_object_perm, page, 'own')
+        revoke.run(user.revoke_object_perm, page, 'own')
+
+    for t in timers:
+        t.report()
+    cleanup()
+
+if __name__ == '__main__':
+    main()
@@ -34,4 +34,31 @@ class SimpleTextAdmin(admin.ModelAdmin):
     list_display = ('firstname','lastname','favorite_color')
     inlines = [SimpleTaggedItemInline, TabularUserPermInline, ]
 
-admin.site.register(SimpleText, SimpleTextAdmin)
\ No newline at end of file
+admin.site.register(SimpleText, SimpleTextAdmin)
+
+class Folder(models.Model):
+    name = models.CharField(max_length=255)
+    parent = models.ForeignKey('self', null=True, blank=True)
+    
+    def __unicode__(self):
+        return self.name
+
+class Document(models.Model):
+    title = models.CharField(max_length=255)
+    folder = models.ForeignKey(Folder)
+    
+    def __unicode__(self):
+        return self.title
+
+# Documents inherit the permissions of their folder and its parents
+objectpermissions.register(Folder, ['read', 'write'], parent='parent')
+objectpermissions.register(Document, ['read', 'write', 'delete'], parent='folder')
+
+class Ticket(models.Model):
+    title = models.CharField(max_length=255)
+    
+    def __unicode__(self):
+        return self.title
+
+# One row per permission, for finding who can close what by index
+objectpermissions.register(Ticket, ['read', 'write', 'close'], storage='rows')
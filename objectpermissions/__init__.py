@@ -18,9 +18,12 @@ def get_version():
 __version__ = get_version()
 
 try:
-    from registration import register, AlreadyRegistered
+    from registration import register, AlreadyRegistered, bulk_grant, bulk_revoke, check_many
+    from defaults import apply_default_perms, group_named
+    from cleanup import delete_object_perms
     from models import UnknownPermission
 
-    __all__ = ('register', 'AlreadyRegistered', 'UnknownPermission')
+    __all__ = ('register', 'AlreadyRegistered', 'UnknownPermission', 'bulk_grant', 'bulk_revoke',
+               'check_many', 'apply_default_perms', 'group_named', 'delete_object_perms')
 except ImportError:
     pass
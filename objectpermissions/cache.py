@@ -0,0 +1,425 @@
+"""
+Caching of the resolved, bitwise object permissions of users and groups, and
+of the groups each user belongs to.
+"""
+import threading
+import time
+
+from django.contrib.auth.models import User, Group
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache as shared_cache
+from django.core.signals import request_finished
+from django.db import transaction
+from django.db.models import signals
+try:
+    from django.db.models.signals import m2m_changed
+except ImportError:
+    m2m_changed = None
+
+from signals import permission_changed, permissions_changed_in_bulk
+from hierarchy import is_hierarchical, descendant_models
+import settings as app_settings
+
+# The request caches that are active in this thread
+_local = threading.local()
+
+
+def _active_caches():
+    if not hasattr(_local, 'caches'):
+        _local.caches = []
+    return _local.caches
+
+
+def _pending_versions():
+    # The versions moved inside a transaction in this thread
+    if not hasattr(_local, 'versions'):
+        _local.versions = set()
+    return _local.versions
+
+
+def cache_key(instance):
+    """
+    The key under which the permissions for ``instance`` are cached: a
+    ``(content_type_id, object_id)`` tuple.
+    """
+    return (ContentType.objects.get_for_model(instance).pk, instance.pk)
+
+
+class RequestCache(dict):
+    """
+    The permissions resolved for one user, by ``cache_key``\ , and the ids
+    of the user's groups once they are needed.
+    """
+    def __init__(self, user_id):
+        super(RequestCache, self).__init__()
+        self.user_id = user_id
+        self.group_ids = None
+    
+    def clear(self):
+        super(RequestCache, self).clear()
+        self.group_ids = None
+
+
+def enable_request_cache(user):
+    """
+    Attach an empty permission cache to ``user``\ . Until
+    :func:`disable_request_cache` is called, the permissions resolved for
+    ``user`` are kept on the instance and reused.
+    """
+    permission_changed.connect(invalidate_request_caches,
+                               dispatch_uid='objectpermissions.cache.request')
+    permissions_changed_in_bulk.connect(invalidate_request_caches_in_bulk,
+                                        dispatch_uid='objectpermissions.cache.request')
+    cache = RequestCache(user.pk)
+    user._object_perm_cache = cache
+    _active_caches().append(cache)
+    return cache
+
+
+def disable_request_cache(user):
+    """
+    Remove the permission cache from ``user``\ .
+    """
+    cache = getattr(user, '_object_perm_cache', None)
+    if cache is None:
+        return
+    del user._object_perm_cache
+    caches = _active_caches()
+    for i, item in enumerate(caches):
+        if item is cache:
+            del caches[i]
+            break
+
+
+def clear_request_caches():
+    """
+    Forget all the request caches active in this thread.
+    """
+    _local.caches = []
+
+
+def get_request_cache(user):
+    """
+    Return the permission cache attached to ``user`` or ``None``
+    """
+    return getattr(user, '_object_perm_cache', None)
+
+
+def _groups_key(user_id):
+    return '%s:groups:%s' % (app_settings.CACHE_PREFIX, user_id)
+
+
+def get_group_ids(user):
+    """
+    Return the ids of the groups of ``user`` as a ``frozenset``\ , so the
+    permissions of its groups can be looked up with ``group__in`` instead of
+    joining the membership table, or skipped when there are none.
+    
+    The ids are kept in the user's request cache, and in Django's cache with
+    ``OBJECTPERMISSIONS_GROUP_CACHE`` set, until the user's groups change.
+    Without ``m2m_changed`` (before Django 1.2) changes can't be seen, so
+    the ids are only kept with ``OBJECTPERMISSIONS_GROUP_CACHE``\ , and
+    :func:`invalidate_group_ids` must be called after changing someone's
+    groups. Otherwise it returns ``None``\ .
+    """
+    if user.pk is None:
+        return None
+    cache = get_request_cache(user)
+    if cache is not None and cache.group_ids is not None:
+        return cache.group_ids
+    if not app_settings.GROUP_CACHE and (cache is None or m2m_changed is None):
+        return None
+    group_ids = None
+    if app_settings.GROUP_CACHE:
+        group_ids = shared_cache.get(_groups_key(user.pk))
+    if group_ids is None:
+        group_ids = frozenset(user.groups.values_list('pk', flat=True))
+        if app_settings.GROUP_CACHE:
+            shared_cache.set(_groups_key(user.pk), group_ids, app_settings.CACHE_TIMEOUT)
+    if cache is not None:
+        cache.group_ids = group_ids
+    return group_ids
+
+
+def invalidate_group_ids(user_ids):
+    """
+    Forget the group ids kept for the users ``user_ids``\ , and the
+    permissions in their request caches in this thread and in the shared
+    cache, after their groups changed.
+    """
+    user_ids = set(user_ids)
+    for cache in _active_caches():
+        if cache.user_id in user_ids:
+            cache.clear()
+    if app_settings.GROUP_CACHE:
+        for user_id in user_ids:
+            shared_cache.delete(_groups_key(user_id))
+    if app_settings.CACHE_ENABLED:
+        for user_id in user_ids:
+            bump_version(_groups_version_key(user_id))
+
+
+def invalidate_group_ids_on_change(sender, instance, action, reverse, pk_set=None, **kwargs):
+    """
+    An ``m2m_changed`` handler for ``User.groups``\ . Clearing the members
+    of a group is handled before it happens, while they are still known.
+    """
+    if reverse:
+        if action == 'pre_clear':
+            invalidate_group_ids(list(instance.user_set.values_list('pk', flat=True)))
+        elif action in ('post_add', 'post_remove'):
+            invalidate_group_ids(pk_set or [])
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_group_ids([instance.pk])
+
+
+def invalidate_group_ids_on_delete(sender, instance, **kwargs):
+    """
+    A ``pre_delete`` handler for :class:`Group`\ . Deleting a group removes
+    its members without ``m2m_changed``\ , so they are forgotten here.
+    """
+    if _active_caches() or app_settings.GROUP_CACHE or app_settings.CACHE_ENABLED:
+        invalidate_group_ids(list(instance.user_set.values_list('pk', flat=True)))
+
+if m2m_changed is not None:
+    m2m_changed.connect(invalidate_group_ids_on_change, sender=User.groups.through,
+                        dispatch_uid='objectpermissions.cache.groups')
+signals.pre_delete.connect(invalidate_group_ids_on_delete, sender=Group,
+                           dispatch_uid='objectpermissions.cache.groups')
+
+
+def _descendant_type_ids(model):
+    """
+    The content type ids of the models that inherit permissions from ``model``
+    """
+    return set([ContentType.objects.get_for_model(child).pk for child in descendant_models(model)])
+
+
+def _drop_request_keys(content_type_ids):
+    """
+    Drop every object of the content types ``content_type_ids`` from the
+    request caches in this thread
+    """
+    if not content_type_ids:
+        return
+    for cache in _active_caches():
+        for key in cache.keys():
+            if key[0] in content_type_ids:
+                del cache[key]
+
+
+def invalidate_request_caches(sender, **kwargs):
+    """
+    A ``permission_changed`` handler that drops the changed object from every
+    request cache in this thread. A change to a group permission affects many
+    users, so the object is dropped regardless of whose permission changed.
+    Objects that inherit permissions from it are dropped too.
+    """
+    key = (sender.content_type_id, sender.object_id)
+    for cache in _active_caches():
+        cache.pop(key, None)
+    model = ContentType.objects.get_for_id(sender.content_type_id).model_class()
+    _drop_request_keys(_descendant_type_ids(model))
+
+
+def invalidate_request_caches_in_bulk(sender, to_what, **kwargs):
+    """
+    A ``permissions_changed_in_bulk`` handler that drops the changed objects
+    from every request cache in this thread.
+    """
+    keys = [cache_key(instance) for instance in to_what]
+    for cache in _active_caches():
+        for key in keys:
+            cache.pop(key, None)
+    for model in set([instance.__class__ for instance in to_what]):
+        _drop_request_keys(_descendant_type_ids(model))
+
+
+def _principal_key(principal):
+    return (principal._meta.module_name, principal.pk)
+
+
+def get_prefetched_perm(instance, principal):
+    """
+    Return the bitwise permissions of the :class:`User` or :class:`Group`
+    ``principal`` that were prefetched onto ``instance``\ , or ``None``
+    """
+    prefetched = getattr(instance, '_object_perm_prefetch', None)
+    if not prefetched:
+        return None
+    return prefetched.get(_principal_key(principal))
+
+
+def set_prefetched_perm(instance, principal, perm):
+    """
+    Keep the bitwise permissions ``perm`` of ``principal`` on ``instance``
+    """
+    if not hasattr(instance, '_object_perm_prefetch'):
+        instance._object_perm_prefetch = {}
+    instance._object_perm_prefetch[_principal_key(principal)] = perm
+
+
+def clear_prefetched_perms(instance):
+    """
+    Forget all the permissions prefetched onto ``instance``
+    """
+    if hasattr(instance, '_object_perm_prefetch'):
+        del instance._object_perm_prefetch
+
+
+def _version_key(content_type_id, object_id):
+    return '%s:v:%s:%s' % (app_settings.CACHE_PREFIX, content_type_id, object_id)
+
+
+def _new_version():
+    # Based on the clock, so a version key that is evicted from the cache
+    # never comes back with a number that was already used
+    return int(time.time() * 1000)
+
+
+def get_version(key):
+    """
+    Return the current version of the cached permissions for ``key``\ , a
+    ``(content_type_id, object_id)`` tuple.
+    """
+    version_key = _version_key(*key)
+    version = shared_cache.get(version_key)
+    if version is None:
+        version = _new_version()
+        if not shared_cache.add(version_key, version, app_settings.CACHE_TIMEOUT):
+            version = shared_cache.get(version_key, version)
+    return version
+
+
+def _bump(key):
+    version_key = _version_key(*key)
+    try:
+        shared_cache.incr(version_key)
+    except ValueError:
+        shared_cache.set(version_key, _new_version(), app_settings.CACHE_TIMEOUT)
+
+
+def bump_version(key):
+    """
+    Invalidate every cached permission for ``key``\ , a
+    ``(content_type_id, object_id)`` tuple, by moving to a new version.
+
+    Inside a transaction, other processes read the old rows until it is
+    committed and may cache them under the new version, so the version is
+    moved again by :func:`bump_pending_versions`\ .
+    """
+    _bump(key)
+    if transaction.is_managed():
+        _pending_versions().add(key)
+
+
+def bump_pending_versions(**kwargs):
+    """
+    Move the versions changed inside a transaction in this thread again, now
+    that it has ended. It is connected to ``request_finished``\ , which is sent
+    after ``TransactionMiddleware`` commits; call it after committing a
+    transaction outside of a request.
+    """
+    versions = _pending_versions()
+    while versions:
+        _bump(versions.pop())
+
+
+def _tree_key(content_type_id):
+    # The version of everything inherited by the objects of a content type
+    return (content_type_id, 'tree')
+
+
+def _groups_version_key(user_id):
+    # The version of everything a user gets from their groups
+    return ('groups', user_id)
+
+
+def _shared_key(key, principal):
+    version = get_version(key)
+    if is_hierarchical(ContentType.objects.get_for_id(key[0]).model_class()):
+        version = '%s.%s' % (version, get_version(_tree_key(key[0])))
+    if isinstance(principal, User):
+        version = '%s.%s' % (version, get_version(_groups_version_key(principal.pk)))
+    return '%s:%s:%s:%s:%s%s' % (app_settings.CACHE_PREFIX, key[0], key[1],
+        version, principal._meta.module_name[0], principal.pk)
+
+
+def get_shared_perm(key, principal):
+    """
+    Return the bitwise permissions of the :class:`User` or :class:`Group`
+    ``principal`` cached for ``key``\ , or ``None`` if there are none.
+    """
+    return shared_cache.get(_shared_key(key, principal))
+
+
+def set_shared_perm(key, principal, perm):
+    """
+    Cache the bitwise permissions ``perm`` of ``principal`` for ``key``\ .
+    """
+    shared_cache.set(_shared_key(key, principal), perm, app_settings.CACHE_TIMEOUT)
+
+
+def invalidate_shared_cache(sender, **kwargs):
+    """
+    A ``permission_changed`` handler that bumps the version of the changed
+    object, so no process reads the permissions cached before the change.
+    """
+    bump_version((sender.content_type_id, sender.object_id))
+    model = ContentType.objects.get_for_id(sender.content_type_id).model_class()
+    for content_type_id in _descendant_type_ids(model):
+        bump_version(_tree_key(content_type_id))
+
+
+def invalidate_shared_cache_in_bulk(sender, to_what, **kwargs):
+    """
+    A ``permissions_changed_in_bulk`` handler that bumps the version of each
+    of the changed objects.
+    """
+    for instance in to_what:
+        bump_version(cache_key(instance))
+    content_type_ids = set()
+    for model in set([instance.__class__ for instance in to_what]):
+        content_type_ids.update(_descendant_type_ids(model))
+    for content_type_id in content_type_ids:
+        bump_version(_tree_key(content_type_id))
+
+
+def invalidate_models(models):
+    """
+    Forget the cached permissions of every object of ``models``\ , for
+    example because what they inherit changed. The objects of a model that
+    inherits permissions share a version in the shared cache, so this takes
+    one cache operation per model.
+    """
+    content_type_ids = set([ContentType.objects.get_for_model(model).pk for model in models])
+    _drop_request_keys(content_type_ids)
+    if app_settings.CACHE_ENABLED:
+        for content_type_id in content_type_ids:
+            if is_hierarchical(ContentType.objects.get_for_id(content_type_id).model_class()):
+                bump_version(_tree_key(content_type_id))
+
+
+def connect_shared_cache():
+    """
+    Invalidate the shared cache whenever a permission changes. This is done
+    automatically when ``OBJECTPERMISSIONS_CACHE`` is set.
+    """
+    permission_changed.connect(invalidate_shared_cache,
+                               dispatch_uid='objectpermissions.cache.shared')
+    permissions_changed_in_bulk.connect(invalidate_shared_cache_in_bulk,
+                                        dispatch_uid='objectpermissions.cache.shared')
+    request_finished.connect(bump_pending_versions,
+                             dispatch_uid='objectpermissions.cache.shared')
+
+
+def disconnect_shared_cache():
+    permission_changed.disconnect(invalidate_shared_cache,
+                                  dispatch_uid='objectpermissions.cache.shared')
+    permissions_changed_in_bulk.disconnect(invalidate_shared_cache_in_bulk,
+                                           dispatch_uid='objectpermissions.cache.shared')
+    request_finished.disconnect(bump_pending_versions,
+                                dispatch_uid='objectpermissions.cache.shared')
+
+if app_settings.CACHE_ENABLED:
+    connect_shared_cache()
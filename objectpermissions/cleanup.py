@@ -0,0 +1,309 @@
+"""
+Removing permission rows that shouldn't be there.
+
+Rows pile up that slow down every scan of the permission tables: several
+rows for the same user or group and object, left by races in older versions
+or by importing data, rows without any permission, and rows whose object,
+user or group was deleted, since a generic relation has no foreign key to
+cascade from. :func:`compact_permissions`\ , also available as the
+``compact_permissions`` command, merges the first and deletes the others, a
+batch at a time.
+
+Registered models don't leave orphans behind: when their objects are deleted,
+with ``delete()`` on an object or a ``QuerySet``\ , the permission rows of
+all of them are deleted together, with one statement per table. Call
+:func:`delete_object_perms` after deleting objects with raw SQL.
+"""
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Q, signals
+from django.contrib.contenttypes.models import ContentType
+
+from models import EffectivePermission, STORAGES
+from utils import chunks, bulk_changed
+
+#: The most rows read or deleted at a time
+BATCH_SIZE = 1000
+
+
+def permission_tables():
+    """
+    The models of every table holding permission rows, with the name of
+    their user or group field
+    """
+    tables = []
+    for models in STORAGES.values():
+        tables.extend([(model, model._principal_field) for model in models])
+    tables.append((EffectivePermission, 'user'))
+    return tables
+
+
+def _delete_ids(model, ids):
+    """
+    Delete the rows of ``model`` with the primary keys ``ids`` without
+    loading them or sending any signals
+    """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for chunk in chunks(ids):
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (qn(model._meta.db_table),
+            qn(model._meta.pk.column), ', '.join(['%s'] * len(chunk))), chunk)
+    transaction.commit_unless_managed()
+    return len(ids)
+
+
+def delete_object_perms(model, object_ids):
+    """
+    Delete every permission on the objects of ``model`` with the ids
+    ``object_ids``\ , in both storages and the effective permission table,
+    with one ``DELETE`` per table a chunk at a time. Cached permissions of the
+    objects are dropped and ``permissions_changed_in_bulk`` is sent with an
+    empty ``to_whom`` and the ``action`` ``'delete'``\ .
+    """
+    object_ids = list(object_ids)
+    if not object_ids:
+        return
+    qn = connection.ops.quote_name
+    content_type = ContentType.objects.get_for_model(model)
+    cursor = connection.cursor()
+    for perm_model, principal in permission_tables():
+        for chunk in chunks(object_ids):
+            cursor.execute('DELETE FROM %s WHERE %s = %%s AND %s IN (%s)' % (
+                qn(perm_model._meta.db_table), qn(perm_model._meta.get_field('content_type').column),
+                qn(perm_model._meta.get_field('object_id').column), ', '.join(['%s'] * len(chunk))),
+                [content_type.pk] + chunk)
+    transaction.commit_unless_managed()
+    bulk_changed([], [model(pk=pk) for pk in object_ids], 'delete')
+
+
+# The ids of the objects of each model being deleted in this thread
+_local = threading.local()
+
+
+def _deleting():
+    if not hasattr(_local, 'deleting'):
+        _local.deleting = {}
+    return _local.deleting
+
+
+def remember_deleted(sender, instance, **kwargs):
+    """
+    A ``pre_delete`` handler. Django sends it for every object before
+    deleting any of them, so the objects are collected here and their
+    permissions deleted together by :func:`delete_perms_of_deleted`\ .
+    """
+    _deleting().setdefault(sender, set()).add(instance.pk)
+
+
+def delete_perms_of_deleted(sender, instance, **kwargs):
+    """
+    A ``post_delete`` handler. The first one after the objects are deleted
+    deletes the permissions of all of them; the rest find nothing left to do.
+    """
+    pending = _deleting().pop(sender, None)
+    if not pending:
+        return
+    pending.add(instance.pk)
+    if len(pending) > 1:
+        # An earlier delete that failed can leave ids behind
+        for chunk in chunks(pending):
+            pending.difference_update(_base_manager(sender).filter(pk__in=chunk).values_list('pk', flat=True))
+    delete_object_perms(sender, pending)
+
+
+def register_cleanup(model):
+    """
+    Delete the permissions on objects of ``model`` when they are deleted
+    """
+    uid = 'objectpermissions.cleanup.%s.%s' % (model._meta.app_label, model._meta.object_name)
+    signals.pre_delete.connect(remember_deleted, sender=model, dispatch_uid=uid)
+    signals.post_delete.connect(delete_perms_of_deleted, sender=model, dispatch_uid=uid)
+
+
+def _delete_rows(rows, batch_size=BATCH_SIZE):
+    """
+    Delete every row of the ``QuerySet`` ``rows``\ , ``batch_size`` at a time
+    """
+    deleted = 0
+    while True:
+        ids = list(rows.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += _delete_ids(rows.model, ids)
+
+
+def merge_duplicates(model, principal, batch_size=BATCH_SIZE):
+    """
+    Merge the rows of ``model`` that are for the same user or group and
+    object into the oldest one, ORing their permissions, and delete the rest.
+    For the row storage, rows are only duplicates if they also have the same
+    permission.
+
+    :result: The number of rows deleted
+    """
+    bit_rows = getattr(model, '_bit_rows', False)
+    key = ['content_type', 'object_id', principal]
+    if bit_rows:
+        key.append('permission')
+    duplicates = model.objects.values(*key).annotate(rows=Count('pk')).filter(rows__gt=1)
+    principal_attname = model._meta.get_field(principal).attname
+    deleted = 0
+    while True:
+        keys = list(duplicates[:batch_size])
+        if not keys:
+            return deleted
+        by_content_type = {}
+        for item in keys:
+            by_content_type.setdefault(item['content_type'], set()).add(
+                tuple([item[name] for name in key]))
+
+        merged, extra = {}, []
+        for content_type_id, wanted in by_content_type.items():
+            object_ids = set([item[1] for item in wanted])
+            for chunk in chunks(object_ids):
+                rows = model.objects.filter(content_type=content_type_id, object_id__in=chunk
+                    ).order_by('pk').values_list('pk', 'object_id', principal_attname, 'permission')
+                for pk, object_id, principal_id, permission in rows:
+                    row_key = (content_type_id, object_id, principal_id)
+                    if bit_rows:
+                        row_key += (permission,)
+                    if row_key not in wanted:
+                        continue
+                    if row_key in merged:
+                        kept, bits = merged[row_key]
+                        merged[row_key] = (kept, bits | (permission or 0))
+                        extra.append(pk)
+                    else:
+                        merged[row_key] = (pk, permission or 0)
+
+        by_value = {}
+        for kept, bits in merged.values():
+            by_value.setdefault(bits, []).append(kept)
+        for bits, pks in by_value.items():
+            for chunk in chunks(pks):
+                model.objects.filter(pk__in=chunk).update(permission=bits)
+        deleted += _delete_ids(model, extra)
+        if not extra:
+            # Nothing could be merged, don't ask for the same keys again
+            return deleted
+
+
+def delete_empty(model, batch_size=BATCH_SIZE):
+    """
+    Delete the rows of ``model`` without any permission
+
+    :result: The number of rows deleted
+    """
+    return _delete_rows(model.objects.filter(Q(permission=0) | Q(permission__isnull=True)), batch_size)
+
+
+def _base_manager(model):
+    return getattr(model, '_base_manager', model._default_manager)
+
+
+def _missing_ids(rows, field, target, batch_size):
+    """
+    Yield lists of the values of ``field`` in ``rows`` that aren't the
+    primary key of an object of ``target``\ , going through them in order a
+    batch at a time
+    """
+    rows = rows.exclude(**{'%s__isnull' % field: True})
+    last = None
+    while True:
+        if last is not None:
+            values = rows.filter(**{'%s__gt' % field: last})
+        else:
+            values = rows
+        values = list(values.order_by(field).values_list(field, flat=True).distinct()[:batch_size])
+        if not values:
+            return
+        existing = set(_base_manager(target).filter(pk__in=values).values_list('pk', flat=True))
+        missing = [value for value in values if value not in existing]
+        if missing:
+            yield missing
+        if len(values) < batch_size:
+            return
+        last = values[-1]
+
+
+def delete_orphans(model, principal, batch_size=BATCH_SIZE):
+    """
+    Delete the rows of ``model`` whose object, content type, user or group
+    doesn't exist anymore
+
+    :result: The number of rows deleted
+    """
+    deleted = 0
+    content_type_ids = list(model.objects.values_list('content_type', flat=True).distinct())
+    # Not get_for_id, which fails on content types without a model
+    content_types = ContentType.objects.in_bulk(content_type_ids)
+    for content_type_id in content_type_ids:
+        rows = model.objects.filter(content_type=content_type_id)
+        target = None
+        if content_type_id in content_types:
+            target = content_types[content_type_id].model_class()
+        if target is None:
+            deleted += _delete_rows(rows, batch_size)
+            continue
+        for missing in _missing_ids(rows, 'object_id', target, batch_size):
+            for chunk in chunks(missing):
+                deleted += _delete_rows(rows.filter(object_id__in=chunk), batch_size)
+
+    target = model._meta.get_field(principal).rel.to
+    deleted += _delete_rows(model.objects.filter(**{'%s__isnull' % principal: True}), batch_size)
+    for missing in _missing_ids(model.objects.all(), principal, target, batch_size):
+        for chunk in chunks(missing):
+            deleted += _delete_rows(model.objects.filter(**{'%s__in' % principal: chunk}), batch_size)
+    return deleted
+
+
+def vacuum(models):
+    """
+    Give the space of deleted rows back: ``VACUUM`` on SQLite, ``VACUUM
+    ANALYZE`` of the tables of ``models`` on PostgreSQL and ``OPTIMIZE
+    TABLE`` on MySQL.
+
+    :result: ``False`` if the database isn't one of those
+    """
+    qn = connection.ops.quote_name
+    engine = getattr(connection, 'vendor', None) or settings.DATABASE_ENGINE
+    tables = [qn(model._meta.db_table) for model in models]
+    cursor = connection.cursor()
+    if 'sqlite' in engine:
+        transaction.commit_unless_managed()
+        cursor.execute('VACUUM')
+    elif 'postgres' in engine:
+        # VACUUM can't run in a transaction
+        transaction.commit_unless_managed()
+        isolation_level = connection.connection.isolation_level
+        connection.connection.set_isolation_level(0)
+        try:
+            for table in tables:
+                cursor.execute('VACUUM ANALYZE %s' % table)
+        finally:
+            connection.connection.set_isolation_level(isolation_level)
+    elif 'mysql' in engine:
+        cursor.execute('OPTIMIZE TABLE %s' % ', '.join(tables))
+        cursor.fetchall()
+    else:
+        return False
+    return True
+
+
+def compact_permissions(batch_size=BATCH_SIZE):
+    """
+    Merge the duplicate rows of every permission table and delete the empty
+    and orphaned ones.
+
+    :result: A list of ``(model, merged, empty, orphans)``\ , the number of
+             rows of the table of ``model`` removed for each reason
+    """
+    report = []
+    for model, principal in permission_tables():
+        merged = merge_duplicates(model, principal, batch_size)
+        empty = delete_empty(model, batch_size)
+        orphans = delete_orphans(model, principal, batch_size)
+        report.append((model, merged, empty, orphans))
+    return report
@@ -14,14 +14,40 @@ except ImportError:
     auto_adapt_to_methods = lambda x: x
 from django.utils.http import urlquote
 
+from cache import set_prefetched_perm
+from query import with_perms_for
 from views import permission_denied
 
+# The attribute of the object that the decorator's query puts the user's permissions in
+PERMS_ATTRIBUTE = '_permission_required_perms'
+
+def _get_model(model):
+    if isinstance(model, basestring):
+        found = get_model(*model.split("."))
+        if found is None:
+            raise ValueError("The model passed ('%s') is not a Model class or string in the format 'app.model'." % model)
+        return found
+    elif isinstance(model, type) and issubclass(model, Model):
+        return model
+    raise ValueError("The model passed ('%s') is not a Model class or string in the format 'app.model'." % model)
+
+
 def permission_required(permission, obj_lookup, login_url=settings.LOGIN_URL, 
-                        redirect_field_name=REDIRECT_FIELD_NAME, **kwargs):
+                        redirect_field_name=REDIRECT_FIELD_NAME, require_all=True,
+                        object_name=None):
     """
     Decorator for a view that makes sure that the user has *all* permissions,
     redirects to the log-in page if not logged in.
     
+    The object and the user's permissions on it are loaded with one query.
+    The object is available to the view as ``request.permission_object``\ ,
+    with the permissions prefetched, so checking them again in the view
+    doesn't query the database. Objects that don't exist raise ``Http404``\ .
+    
+        @permission_required('read', (FlatPage, 'pk', 'page_id'), object_name='page')
+        def page_detail(request, page_id, page):
+            ...
+    
     :param permission: The permission set that the user must have for the object
     :type permission: An ``int``, ``string``, or ``list``
     :param obj_lookup: How to locate the object to test. It specifies the model,
@@ -30,29 +56,36 @@ def permission_required(permission, obj_lookup, login_url=settings.LOGIN_URL,
                        to retrieve the object
     :type obj_lookup: ``(<model>, '<field_lookup>', 'view_arg')`` or
                       ``('<appname>.<modelname>', '<field_lookup>', 'view_arg')``
+    :param require_all: Must the user have all of the permissions? **Default:** ``True``
+    :type require_all: ``bool``
+    :param object_name: Also pass the object to the view as this keyword argument.
+                        **Default:** ``None``
+    :type object_name: ``string``
     """
     if isinstance(obj_lookup, (tuple, list)):
         _model, lookup, varname = obj_lookup
     else:
         raise ValueError("The given argument '%s' should be a list or tuple" % obj_lookup)
+    if not isinstance(_model, basestring):
+        _get_model(_model)
     
-    if issubclass(_model, Model):
-        model = _model
-    elif isinstance(_model, basestring):
-        model = get_model(*model.split("."))
-    else:
-        raise ValueError("The model passed ('%s') is not a Model class or string in the format 'app.model'." % model)
-    value = kwargs.get(varname, None)
     def decorator(view_func):
         def _wrapped_view(request, *args, **kwargs):
-            if not request.user.is_authenticated():
+            user = request.user
+            if not user.is_authenticated():
                 path = urlquote(request.get_full_path())
                 return HttpResponseRedirect('%s?%s=%s' % (login_url, redirect_field_name, path))
             
-            obj = get_object_or_404(model, **{lookup: value})
-            if request.user.has_object_permission(obj, permission):
-                return view_func(request, *args, **kwargs)
-            return permission_denied(request)
+            model = _get_model(_model)
+            queryset = with_perms_for(model._default_manager.filter(**{lookup: kwargs.get(varname)}), 
+                                      user, PERMS_ATTRIBUTE)
+            obj = get_object_or_404(queryset)
+            set_prefetched_perm(obj, user, getattr(obj, PERMS_ATTRIBUTE) or 0)
+            if not user.has_object_perm(obj, permission, require_all):
+                return permission_denied(request)
+            request.permission_object = obj
+            if object_name:
+                kwargs[object_name] = obj
+            return view_func(request, *args, **kwargs)
         return wraps(view_func)(_wrapped_view)
     return auto_adapt_to_methods(decorator)
-    
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""
+Permissions granted automatically when an object is created.
+
+A model registered with ``default_perms``\ , a list of ``(principal, perm)``
+rules, grants each ``perm`` to the user or group the rule names as soon as
+one of its objects is created::
+
+    objectpermissions.register(Document, ['read', 'write', 'own'], default_perms=[
+        ('owner', ['read', 'write', 'own']),
+        (group_named('staff'), 'read'),
+    ])
+
+``principal`` is the name of an attribute or ``ForeignKey`` of the object
+holding a :class:`User` or :class:`Group`\ , a function that takes the object
+and returns a user, a group, a list of them or ``None``\ , or
+:func:`group_named`\ .
+
+All the rows of an object are inserted together, with one statement per
+permission table, and a single ``permissions_changed_in_bulk`` signal is
+sent. ``bulk_create`` doesn't send ``post_save``\ , so call
+:func:`apply_default_perms` with the objects it created.
+"""
+from django.db.models import signals, FieldDoesNotExist
+from django.contrib.auth.models import User, Group
+from django.contrib.contenttypes.models import ContentType
+
+from models import perm_models
+from utils import chunks, bulk_create, bulk_changed
+
+#: The rules of each model with default permissions: a ``list`` of
+#: ``(principal, bitwise permission)``
+default_perms = {}
+
+
+class group_named(object):
+    """
+    A principal for ``default_perms``\ : the :class:`Group` called ``name``\ ,
+    looked up once per batch of objects. Nothing is granted while there is no
+    such group.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, instance):
+        for group in Group.objects.filter(name=self.name)[:1]:
+            return group
+        return None
+
+    def __repr__(self):
+        return 'group_named(%r)' % self.name
+
+
+def register_defaults(model, rules):
+    """
+    Grant the permissions of ``rules`` on every new object of ``model``
+    """
+    default_perms[model] = [(principal, model.perms.as_int(perm)) for principal, perm in rules]
+    signals.post_save.connect(grant_default_perms, sender=model,
+        dispatch_uid='objectpermissions.defaults.%s.%s' % (model._meta.app_label, model._meta.object_name))
+
+
+def _principal_keys(instance, principal):
+    """
+    Return the ``('user', id)`` and ``('group', id)`` keys of the principals
+    that the rule ``principal`` names for ``instance``
+    """
+    if isinstance(principal, basestring):
+        try:
+            field = instance._meta.get_field(principal)
+        except FieldDoesNotExist:
+            field = None
+        rel = getattr(field, 'rel', None)
+        if rel is not None and rel.to in (User, Group):
+            # Use the id, so the user or group isn't fetched
+            value = getattr(instance, field.attname)
+            if value is None:
+                return []
+            return [(rel.to is User and 'user' or 'group', value)]
+        value = getattr(instance, principal)
+    else:
+        value = principal(instance)
+
+    if value is None:
+        return []
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    keys = []
+    for item in value:
+        if isinstance(item, User):
+            keys.append(('user', item.pk))
+        elif isinstance(item, Group):
+            keys.append(('group', item.pk))
+        else:
+            raise Exception("Default permissions can only be granted to a User or Group object.")
+    return keys
+
+
+def apply_default_perms(instances):
+    """
+    Grant the default permissions of the models of ``instances`` on each of
+    them, for objects created without ``post_save``\ , such as by
+    ``bulk_create``\ . The rows are inserted a chunk at a time and one
+    ``permissions_changed_in_bulk`` signal is sent. Users and groups named by
+    a ``ForeignKey`` aren't fetched, so the signal's ``to_whom`` only has
+    their ``pk`` set.
+
+    :param instances: Newly created objects
+    :type instances: ``list`` of :class:`Model` instances
+    """
+    instances = [instance for instance in instances if instance.__class__ in default_perms]
+    if not instances:
+        return
+
+    # Rules that don't depend on the object are resolved once
+    shared = {}
+    bits = {}
+    for instance in instances:
+        for principal, perm in default_perms[instance.__class__]:
+            if isinstance(principal, group_named):
+                if principal.name not in shared:
+                    shared[principal.name] = _principal_keys(instance, principal)
+                keys = shared[principal.name]
+            else:
+                keys = _principal_keys(instance, principal)
+            for key in keys:
+                row = (instance.__class__, instance.pk) + key
+                bits[row] = bits.get(row, 0) | perm
+
+    rows = {}
+    users, groups = set(), set()
+    for (model, object_id, kind, principal_id), perm in bits.items():
+        ctype = ContentType.objects.get_for_model(model)
+        if kind == 'user':
+            users.add(principal_id)
+            perm_model = perm_models(model)[0]
+        else:
+            groups.add(principal_id)
+            perm_model = perm_models(model)[1]
+        if perm_model._bit_rows:
+            values = model.perms.as_int_list(perm)
+        else:
+            values = [perm]
+        rows.setdefault(perm_model, []).extend([
+            perm_model(content_type=ctype, object_id=object_id, permission=value,
+                       **{'%s_id' % kind: principal_id})
+            for value in values])
+    for perm_model, perm_rows in rows.items():
+        for chunk in chunks(perm_rows):
+            bulk_create(perm_model, chunk)
+    if bits:
+        principals = [User(pk=pk) for pk in users] + [Group(pk=pk) for pk in groups]
+        bulk_changed(principals, instances, 'grant')
+
+
+def grant_default_perms(sender, instance, created=False, raw=False, **kwargs):
+    """
+    A ``post_save`` handler that grants the default permissions on new
+    objects. Objects loaded from fixtures are left alone.
+    """
+    if created and not raw:
+        apply_default_perms([instance])
@@ -0,0 +1,314 @@
+"""
+A materialized table of the effective permissions of each user.
+
+Resolving the permissions of a user means combining their own permission with
+those of every group they belong to. With ``OBJECTPERMISSIONS_EFFECTIVE_PERMS``
+set, the combined value is kept in the :class:`EffectivePermission` table,
+one row per user and object, so :func:`has_object_perm` and
+:func:`get_objects_with_perms` read a single row by its unique index.
+
+The table is kept up to date incrementally: whenever ``permission_changed``
+or ``permissions_changed_in_bulk`` is sent, only the rows of the affected
+objects and users are recomputed, with one ``DELETE`` and one
+``INSERT ... SELECT`` each. Changes to group membership are picked up through
+``m2m_changed``\ , so the table needs Django 1.2 or later. Deleting a group
+recomputes the permissions of its members. The ``rebuild_effective_perms``
+command recomputes the whole table.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.db.models import signals
+from django.contrib.auth.models import User, Group
+from django.contrib.contenttypes.models import ContentType
+try:
+    from django.db.models.signals import m2m_changed
+except ImportError:
+    m2m_changed = None
+
+from models import EffectivePermission, STORAGES, perm_models
+from utils import chunks, bit_or_sql
+from hierarchy import is_hierarchical
+from signals import permission_changed, permissions_changed_in_bulk, batching
+import settings as app_settings
+
+# Enough bits for any positive integer column, for content types that aren't
+# registered anymore
+MAX_BITS = 31
+
+
+def enabled(model=None):
+    """
+    Should permissions be read from the effective permission table? Not while
+    a :class:`permission_signal_batch` holds back the signals that update it,
+    nor for models that inherit permissions, whose rows don't include them.
+    """
+    return app_settings.EFFECTIVE_PERMS and not batching() and not is_hierarchical(model)
+
+
+def _nbits(content_type):
+    perms = getattr(content_type.model_class(), 'perms', None)
+    if perms is None:
+        return MAX_BITS
+    return len(perms)
+
+
+def _in_clause(column, ids):
+    return '%s IN (%s)' % (column, ', '.join(['%s'] * len(ids)))
+
+
+def _refresh(cursor, content_type, object_ids, user_ids):
+    qn = connection.ops.quote_name
+    groups_field = User._meta.get_field('groups')
+    membership_table = qn(groups_field.m2m_db_table())
+    membership_user = '%s.%s' % (membership_table, qn(groups_field.m2m_column_name()))
+    membership_group = '%s.%s' % (membership_table, qn(groups_field.m2m_reverse_name()))
+    table = qn(EffectivePermission._meta.db_table)
+    user_perm_model, group_perm_model = perm_models(content_type.model_class())
+    user_table = qn(user_perm_model._meta.db_table)
+    group_table = qn(group_perm_model._meta.db_table)
+
+    def scope(object_col, user_col):
+        where, params = [], []
+        if object_ids is not None:
+            where.append(_in_clause(object_col, object_ids))
+            params.extend(object_ids)
+        if user_ids is not None:
+            where.append(_in_clause(user_col, user_ids))
+            params.extend(user_ids)
+        return ''.join([' AND %s' % clause for clause in where]), params
+
+    where, params = scope('object_id', 'user_id')
+    cursor.execute('DELETE FROM %s WHERE content_type_id = %%s%s' % (table, where),
+                   [content_type.pk] + params)
+
+    bits = bit_or_sql('perms.permission', _nbits(content_type))
+    user_where, user_params = scope('%s.object_id' % user_table, '%s.user_id' % user_table)
+    group_where, group_params = scope('%s.object_id' % group_table, membership_user)
+    sql = ('INSERT INTO %(table)s (user_id, content_type_id, object_id, permission) '
+           'SELECT perms.user_id, %%s, perms.object_id, %(bits)s FROM ('
+           'SELECT %(user_table)s.user_id AS user_id, %(user_table)s.object_id AS object_id, '
+           '%(user_table)s.permission AS permission FROM %(user_table)s '
+           'WHERE %(user_table)s.content_type_id = %%s%(user_where)s '
+           'UNION ALL '
+           'SELECT %(membership_user)s, %(group_table)s.object_id, %(group_table)s.permission '
+           'FROM %(group_table)s INNER JOIN %(membership_table)s ON '
+           '%(group_table)s.group_id = %(membership_group)s '
+           'WHERE %(group_table)s.content_type_id = %%s%(group_where)s'
+           ') perms GROUP BY perms.user_id, perms.object_id HAVING %(bits)s > 0') % {
+        'table': table,
+        'bits': bits,
+        'user_table': user_table,
+        'group_table': group_table,
+        'membership_table': membership_table,
+        'membership_user': membership_user,
+        'membership_group': membership_group,
+        'user_where': user_where,
+        'group_where': group_where,
+    }
+    cursor.execute(sql, [content_type.pk, content_type.pk] + user_params +
+                   [content_type.pk] + group_params)
+
+
+def refresh_effective_perms(content_type, object_ids=None, user_ids=None):
+    """
+    Recompute the effective permissions on the objects of ``content_type``\ .
+
+    :param content_type: The ``ContentType`` of the objects, or its id
+    :param object_ids: Only recompute these objects. **Default:** all of them
+    :type object_ids: ``list`` of ``integer``
+    :param user_ids: Only recompute the permissions of these users. **Default:** all of them
+    :type user_ids: ``list`` of ``integer``
+    """
+    if not isinstance(content_type, ContentType):
+        content_type = ContentType.objects.get_for_id(content_type)
+    cursor = connection.cursor()
+    object_chunks = object_ids is None and [None] or list(chunks(set(object_ids)))
+    user_chunks = user_ids is None and [None] or list(chunks(set(user_ids)))
+    for object_chunk in object_chunks:
+        for user_chunk in user_chunks:
+            _refresh(cursor, content_type, object_chunk, user_chunk)
+    transaction.commit_unless_managed()
+
+
+def _content_type_ids():
+    """
+    The ids of every content type with a permission or an effective permission
+    """
+    ids = set()
+    for model in [EffectivePermission] + [model for models in STORAGES.values() for model in models]:
+        ids.update(model.objects.values_list('content_type', flat=True).distinct())
+    return ids
+
+
+def refresh_users(user_ids):
+    """
+    Recompute all the effective permissions of the users ``user_ids``\ , for
+    example after their groups changed.
+    """
+    for content_type_id in _content_type_ids():
+        refresh_effective_perms(content_type_id, user_ids=user_ids)
+
+
+def refresh_groups(group_ids, user_ids=None):
+    """
+    Recompute the effective permissions on every object on which one of the
+    groups ``group_ids`` has a permission, for the users ``user_ids`` or
+    everyone.
+    """
+    by_content_type = {}
+    for user_perm_model, group_perm_model in STORAGES.values():
+        for content_type_id, object_id in group_perm_model.objects.filter(
+                group__in=list(group_ids)).values_list('content_type', 'object_id'):
+            by_content_type.setdefault(content_type_id, []).append(object_id)
+    for content_type_id, object_ids in by_content_type.items():
+        refresh_effective_perms(content_type_id, object_ids, user_ids)
+
+
+def rebuild_effective_perms():
+    """
+    Recompute the whole effective permission table.
+    """
+    EffectivePermission.objects.all().delete()
+    for content_type_id in _content_type_ids():
+        refresh_effective_perms(content_type_id)
+
+
+def get_effective_perm(user, instance):
+    """
+    Read the effective permission of ``user`` on ``instance`` from the table
+    """
+    content_type = ContentType.objects.get_for_model(instance)
+    perms = EffectivePermission.objects.filter(user=user, content_type=content_type,
+        object_id=instance.pk).values_list('permission', flat=True)
+    for perm in perms:
+        return perm
+    return 0
+
+
+def get_effective_perms(user, model, object_ids):
+    """
+    Read the effective permissions of ``user`` on the objects of ``model``
+    with the ids ``object_ids`` as a dictionary of ``object_id: permission``\ .
+    Objects without a row are left out.
+    """
+    content_type = ContentType.objects.get_for_model(model)
+    return dict(EffectivePermission.objects.filter(user=user, content_type=content_type,
+        object_id__in=list(object_ids)).values_list('object_id', 'permission'))
+
+
+def update_on_permission_changed(sender, **kwargs):
+    """
+    A ``permission_changed`` handler. A user permission only affects that
+    user; a group permission affects everyone on that object.
+    """
+    if sender._principal_field == 'user':
+        user_ids = [sender.user_id]
+    else:
+        user_ids = None
+    refresh_effective_perms(sender.content_type_id, [sender.object_id], user_ids)
+
+
+def update_on_permissions_changed_in_bulk(sender, to_whom, to_what, **kwargs):
+    """
+    A ``permissions_changed_in_bulk`` handler.
+    """
+    user_ids = []
+    for principal in to_whom:
+        if not isinstance(principal, User):
+            user_ids = None
+            break
+        user_ids.append(principal.pk)
+    by_model = {}
+    for instance in to_what:
+        by_model.setdefault(instance.__class__, []).append(instance.pk)
+    for model, object_ids in by_model.items():
+        refresh_effective_perms(ContentType.objects.get_for_model(model), object_ids, user_ids)
+
+
+def update_on_membership_changed(sender, instance, action, reverse, pk_set=None, **kwargs):
+    """
+    An ``m2m_changed`` handler for ``User.groups``\ .
+    """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        # instance is a group. After a clear its former members are unknown,
+        # so its objects are recomputed for everyone.
+        refresh_groups([instance.pk], action != 'post_clear' and pk_set or None)
+    elif action == 'post_clear':
+        refresh_users([instance.pk])
+    else:
+        refresh_groups(pk_set, [instance.pk])
+
+
+def remember_group_members(sender, instance, **kwargs):
+    """
+    A ``pre_delete`` handler for :class:`Group`\ . Deleting a group removes
+    its members without ``m2m_changed``\ , so they are noted while they are
+    still known.
+    """
+    instance._effective_members = list(instance.user_set.values_list('pk', flat=True))
+
+
+def refresh_group_members(sender, instance, **kwargs):
+    """
+    A ``post_delete`` handler for :class:`Group` that recomputes everything
+    its former members have. The cascade may have unset the group of its
+    permissions before ``pre_delete`` was sent, so its objects aren't known.
+    """
+    user_ids = getattr(instance, '_effective_members', None)
+    if user_ids:
+        del instance._effective_members
+        refresh_users(user_ids)
+
+
+def delete_user_effective_perms(sender, instance, **kwargs):
+    """
+    A ``pre_delete`` handler for :class:`User` that deletes its rows with
+    one statement, rather than letting the cascade load and delete each.
+    """
+    connection.cursor().execute('DELETE FROM %s WHERE user_id = %%s' %
+        connection.ops.quote_name(EffectivePermission._meta.db_table), [instance.pk])
+
+
+def connect_effective_perms():
+    """
+    Keep the effective permission table up to date. This is done
+    automatically when ``OBJECTPERMISSIONS_EFFECTIVE_PERMS`` is set. Raises
+    ``ImproperlyConfigured`` on versions of Django without ``m2m_changed``\ ,
+    where the table would fall behind whenever someone's groups change.
+    """
+    if m2m_changed is None:
+        raise ImproperlyConfigured("The effective permission table follows group membership "
+                                   "through m2m_changed, which needs Django 1.2 or later.")
+    permission_changed.connect(update_on_permission_changed,
+                               dispatch_uid='objectpermissions.effective')
+    permissions_changed_in_bulk.connect(update_on_permissions_changed_in_bulk,
+                                        dispatch_uid='objectpermissions.effective')
+    m2m_changed.connect(update_on_membership_changed, sender=User.groups.through,
+                        dispatch_uid='objectpermissions.effective')
+    signals.pre_delete.connect(remember_group_members, sender=Group,
+                               dispatch_uid='objectpermissions.effective')
+    signals.post_delete.connect(refresh_group_members, sender=Group,
+                                dispatch_uid='objectpermissions.effective')
+    signals.pre_delete.connect(delete_user_effective_perms, sender=User,
+                               dispatch_uid='objectpermissions.effective')
+
+
+def disconnect_effective_perms():
+    permission_changed.disconnect(update_on_permission_changed,
+                                  dispatch_uid='objectpermissions.effective')
+    permissions_changed_in_bulk.disconnect(update_on_permissions_changed_in_bulk,
+                                           dispatch_uid='objectpermissions.effective')
+    if m2m_changed is not None:
+        m2m_changed.disconnect(update_on_membership_changed, sender=User.groups.through,
+                               dispatch_uid='objectpermissions.effective')
+    signals.pre_delete.disconnect(remember_group_members, sender=Group,
+                                  dispatch_uid='objectpermissions.effective')
+    signals.post_delete.disconnect(refresh_group_members, sender=Group,
+                                   dispatch_uid='objectpermissions.effective')
+    signals.pre_delete.disconnect(delete_user_effective_perms, sender=User,
+                                  dispatch_uid='objectpermissions.effective')
+
+if app_settings.EFFECTIVE_PERMS:
+    connect_effective_perms()
@@ -0,0 +1,338 @@
+"""
+Permissions inherited from parent objects.
+
+A model registered with a ``parent``\ , the name of a ``ForeignKey`` to
+another registered model (or to itself), inherits every permission granted on
+its parent, its parent's parent and so on::
+
+    objectpermissions.register(Folder, ['read', 'write'], parent='parent')
+    objectpermissions.register(Document, ['read', 'write', 'delete'], parent='folder')
+
+Permissions are inherited bit for bit, so list the permissions the models
+share first and in the same order.
+
+The ancestors of each object are kept in the :class:`PermissionAncestor`
+closure table, one row per object and ancestor, updated whenever an object is
+saved or deleted. Checking a leaf then takes one query however deep it is:
+its own permission rows and those of its ancestors joined through the
+closure table.
+"""
+from django.db import connection
+from django.db.models import Q, signals
+from django.contrib.auth.models import User, Group
+from django.contrib.contenttypes.models import ContentType
+
+from models import UserPermission, GroupPermission, PermissionAncestor, stores_rows
+from utils import chunks, bulk_create
+
+#: The name of the parent ``ForeignKey`` of each model that inherits permissions
+parents = {}
+
+
+def is_hierarchical(model):
+    """
+    Does ``model`` inherit permissions from a parent?
+    """
+    return model in parents
+
+
+def parent_model(model):
+    """
+    The model that ``model`` inherits permissions from, or ``None``
+    """
+    if model not in parents:
+        return None
+    return model._meta.get_field(parents[model]).rel.to
+
+
+def descendant_models(model):
+    """
+    The models that inherit permissions from ``model``\ , directly or not,
+    including ``model`` itself if it is its own parent.
+    """
+    result = []
+    for child in parents:
+        parent = parent_model(child)
+        seen = set()
+        while parent is not None and parent not in seen:
+            if parent is model:
+                result.append(child)
+                break
+            seen.add(parent)
+            parent = parent_model(parent)
+    return result
+
+
+def register_parent(model, parent):
+    """
+    Make ``model`` inherit the permissions of the object in its ``ForeignKey``
+    named ``parent``\ .
+    """
+    field = model._meta.get_field(parent)
+    if not getattr(field, 'rel', None):
+        raise Exception("The parent of %s, '%s', is not a ForeignKey." % (model.__name__, parent))
+    if stores_rows(field.rel.to):
+        raise Exception("%s passes on permissions, so it must use the bitmask storage." % 
+                        field.rel.to.__name__)
+    parents[model] = parent
+    uid = 'objectpermissions.hierarchy.%s.%s' % (model._meta.app_label, model._meta.object_name)
+    signals.pre_save.connect(check_ancestors, sender=model, dispatch_uid=uid)
+    signals.post_save.connect(update_ancestors, sender=model, dispatch_uid=uid)
+    for sender in (model, field.rel.to):
+        uid = 'objectpermissions.hierarchy.%s.%s' % (sender._meta.app_label, sender._meta.object_name)
+        signals.post_delete.connect(delete_ancestors, sender=sender, dispatch_uid=uid)
+
+
+def _parent_key(instance):
+    """
+    The ``(content_type_id, object_id)`` of the parent of ``instance`` or ``None``
+    """
+    field = instance._meta.get_field(parents[instance.__class__])
+    parent_id = getattr(instance, field.attname)
+    if parent_id is None:
+        return None
+    return (ContentType.objects.get_for_model(field.rel.to).pk, parent_id)
+
+
+def _ancestors(content_type_id, object_id):
+    """
+    The ``(ancestor_type_id, ancestor_id, depth)`` of an object in the table
+    """
+    return list(PermissionAncestor.objects.filter(content_type=content_type_id,
+        object_id=object_id).values_list('ancestor_type', 'ancestor_id', 'depth'))
+
+
+def compute_ancestors(instance):
+    """
+    Return the ``(ancestor_type_id, ancestor_id, depth)`` of ``instance``
+    from its parent and the ancestors of its parent in the table.
+    """
+    key = _parent_key(instance)
+    if key is None:
+        return []
+    ancestors = [(key[0], key[1], 1)]
+    ancestors.extend([(ancestor_type, ancestor_id, depth + 1)
+                      for ancestor_type, ancestor_id, depth in _ancestors(*key)])
+    own_key = (ContentType.objects.get_for_model(instance).pk, instance.pk)
+    for ancestor_type, ancestor_id, depth in ancestors:
+        if (ancestor_type, ancestor_id) == own_key:
+            raise Exception("%s can't be its own ancestor." % instance)
+    return ancestors
+
+
+def _rows(content_type_id, object_id, ancestors, offset=0):
+    return [PermissionAncestor(content_type_id=content_type_id, object_id=object_id,
+                               ancestor_type_id=ancestor_type, ancestor_id=ancestor_id,
+                               depth=depth + offset)
+            for ancestor_type, ancestor_id, depth in ancestors]
+
+
+def _invalidate(model):
+    from cache import invalidate_models
+    invalidate_models([model] + descendant_models(model))
+
+
+def check_ancestors(sender, instance, **kwargs):
+    """
+    A ``pre_save`` handler that refuses to make an object its own ancestor.
+    The ancestors it finds are kept for :func:`update_ancestors`\ .
+    """
+    if instance.pk is not None:
+        instance._permission_ancestors = compute_ancestors(instance)
+
+
+def update_ancestors(sender, instance, created=False, **kwargs):
+    """
+    A ``post_save`` handler that records the ancestors of a new object and
+    moves the ancestors of an object, and those of everything under it, when
+    its parent changed.
+    """
+    content_type = ContentType.objects.get_for_model(instance)
+    new = getattr(instance, '_permission_ancestors', None)
+    if new is None:
+        new = compute_ancestors(instance)
+    else:
+        del instance._permission_ancestors
+    if created:
+        bulk_create(PermissionAncestor, _rows(content_type.pk, instance.pk, new))
+        return
+    old = _ancestors(content_type.pk, instance.pk)
+    if sorted(old) == sorted(new):
+        return
+
+    # The objects under instance keep their ancestors up to it and get the
+    # new ones above it instead of the old ones
+    subtree = [(content_type.pk, instance.pk, 0)]
+    subtree.extend(PermissionAncestor.objects.filter(ancestor_type=content_type,
+        ancestor_id=instance.pk).values_list('content_type', 'object_id', 'depth'))
+    if old:
+        old_ancestors = reduce(lambda x, y: x | y, [Q(ancestor_type=ancestor_type, ancestor_id=ancestor_id)
+                                                    for ancestor_type, ancestor_id, depth in old])
+        by_content_type = {}
+        for content_type_id, object_id, depth in subtree:
+            by_content_type.setdefault(content_type_id, []).append(object_id)
+        for content_type_id, object_ids in by_content_type.items():
+            for chunk in chunks(object_ids):
+                PermissionAncestor.objects.filter(old_ancestors, content_type=content_type_id,
+                                                  object_id__in=chunk).delete()
+    rows = []
+    for content_type_id, object_id, depth in subtree:
+        rows.extend(_rows(content_type_id, object_id, new, depth))
+    for chunk in chunks(rows):
+        bulk_create(PermissionAncestor, chunk)
+    _invalidate(sender)
+
+
+def delete_ancestors(sender, instance, **kwargs):
+    """
+    A ``post_delete`` handler that forgets the ancestors of a deleted object
+    and removes it from the ancestors of the objects under it.
+    """
+    content_type = ContentType.objects.get_for_model(instance)
+    PermissionAncestor.objects.filter(content_type=content_type, object_id=instance.pk).delete()
+    if descendant_models(sender):
+        PermissionAncestor.objects.filter(ancestor_type=content_type, ancestor_id=instance.pk).delete()
+        _invalidate(sender)
+
+
+def rebuild_ancestors(model):
+    """
+    Recompute the ancestors of every object of ``model``\ , parents first,
+    for example after registering a parent for a model that has objects.
+    """
+    for parent in reversed([model] + _ancestor_models(model)):
+        if parent not in parents:
+            continue
+        content_type = ContentType.objects.get_for_model(parent)
+        PermissionAncestor.objects.filter(content_type=content_type).delete()
+        remaining = dict([(obj.pk, obj) for obj in parent._default_manager.all()])
+        # An object's parent must be done before it when they are the same model
+        while remaining:
+            done = []
+            for pk, obj in remaining.items():
+                key = _parent_key(obj)
+                if key is not None and key[0] == content_type.pk and key[1] in remaining:
+                    continue
+                done.append(pk)
+            if not done:
+                raise Exception("The parents of some %s objects form a cycle." % parent.__name__)
+            rows = []
+            for pk in done:
+                rows.extend(_rows(content_type.pk, pk, compute_ancestors(remaining.pop(pk))))
+            for chunk in chunks(rows):
+                bulk_create(PermissionAncestor, chunk)
+    _invalidate(model)
+
+
+def _ancestor_models(model):
+    result = []
+    parent = parent_model(model)
+    while parent is not None and parent not in result and parent is not model:
+        result.append(parent)
+        parent = parent_model(parent)
+    return result
+
+
+def group_ids_sql(column, group_ids):
+    """
+    The condition that ``column`` is one of ``group_ids``\ . The ids are
+    integers from the database, so they are inlined.
+    """
+    return '%s IN (%s)' % (column, ', '.join(['%d' % group_id for group_id in sorted(group_ids)]))
+
+
+def _principal_sources(principal):
+    """
+    For each permission table that applies to ``principal``\ , a tuple of its
+    table, the joins it needs, the condition on ``principal`` and its
+    parameters. The permission table is aliased ``op_perm``\ .
+    """
+    from cache import get_group_ids
+    qn = connection.ops.quote_name
+    group_table = qn(GroupPermission._meta.db_table)
+    if isinstance(principal, User):
+        sources = [(qn(UserPermission._meta.db_table), '', 'op_perm.user_id = %s', [principal.pk])]
+        group_ids = get_group_ids(principal)
+        if group_ids is None:
+            groups_field = User._meta.get_field('groups')
+            join = ' INNER JOIN %s op_member ON op_perm.group_id = op_member.%s' % (
+                qn(groups_field.m2m_db_table()), qn(groups_field.m2m_reverse_name()))
+            sources.append((group_table, join, 'op_member.%s = %%s' % qn(groups_field.m2m_column_name()),
+                            [principal.pk]))
+        elif group_ids:
+            sources.append((group_table, '', group_ids_sql('op_perm.group_id', group_ids), []))
+        return sources
+    elif isinstance(principal, Group):
+        return [(group_table, '', 'op_perm.group_id = %s', [principal.pk])]
+    raise Exception("The principal should be a User or Group object.")
+
+
+def ancestor_perms_sql(principal, content_type_id, object_sql, select='op_anc.object_id, op_perm.permission',
+                       perm_sql=None, perm_params=()):
+    """
+    Return a list of the SQL and parameters of ``SELECT``\ s of the
+    permissions of ``principal`` on the ancestors of the objects of
+    ``content_type_id`` whose id matches ``object_sql`` (such as ``= %s``)\ ,
+    or of every object if it is ``None``\ . Only the rows whose
+    ``op_perm.permission`` matches ``perm_sql`` are selected.
+    """
+    table = connection.ops.quote_name(PermissionAncestor._meta.db_table)
+    parts = []
+    for perm_table, join, condition, params in _principal_sources(principal):
+        sql = ('SELECT %s FROM %s op_anc INNER JOIN %s op_perm ON '
+               'op_perm.content_type_id = op_anc.ancestor_type_id AND '
+               'op_perm.object_id = op_anc.ancestor_id%s WHERE op_anc.content_type_id = %%s'
+               '%s AND %s%s') % (select, table, perm_table, join,
+            object_sql and ' AND op_anc.object_id %s' % object_sql or '', condition,
+            perm_sql and ' AND %s' % perm_sql or '')
+        parts.append((sql, [content_type_id] + params + list(perm_params)))
+    return parts
+
+
+def own_perms_sql(principal, content_type_id, object_sql, select='op_perm.object_id, op_perm.permission',
+                  perm_sql=None, perm_params=()):
+    """
+    Like :func:`ancestor_perms_sql` for the permissions on the objects themselves
+    """
+    parts = []
+    for perm_table, join, condition, params in _principal_sources(principal):
+        sql = ('SELECT %s FROM %s op_perm%s WHERE op_perm.content_type_id = %%s'
+               '%s AND %s%s') % (select, perm_table, join,
+            object_sql and ' AND op_perm.object_id %s' % object_sql or '', condition,
+            perm_sql and ' AND %s' % perm_sql or '')
+        parts.append((sql, [content_type_id] + params + list(perm_params)))
+    return parts
+
+
+def perm_rows(principal, model, object_ids):
+    """
+    Return the ``(object_id, permission)`` of every row granted to
+    ``principal`` on the objects of ``model`` with ids ``object_ids`` or on
+    their ancestors, with one query.
+    """
+    object_ids = list(object_ids)
+    if not object_ids:
+        return []
+    content_type_id = ContentType.objects.get_for_model(model).pk
+    object_sql = 'IN (%s)' % ', '.join(['%s'] * len(object_ids))
+    parts = own_perms_sql(principal, content_type_id, object_sql) + \
+            ancestor_perms_sql(principal, content_type_id, object_sql)
+    sql = ' UNION ALL '.join([part for part, params in parts])
+    params = []
+    for part, part_params in parts:
+        params.extend(part_params[:1] + object_ids + part_params[1:])
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+
+def query_perm_bits(principal, instance):
+    """
+    Query the effective permissions of ``principal`` on ``instance``\ ,
+    including those inherited from its ancestors, with one query.
+    """
+    bits = 0
+    for object_id, perm in perm_rows(principal, instance.__class__, [instance.pk]):
+        if perm:
+            bits |= perm
+    return bits
@@ -0,0 +1,301 @@
+"""
+Count and time the permission checks and changes.
+
+Each call to one of the entry points (``has_object_perm``\ ,
+``get_object_perm``\ , ``get_objects_with_perms``\ , the grant and revoke
+functions) is reported to the active collector with the model, the user or
+group, the time it took and the queries it ran. ``get_objects_with_perms``
+returns a lazy ``QuerySet``\ , so it is reported when the query runs.
+Cache lookups are reported as hits or misses. With no collector, nothing is
+recorded.
+
+Collect for a block of code::
+
+    with collect_permission_stats() as stats:
+        response = client.get('/documents/')
+    stats.by_model()
+
+or for the whole process by setting ``OBJECTPERMISSIONS_COLLECTOR`` to the
+dotted path of a :class:`Collector` subclass, for example one that sends the
+numbers to your metrics system.
+"""
+import threading
+import time
+try:
+    from functools import wraps
+except ImportError:
+    from django.utils.functional import wraps  # Python 2.3, 2.4 fallback.
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.query import QuerySet
+from django.utils.importlib import import_module
+
+import settings as app_settings
+
+
+class Collector(object):
+    """
+    Receives the measurements. Subclass it and override the methods you need.
+    """
+    def record_call(self, operation, model, principal, elapsed, queries):
+        """
+        ``operation`` was called for ``model`` by ``principal`` and took
+        ``elapsed`` seconds and ``queries`` queries. ``queries`` is ``None``
+        unless the connection records its queries, as it does with ``DEBUG``\ .
+        """
+        pass
+
+    def record_cache(self, model, principal, hit):
+        """
+        A cache was consulted for the permissions of ``principal`` on an object of ``model``
+        """
+        pass
+
+
+class StatsCollector(Collector):
+    """
+    Keeps totals in memory per model and per user or group.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._models = {}
+        self._principals = {}
+
+    def _add(self, table, key, **values):
+        stats = table.setdefault(key, {'calls': 0, 'time': 0.0, 'queries': 0, 'hits': 0, 'misses': 0})
+        for name, value in values.items():
+            stats[name] += value
+
+    def record_call(self, operation, model, principal, elapsed, queries):
+        self._lock.acquire()
+        try:
+            for table, key in ((self._models, (operation, model)), (self._principals, (operation, principal))):
+                self._add(table, key, calls=1, time=elapsed, queries=queries or 0)
+        finally:
+            self._lock.release()
+
+    def record_cache(self, model, principal, hit):
+        counter = hit and 'hits' or 'misses'
+        self._lock.acquire()
+        try:
+            self._add(self._models, ('cache', model), **{counter: 1})
+            self._add(self._principals, ('cache', principal), **{counter: 1})
+        finally:
+            self._lock.release()
+
+    def by_model(self):
+        """
+        Return a dictionary of ``(operation, model label): totals``\ . The
+        totals are a dictionary of ``calls``\ , ``time``\ , ``queries``\ ,
+        ``hits`` and ``misses``\ . Cache lookups use the operation ``cache``\ .
+        """
+        return dict([(key, value.copy()) for key, value in self._models.items()])
+
+    def by_principal(self):
+        """
+        Return a dictionary of ``(operation, principal label): totals``
+        """
+        return dict([(key, value.copy()) for key, value in self._principals.items()])
+
+
+def _load_collector(path):
+    if not path:
+        return None
+    module, name = path.rsplit('.', 1)
+    return getattr(import_module(module), name)()
+
+#: The collector used when no :class:`collect_permission_stats` block is open
+default_collector = _load_collector(app_settings.COLLECTOR)
+
+_local = threading.local()
+
+
+def get_collector():
+    """
+    Return the active collector or ``None``
+    """
+    stack = getattr(_local, 'collectors', None)
+    if stack:
+        return stack[-1]
+    return default_collector
+
+
+def set_collector(collector):
+    """
+    Make ``collector`` the collector of the whole process. ``None`` turns it off.
+    """
+    global default_collector
+    default_collector = collector
+
+
+class collect_permission_stats(object):
+    """
+    Report everything done in this thread inside the block to ``collector``\ ,
+    a :class:`StatsCollector` by default, which is returned by ``with``\ .
+    """
+    def __init__(self, collector=None):
+        if collector is None:
+            collector = StatsCollector()
+        self.collector = collector
+
+    def __enter__(self):
+        if not hasattr(_local, 'collectors'):
+            _local.collectors = []
+        _local.collectors.append(self.collector)
+        return self.collector
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.collectors.pop()
+        return False
+
+
+def model_label(model):
+    if not isinstance(model, type):
+        model = model.__class__
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+
+def principal_label(principal):
+    return '%s:%s' % (principal._meta.module_name, principal.pk)
+
+
+def record_cache(instance, principal, hit):
+    """
+    Report a cache lookup for the permissions of ``principal`` on ``instance``
+    """
+    collector = get_collector()
+    if collector is not None:
+        collector.record_cache(model_label(instance), principal_label(principal), hit)
+
+
+def instrumented(operation):
+    """
+    Decorate a function added to :class:`User` and :class:`Group` whose first
+    argument after ``self`` is a model instance or class, so its calls are
+    reported as ``operation``\ .
+    """
+    def decorator(func):
+        def _instrumented(self, target, *args, **kwargs):
+            collector = get_collector()
+            if collector is None:
+                return func(self, target, *args, **kwargs)
+            recording = settings.DEBUG or getattr(connection, 'use_debug_cursor', False)
+            queries = len(connection.queries)
+            start = time.time()
+            try:
+                return func(self, target, *args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                if recording:
+                    queries = len(connection.queries) - queries
+                else:
+                    queries = None
+                collector.record_call(operation, model_label(target), principal_label(self),
+                                      elapsed, queries)
+        return wraps(func)(_instrumented)
+    return decorator
+
+
+class MeasuredQuerySet(object):
+    """
+    Mixed into the class of a ``QuerySet`` returned by an instrumented
+    operation, so the call is reported each time it, or a ``QuerySet`` made
+    from it, including by ``values()``\ , is evaluated or counted, with the
+    time and queries of fetching the rows.
+    """
+    _measure = None
+    
+    def _clone(self, klass=None, *args, **kwargs):
+        if klass is not None and not issubclass(klass, MeasuredQuerySet):
+            klass = _measured_class(klass)
+        clone = super(MeasuredQuerySet, self)._clone(klass, *args, **kwargs)
+        clone._measure = self._measure
+        return clone
+    
+    def _measured_call(self, name, *args, **kwargs):
+        func = getattr(super(MeasuredQuerySet, self), name)
+        if self._measure is None or self._result_cache is not None:
+            return func(*args, **kwargs)
+        collector, operation, model, principal = self._measure
+        recording = settings.DEBUG or getattr(connection, 'use_debug_cursor', False)
+        queries = len(connection.queries)
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            if recording:
+                queries = len(connection.queries) - queries
+            else:
+                queries = None
+            collector.record_call(operation, model, principal, elapsed, queries)
+    
+    def count(self):
+        return self._measured_call('count')
+    
+    def aggregate(self, *args, **kwargs):
+        return self._measured_call('aggregate', *args, **kwargs)
+    
+    def in_bulk(self, id_list):
+        return self._measured_call('in_bulk', id_list)
+    
+    if hasattr(QuerySet, 'exists'):
+        # Django 1.2
+        def exists(self):
+            return self._measured_call('exists')
+    
+    def iterator(self):
+        results = super(MeasuredQuerySet, self).iterator()
+        if self._measure is None:
+            for obj in results:
+                yield obj
+            return
+        collector, operation, model, principal = self._measure
+        recording = settings.DEBUG or getattr(connection, 'use_debug_cursor', False)
+        elapsed, queries = 0.0, 0
+        try:
+            while True:
+                # Only the time spent fetching, not in the caller's loop
+                before = recording and len(connection.queries)
+                start = time.time()
+                try:
+                    obj = results.next()
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.time() - start
+                    if recording:
+                        queries += len(connection.queries) - before
+                yield obj
+        finally:
+            collector.record_call(operation, model, principal, elapsed, recording and queries or None)
+
+_measured_classes = {}
+
+
+def _measured_class(klass):
+    if klass not in _measured_classes:
+        _measured_classes[klass] = type('Measured%s' % klass.__name__, (MeasuredQuerySet, klass), {})
+    return _measured_classes[klass]
+
+
+def instrumented_queryset(operation):
+    """
+    Like :func:`instrumented` for a function that returns a lazy
+    ``QuerySet``\ : the call is reported when the query runs.
+    """
+    def decorator(func):
+        def _instrumented(self, target, *args, **kwargs):
+            queryset = func(self, target, *args, **kwargs)
+            collector = get_collector()
+            if collector is None:
+                return queryset
+            measured = queryset._clone(klass=_measured_class(queryset.__class__))
+            measured._measure = (collector, operation, model_label(target), principal_label(self))
+            return measured
+        return wraps(func)(_instrumented)
+    return decorator
@@ -0,0 +1,91 @@
+"""
+Composite indexes for the permission tables.
+
+``unique_together`` gives new tables a unique index on
+``(content_type_id, object_id, user_id)`` (or ``group_id``), which is what
+every permission lookup filters on. The covering indexes add the
+``permission`` column so lookups never have to read the table itself. They
+are created after ``syncdb`` creates the tables, and the
+``permission_indexes`` command adds both to tables created by older versions.
+
+The tables of the row storage also have the ``permission`` in their unique
+index, and their second index starts with the user or group and the
+permission, for finding the objects on which someone has a permission.
+"""
+import sys
+
+from django.db import connection, transaction, DatabaseError
+from django.db.models import signals
+
+from objectpermissions import models as perm_models
+from objectpermissions.models import (UserPermission, GroupPermission, UserPermissionRow,
+                                      GroupPermissionRow)
+
+PERMISSION_TABLES = ((UserPermission, 'user'), (GroupPermission, 'group'),
+                     (UserPermissionRow, 'user'), (GroupPermissionRow, 'group'))
+
+
+def index_statements(unique=True, covering=True):
+    """
+    Return a list of ``(name, sql)`` tuples that create the indexes for the
+    permission tables.
+    """
+    qn = connection.ops.quote_name
+    statements = []
+    for model, principal in PERMISSION_TABLES:
+        table = model._meta.db_table
+        if model._bit_rows:
+            names = (('content_type', 'object_id', principal, 'permission'),
+                     (principal, 'content_type', 'permission', 'object_id'))
+        else:
+            names = (('content_type', 'object_id', principal),
+                     ('content_type', 'object_id', principal, 'permission'))
+        unique_columns, covering_columns = [[model._meta.get_field(name).column for name in fields]
+                                            for fields in names]
+        if unique:
+            name = '%s_unique' % table
+            statements.append((name, 'CREATE UNIQUE INDEX %s ON %s (%s);' % (
+                qn(name), qn(table), ', '.join([qn(c) for c in unique_columns]))))
+        if covering:
+            name = '%s_covering' % table
+            statements.append((name, 'CREATE INDEX %s ON %s (%s);' % (
+                qn(name), qn(table), ', '.join([qn(c) for c in covering_columns]))))
+    return statements
+
+
+def create_indexes(statements, verbosity=1):
+    """
+    Run each of the ``(name, sql)`` ``statements``\ . One that fails, for
+    example because the index already exists, is reported and skipped.
+    
+    :result: The number of indexes created
+    """
+    cursor = connection.cursor()
+    created = 0
+    for name, sql in statements:
+        try:
+            cursor.execute(sql)
+            transaction.commit_unless_managed()
+            created += 1
+            if verbosity >= 1:
+                sys.stdout.write("Created index %s\n" % name)
+        except DatabaseError as e:
+            transaction.rollback_unless_managed()
+            if verbosity >= 1:
+                sys.stdout.write("Skipped index %s: %s\n" % (name, e))
+    return created
+
+
+def create_covering_indexes(sender, created_models, verbosity=1, **kwargs):
+    """
+    Add the covering indexes to the permission tables that ``syncdb`` just created.
+    """
+    statements = []
+    for name, sql in index_statements(unique=False):
+        for model, principal in PERMISSION_TABLES:
+            if model in created_models and name.startswith(model._meta.db_table + '_'):
+                statements.append((name, sql))
+    if statements:
+        create_indexes(statements, verbosity - 1)
+
+signals.post_syncdb.connect(create_covering_indexes, sender=perm_models)
@@ -0,0 +1,29 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from objectpermissions.cleanup import compact_permissions, vacuum, BATCH_SIZE
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=BATCH_SIZE,
+            help='The most rows to read or delete at a time. Defaults to %d.' % BATCH_SIZE),
+        make_option('--vacuum', action='store_true', dest='vacuum', default=False,
+            help='Give the space of the deleted rows back to the database afterwards.'),
+    )
+    help = "Merge duplicate object permission rows and delete empty and orphaned ones."
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        report = compact_permissions(options.get('batch_size') or BATCH_SIZE)
+        if verbosity >= 1:
+            for model, merged, empty, orphans in report:
+                sys.stdout.write("%s: %d merged, %d empty, %d orphaned\n" % (
+                    model._meta.db_table, merged, empty, orphans))
+        if options.get('vacuum'):
+            if vacuum([model for model, merged, empty, orphans in report]):
+                if verbosity >= 1:
+                    sys.stdout.write("Vacuumed the permission tables\n")
+            else:
+                sys.stderr.write("Don't know how to vacuum this database\n")
@@ -0,0 +1,24 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from objectpermissions.management import index_statements, create_indexes
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--unique', action='store_true', dest='unique', default=False,
+            help='Also add the unique indexes. Only needed for tables created before they were declared.'),
+        make_option('--sql', action='store_true', dest='sql', default=False,
+            help='Print the SQL instead of running it.'),
+    )
+    help = "Add the composite indexes to existing object permission tables."
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        statements = index_statements(unique=options.get('unique', False))
+        if options.get('sql'):
+            for name, sql in statements:
+                sys.stdout.write("%s\n" % sql)
+            return
+        create_indexes(statements, verbosity)
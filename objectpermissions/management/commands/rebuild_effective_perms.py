@@ -0,0 +1,16 @@
+import sys
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from objectpermissions.effective import rebuild_effective_perms
+from objectpermissions.models import EffectivePermission
+
+class Command(NoArgsCommand):
+    help = "Recompute the effective permission of every user on every object."
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        transaction.commit_on_success(rebuild_effective_perms)()
+        if verbosity >= 1:
+            sys.stdout.write("Rebuilt %d effective permissions\n" % EffectivePermission.objects.count())
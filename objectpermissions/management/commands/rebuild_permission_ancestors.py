@@ -0,0 +1,27 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import get_model
+
+from objectpermissions.hierarchy import parents, rebuild_ancestors
+
+class Command(BaseCommand):
+    args = '[appname.ModelName ...]'
+    help = "Recompute the ancestors of the objects of models that inherit permissions. All of them by default."
+    
+    def handle(self, *labels, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if labels:
+            models = []
+            for label in labels:
+                model = get_model(*label.split('.', 1))
+                if model not in parents:
+                    raise CommandError("%s doesn't inherit permissions." % label)
+                models.append(model)
+        else:
+            models = parents.keys()
+        for model in models:
+            transaction.commit_on_success(rebuild_ancestors)(model)
+            if verbosity >= 1:
+                sys.stdout.write("Rebuilt the ancestors of %s.%s\n" % (model._meta.app_label, model._meta.object_name))
@@ -0,0 +1,22 @@
+from cache import enable_request_cache, disable_request_cache, clear_request_caches
+
+class PermissionCacheMiddleware(object):
+    """
+    Cache the object permissions of ``request.user`` for the length of the
+    request, so repeated checks on the same object only hit the database once.
+
+    It must come after ``AuthenticationMiddleware`` in ``MIDDLEWARE_CLASSES``\ .
+    """
+    def process_request(self, request):
+        clear_request_caches()
+        user = request.user
+        if user.is_authenticated():
+            enable_request_cache(user)
+            request._object_perm_cache_user = user
+
+    def process_response(self, request, response):
+        user = getattr(request, '_object_perm_cache_user', None)
+        if user is not None:
+            disable_request_cache(user)
+            del request._object_perm_cache_user
+        return response
@@ -1,7 +1,11 @@
-from django.db import models
+from django.db import models, connection
 from django.contrib.auth.models import User, Group
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
+try:
+    from django.utils.functional import SimpleLazyObject
+except ImportError:
+    SimpleLazyObject = None
 
 class UnknownPermission(Exception):
     """
@@ -17,8 +21,58 @@ class PermissionManager(models.Manager):
         """
         perm = self.instance.perms.as_int(permission)
         qs = self.get_query_set()
-        new_qs = qs.extra(where=['permission & %s = %s',], params=[perm, perm])
-        return new_qs
+        if self.model._bit_rows:
+            # One row per permission: return the row of the first one, for
+            # the users or groups that also have a row for each of the others
+            bits = self.instance.perms.as_int_list(perm)
+            if not bits:
+                return qs.none()
+            qs = qs.filter(permission=bits[0])
+            if len(bits) == 1:
+                return qs
+            qn = connection.ops.quote_name
+            table = qn(self.model._meta.db_table)
+            principal = qn('%s_id' % self.model._principal_field)
+            where = ('(SELECT COUNT(*) FROM %(table)s bits WHERE bits.%(principal)s = '
+                     '%(table)s.%(principal)s AND bits.content_type_id = %(table)s.content_type_id '
+                     'AND bits.object_id = %(table)s.object_id AND bits.permission IN (%(in)s)) = %%s') % {
+                'table': table,
+                'principal': principal,
+                'in': ', '.join(['%s'] * len(bits)),
+            }
+            return qs.extra(where=[where], params=bits + [len(bits)])
+        condition = self.instance.perms.masks_sql('permission', perm, True)
+        if condition is not None:
+            # Every value that has the bits, so the index can be used
+            return qs.extra(where=[condition])
+        return qs.extra(where=['permission & %s = %s',], params=[perm, perm])
+
+
+def _lazy_related(obj, name):
+    """
+    Return the related object ``name`` of ``obj`` if it is already loaded,
+    otherwise an object that loads it the first time it is used.
+    """
+    if SimpleLazyObject is None or hasattr(obj, '_%s_cache' % name):
+        return getattr(obj, name)
+    return SimpleLazyObject(lambda: getattr(obj, name))
+
+
+# The bits of every byte, most significant first
+_BYTE_BITS = [[(byte >> i) & 1 for i in range(7, -1, -1)] for byte in range(256)]
+
+
+def _bit_length(a):
+    """
+    The number of bits needed to represent the non-negative integer ``a``
+    """
+    if a < 0:
+        raise ValueError("The permission %s is negative" % a)
+    try:
+        return a.bit_length()
+    except AttributeError:
+        # Python 2.6
+        return len(bin(a)) - 2 - (a == 0)
 
 
 class Permission(models.Model):
@@ -35,11 +89,14 @@ class Permission(models.Model):
     
     objects = PermissionManager()
     
+    # Does each row hold a single permission? See PermissionRow
+    _bit_rows = False
+    
     @classmethod
     def bits(self, a):
         """
         Convert an integer into a list of 1's or 0's indicating the
-        bits set. Modified from http://wiki.python.org/moin/BitManipulation
+        bits set, most significant first, padded to a multiple of three.
         
         >>> Permission.bits(10)
         [0, 0, 1, 0, 1, 0]
@@ -48,11 +105,16 @@ class Permission(models.Model):
         :type a: ``integer``
         :result: A list of ``1`` and ``0`` corresponding to a bit set or not
         """
-        result = []
-        oct_bits={'0':[0,0,0],'1':[0,0,1],'2':[0,1,0],'3':[0,1,1],
-           '4':[1,0,0],'5':[1,0,1],'6':[1,1,0],'7':[1,1,1]}
-        for c in filter(lambda char: char != 'L', oct(a))[1:]:
-                result += oct_bits[c]
+        length = _bit_length(a)
+        length += -length % 3
+        # The leading, partial byte and then a whole byte at a time
+        head = length % 8
+        if head:
+            result = _BYTE_BITS[a >> (length - head)][8 - head:]
+        else:
+            result = []
+        for shift in range(length - head - 8, -1, -8):
+            result.extend(_BYTE_BITS[(a >> shift) & 0xff])
         return result
     
     @classmethod
@@ -68,12 +130,17 @@ class Permission(models.Model):
         :type a: ``integer``
         :result: A list of integers corresponding to values of the set bits
         """
-        result=[]
-        bitlist = self.bits(a)
-        l = len(bitlist)
-        for i in range(l):
-            result.insert(0, 1<<i)
-        return [i for i in map(lambda x,y: x*y, bitlist, result) if i != 0]
+        if not a:
+            return []
+        if a < 0:
+            raise ValueError("The permission %s is negative" % a)
+        result = []
+        while a:
+            lowest = a & -a
+            result.append(lowest)
+            a ^= lowest
+        result.reverse()
+        return result
     
     
     def _set_perm_with_list(self, int_list):
@@ -94,74 +161,310 @@ class Permission(models.Model):
         return self.int_to_perms(self.permission)
     
     perm_list = property(_get_perm_as_list, _set_perm_with_list, doc="The permissions as an integer list")
+    
+    def _get_principal(self):
+        return getattr(self, self._principal_field)
+    
+    principal = property(_get_principal, doc="The User or Group to whom the permission is granted")
+    
+    def _get_principal_id(self):
+        return getattr(self, '%s_id' % self._principal_field)
+    
+    def send_changed(self):
+        """
+        Send out a signal indicating that this permission was changed.
+        
+        Nothing is done if no one listens. The user or group and the object
+        are passed as lazy objects unless they are already loaded, so they are
+        only fetched if a receiver uses them.
+        """
+        from signals import permission_changed, has_receivers, send
+        if not has_receivers(permission_changed):
+            return
+        send(permission_changed, self, to_whom=_lazy_related(self, self._principal_field),
+             to_what=_lazy_related(self, 'content_object'))
 
 class UserPermission(Permission):
     user = models.ForeignKey(User)
     
+    class Meta:
+        unique_together = (('content_type', 'object_id', 'user'),)
+    
+    _principal_field = 'user'
+    
     def save(self, *a, **kw):
         """
         Send out a signal indicating that a permission was changed
         """
         super(Permission, self).save(*a, **kw)
-        from signals import permission_changed
-        permission_changed.send(sender=self, to_whom=self.user, to_what=self.content_object)
+        self.send_changed()
+    
+    def delete(self, *a, **kw):
+        """
+        Send out a signal indicating that a permission was removed
+        """
+        super(UserPermission, self).delete(*a, **kw)
+        self.send_changed()
 
 
 class GroupPermission(Permission):
     group = models.ForeignKey(Group, null=True)
     
+    class Meta:
+        unique_together = (('content_type', 'object_id', 'group'),)
+    
+    _principal_field = 'group'
+    
     def save(self, *a, **kw):
         """
         Send out a signal indicating that a permission was changed
         """
         super(Permission, self).save(*a, **kw)
-        from signals import permission_changed
-        permission_changed.send(sender=self, to_whom=self.group, to_what=self.content_object)
+        self.send_changed()
+    
+    def delete(self, *a, **kw):
+        """
+        Send out a signal indicating that a permission was removed
+        """
+        super(GroupPermission, self).delete(*a, **kw)
+        self.send_changed()
+
+
+class PermissionRow(Permission):
+    """
+    A single permission granted to a User or Group on an object, for models
+    registered with ``storage='rows'``\ . A user or group has one row per
+    permission they hold, so rows can be found by permission with an index.
+    The permissions on an object are the OR of the rows.
+    """
+    class Meta:
+        abstract = True
+    
+    _bit_rows = True
+    
+    def send_changed(self):
+        """
+        Send ``permission_changed`` with the combined permissions of the user
+        or group on the object, so receivers see the same thing as with the
+        bitmask storage.
+        """
+        from signals import permission_changed, has_receivers
+        if not has_receivers(permission_changed):
+            return
+        lookup = {self._principal_field: self._get_principal_id()}
+        bits = self.__class__.objects.filter(content_type=self.content_type_id, 
+            object_id=self.object_id, **lookup).values_list('permission', flat=True)
+        combined = self.__class__(content_type_id=self.content_type_id, object_id=self.object_id,
+                                  permission=reduce(lambda x, y: x | y, bits, 0), 
+                                  **{'%s_id' % self._principal_field: self._get_principal_id()})
+        for name in ('content_object', self._principal_field):
+            if hasattr(self, '_%s_cache' % name):
+                setattr(combined, '_%s_cache' % name, getattr(self, '_%s_cache' % name))
+        super(PermissionRow, combined).send_changed()
+    
+    def save(self, *a, **kw):
+        super(PermissionRow, self).save(*a, **kw)
+        self.send_changed()
+    
+    def delete(self, *a, **kw):
+        super(PermissionRow, self).delete(*a, **kw)
+        self.send_changed()
+
+
+class UserPermissionRow(PermissionRow):
+    user = models.ForeignKey(User)
+    
+    class Meta:
+        unique_together = (('content_type', 'object_id', 'user', 'permission'),)
+    
+    _principal_field = 'user'
+
+
+class GroupPermissionRow(PermissionRow):
+    group = models.ForeignKey(Group)
+    
+    class Meta:
+        unique_together = (('content_type', 'object_id', 'group', 'permission'),)
+    
+    _principal_field = 'group'
+
+
+class EffectivePermission(models.Model):
+    """
+    The effective permission of a user on an object: the OR of their own
+    permission and those of all their groups. The table is only kept when
+    ``OBJECTPERMISSIONS_EFFECTIVE_PERMS`` is set; see
+    :mod:`objectpermissions.effective`\ .
+    """
+    user = models.ForeignKey(User)
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    permission = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = (('user', 'content_type', 'object_id'),)
+
+
+class PermissionAncestor(models.Model):
+    """
+    An ancestor of an object of a model that inherits permissions: a closure
+    table with a row for every object and each of its ancestors. See
+    :mod:`objectpermissions.hierarchy`\ .
+    """
+    content_type = models.ForeignKey(ContentType, related_name='permission_ancestors')
+    object_id = models.PositiveIntegerField()
+    ancestor_type = models.ForeignKey(ContentType, related_name='permission_descendants')
+    ancestor_id = models.PositiveIntegerField(db_index=True)
+    depth = models.PositiveIntegerField()
+    
+    class Meta:
+        unique_together = (('content_type', 'object_id', 'ancestor_type', 'ancestor_id'),)
+
+
+#: Models with up to this many permissions decode every mask with a table of
+#: all ``2 ** n`` masks, built when they are registered
+DECODE_TABLE_BITS = 12
+
+#: For models with more permissions, the most decoded masks that are remembered
+DECODE_CACHE_SIZE = 4096
+
+#: Models with up to this many permissions match permission values with a
+#: list of every value that qualifies instead of a bitwise test
+MASK_LIST_BITS = 8
 
 
 class ModelPermissions(object):
     """
     An object that converts named permissions into a bitwise set of attributes
+    
+    The name to bit and bit to name tables are built once, so converting
+    between names, integers and lists is a dictionary or list lookup.
     """
     def __init__(self, permissions):
-        self._perms = permissions[:]
+        self._perms = tuple(permissions)
+        self._bits = {}
+        self._items = []
         for num, perm in enumerate(permissions):
             setattr(self, perm, 1<<num)
+            self._bits[perm] = 1<<num
+            self._items.append((1<<num, perm))
+        self._items = tuple(self._items)
+        self._names = dict(self._items)
+        self._mask = (1 << len(self._perms)) - 1
+        if len(self._perms) <= DECODE_TABLE_BITS:
+            self._decoded = [self._decode(perm) for perm in range(self._mask + 1)]
+        else:
+            self._decoded = {}
+        self._masks = {}
+    
+    def _decode(self, perm):
+        """
+        Return the ``(int_list, string_list, choices)`` of ``perm`` as tuples
+        """
+        keys = []
+        perm &= self._mask
+        while perm:
+            lowest = perm & -perm
+            keys.append(lowest)
+            perm ^= lowest
+        names = [self._names[key] for key in keys]
+        return (tuple(keys), tuple(names), tuple(zip(keys, names)))
+    
+    def decode(self, perm):
+        """
+        Return the ``(int_list, string_list, choices)`` of the permissions set
+        in ``perm`` as tuples, from the decode table. Don't modify them.
+        """
+        if not isinstance(perm, (int, long)):
+            raise UnknownPermission("'perm' must be an integer")
+        perm &= self._mask
+        try:
+            return self._decoded[perm]
+        except KeyError:
+            decoded = self._decode(perm)
+            if len(self._decoded) < DECODE_CACHE_SIZE:
+                self._decoded[perm] = decoded
+            return decoded
+    
+    def masks(self, perm, require_all=False):
+        """
+        Return every permission value that has *all* of the bits of ``perm``
+        if ``require_all`` is ``True``\ , otherwise *any* of them, so rows
+        can be matched with ``permission IN (...)`` on an index instead of a
+        bitwise test on every row. Returns ``None`` for models with more than
+        ``MASK_LIST_BITS`` permissions, whose lists would be too long.
+        """
+        if len(self._perms) > MASK_LIST_BITS:
+            return None
+        key = (perm, bool(require_all))
+        try:
+            return self._masks[key]
+        except KeyError:
+            pass
+        if require_all:
+            masks = [value for value in range(self._mask + 1) if value & perm == perm]
+        else:
+            masks = [value for value in range(self._mask + 1) if value & perm]
+        self._masks[key] = masks
+        return masks
+    
+    def masks_sql(self, column, perm, require_all=False):
+        """
+        Return the SQL that tests ``column`` for :meth:`masks`\ , or ``None``
+        where there are no lists. Values with bits above the registered
+        permissions, left when a model loses permissions or set as a raw
+        integer, aren't listed and are tested bitwise; ``column > mask``
+        keeps that test to those rows.
+        """
+        masks = self.masks(perm, require_all)
+        if masks is None:
+            return None
+        if require_all:
+            bitwise = '%s & %d = %d' % (column, perm, perm)
+        else:
+            bitwise = '%s & %d > 0' % (column, perm)
+        if not masks:
+            return '(%s > %d AND %s)' % (column, self._mask, bitwise)
+        # The masks are integers we generated, so they are inlined
+        return '(%s IN (%s) OR %s > %d AND %s)' % (column, ', '.join(['%d' % mask for mask in masks]),
+                                                   column, self._mask, bitwise)
     
     def __len__(self):
         return len(self._perms)
     
     def __getitem__(self, key):
-        if key in self._perms:
-            return getattr(self, key)
-        else:
-            raise KeyError
+        return self._bits[key]
     
     def __iter__(self):
-        for item in self._perms:
-            yield item
+        return iter(self._perms)
     
     def iterkeys(self):
         return self.__iter__()
     
     def itervalues(self):
-        for item in self._perms:
-            yield getattr(self, item)
+        for key, val in self._items:
+            yield key
     
     def keys(self):
-        return self._perms
+        return list(self._perms)
     
     def values(self):
-        return [getattr(self, x) for x in self._perms]
+        return [key for key, val in self._items]
     
     def has_key(self, key):
         return self.__contains__(key)
     
     def __contains__(self, value):
-        return value in self._perms
+        return value in self._bits
     
     def items(self):
-        return [(getattr(self, key), key) for key in self._perms]
+        return list(self._items)
+    
+    def name(self, bit):
+        """
+        Return the name of the permission with the value ``bit``
+        """
+        return self._names[bit]
     
     def as_int(self, perm):
         """
@@ -170,54 +473,41 @@ class ModelPermissions(object):
         Converts strings by looking up the name
         Converts a list or tuple by OR'ing the int value for each item
         """
-        if isinstance(perm, int):
-            valid_perm = perm
+        if isinstance(perm, (int, long)):
+            return perm
         elif isinstance(perm, basestring):
-            # Look up the attribute, it will raise an error if it doesn't exist
-            valid_perm = getattr(self, perm)
+            try:
+                return self._bits[perm]
+            except KeyError:
+                raise AttributeError("'%s' is not a permission of this model." % perm)
         elif isinstance(perm, (list, tuple)):
             valid_perm = 0
             for item in perm:
-                valid_perm |= self.as_int(item)
+                if isinstance(item, basestring) and item in self._bits:
+                    valid_perm |= self._bits[item]
+                else:
+                    valid_perm |= self.as_int(item)
+            return valid_perm
         else:
             raise UnknownPermission("'%s' is an unknown permission type." % perm)
-        return valid_perm
     
     def as_string_list(self, perm):
         """
         A utility method to convert an integer into a list of strings of the selected permissions
         """
-        if not isinstance(perm, int):
-            raise UnknownPermission("'perm' must be an integer")
-        result_list = []
-        for key, val in self.items():
-            if key & perm == key:
-                result_list.append(val)
-        return result_list
+        return list(self.decode(perm)[1])
     
     def as_int_list(self, perm):
         """
         A utility method to convert an integer into a list of integers of the selected permissions
         """
-        if not isinstance(perm, int):
-            raise UnknownPermission("'perm' must be an integer")
-        result_list = []
-        for key, val in self.items():
-            if key & perm == key:
-                result_list.append(key)
-        return result_list
+        return list(self.decode(perm)[0])
         
     def as_choices(self, perm):
         """
         A utility method to convert an integer into a list of integer, string tuples for choices
         """
-        if not isinstance(perm, int):
-            raise UnknownPermission("'perm' must be an integer")
-        result_list = []
-        for key, val in self.items():
-            if key & perm == key:
-                result_list.append((key, val))
-        return result_list
+        return list(self.decode(perm)[2])
     
     def choice_list(self):
         """
@@ -229,15 +519,44 @@ class ModelPermissions(object):
 class UserPermissionRelation(generic.GenericRelation):
     """A generic relation for Object Permissions"""
     
-    def __init__(self,**kwargs):
+    def __init__(self, to=UserPermission, **kwargs):
         """Override this to automatically set the "to" field """
-        super(UserPermissionRelation, self).__init__(UserPermission, **kwargs)
+        super(UserPermissionRelation, self).__init__(to, **kwargs)
 
 
 class GroupPermissionRelation(generic.GenericRelation):
     """A generic relation for Object Permissions"""
     
-    def __init__(self,**kwargs):
+    def __init__(self, to=GroupPermission, **kwargs):
         """Override this to automatically set the "to" field """
-        super(GroupPermissionRelation, self).__init__(GroupPermission, **kwargs)
+        super(GroupPermissionRelation, self).__init__(to, **kwargs)
+
+
+#: The user and group permission models of each storage
+STORAGES = {
+    'bitmask': (UserPermission, GroupPermission),
+    'rows': (UserPermissionRow, GroupPermissionRow),
+}
+
+
+def perm_models(model):
+    """
+    Return the user and group permission models behind the
+    ``user_perms_set`` and ``group_perms_set`` relations of ``model``\ : 
+    :class:`UserPermission` and :class:`GroupPermission` unless it was
+    registered with another storage. Models that aren't registered get those.
+    """
+    try:
+        opts = model._meta
+        return (opts.get_field('user_perms_set').rel.to,
+                opts.get_field('group_perms_set').rel.to)
+    except (AttributeError, models.FieldDoesNotExist):
+        return STORAGES['bitmask']
+
+
+def stores_rows(model):
+    """
+    Does ``model`` keep one row per permission?
+    """
+    return perm_models(model)[0]._bit_rows
 
@@ -0,0 +1,498 @@
+"""
+Filter and annotate querysets of registered models by the permissions a
+:class:`User` or :class:`Group` has on each row.
+
+Everything is done with subqueries on the permission tables, so the result
+can still be chained, ordered and sliced in the database. Filtering selects
+the ids of the objects with a matching row through the index on the
+permission tables; only the annotation of :func:`with_perms_for` is computed
+for each row::
+
+    pages = filter_perm(FlatPage.objects.all(), request.user, 'read')
+    pages = with_perms_for(pages, request.user).order_by('title')[:20]
+"""
+from django.db import connection, models
+from django.db.models.query import QuerySet
+from django.contrib.auth.models import User, Group
+from django.contrib.contenttypes.models import ContentType
+
+from models import EffectivePermission, PermissionAncestor, perm_models, stores_rows
+from hierarchy import is_hierarchical, ancestor_perms_sql, own_perms_sql, group_ids_sql
+from cache import get_group_ids
+from utils import bit_or_sql
+
+
+def effective_enabled(model):
+    from effective import enabled
+    return enabled(model)
+
+
+def group_lookup(user):
+    """
+    Return the lookup that selects the group permission rows of ``user``\ :
+    ``group__in`` the ids of its groups when they are known (see
+    :func:`get_group_ids`), else a join on the membership table. ``None``
+    if the user is in no group.
+    """
+    group_ids = get_group_ids(user)
+    if group_ids is None:
+        return {'group__user': user}
+    if not group_ids:
+        return None
+    return {'group__in': sorted(group_ids)}
+
+
+def perms_sql(model, principal):
+    """
+    Return the SQL and parameters of an expression that evaluates to the
+    effective, bitwise permissions of ``principal`` on each row of ``model``\ .
+
+    For a :class:`User` it is the OR of their own permission and those of all
+    their groups, or their row in the effective permission table when
+    ``OBJECTPERMISSIONS_EFFECTIVE_PERMS`` is set. For models that inherit
+    permissions, the permissions on the ancestors of each row are added.
+    """
+    qn = connection.ops.quote_name
+    ctype = ContentType.objects.get_for_model(model)
+    nbits = len(model.perms)
+    object_col = '%s.%s' % (qn(model._meta.db_table), qn(model._meta.pk.column))
+    user_perm_model, group_perm_model = perm_models(model)
+    group_table = qn(group_perm_model._meta.db_table)
+
+    if isinstance(principal, User) and effective_enabled(model):
+        sql = ('COALESCE((SELECT %(table)s.permission FROM %(table)s WHERE '
+               '%(table)s.user_id = %%s AND %(table)s.content_type_id = %%s AND '
+               '%(table)s.object_id = %(object_col)s), 0)') % {
+            'table': qn(EffectivePermission._meta.db_table),
+            'object_col': object_col,
+        }
+        params = [principal.pk, ctype.pk]
+    elif isinstance(principal, User):
+        user_table = qn(user_perm_model._meta.db_table)
+        sql = ('(SELECT %(user_bits)s FROM %(user_table)s WHERE '
+               '%(user_table)s.content_type_id = %%s AND %(user_table)s.object_id = %(object_col)s '
+               'AND %(user_table)s.user_id = %%s)') % {
+            'user_bits': bit_or_sql('%s.permission' % user_table, nbits),
+            'user_table': user_table,
+            'object_col': object_col,
+        }
+        params = [ctype.pk, principal.pk]
+        group_ids = get_group_ids(principal)
+        if group_ids is None:
+            groups_field = User._meta.get_field('groups')
+            membership_table = qn(groups_field.m2m_db_table())
+            group_sql = ('(SELECT %(group_bits)s FROM %(group_table)s INNER JOIN %(membership_table)s ON '
+                   '%(group_table)s.group_id = %(membership_table)s.%(membership_group)s WHERE '
+                   '%(group_table)s.content_type_id = %%s AND %(group_table)s.object_id = %(object_col)s '
+                   'AND %(membership_table)s.%(membership_user)s = %%s)') % {
+                'group_bits': bit_or_sql('%s.permission' % group_table, nbits),
+                'group_table': group_table,
+                'membership_table': membership_table,
+                'membership_user': qn(groups_field.m2m_column_name()),
+                'membership_group': qn(groups_field.m2m_reverse_name()),
+                'object_col': object_col,
+            }
+            sql = '(%s | %s)' % (sql, group_sql)
+            params = params + [ctype.pk, principal.pk]
+        elif group_ids:
+            group_sql = ('(SELECT %(group_bits)s FROM %(group_table)s WHERE '
+                   '%(group_table)s.content_type_id = %%s AND %(group_table)s.object_id = %(object_col)s '
+                   'AND %(group_in)s)') % {
+                'group_bits': bit_or_sql('%s.permission' % group_table, nbits),
+                'group_table': group_table,
+                'group_in': group_ids_sql('%s.group_id' % group_table, group_ids),
+                'object_col': object_col,
+            }
+            sql = '(%s | %s)' % (sql, group_sql)
+            params = params + [ctype.pk]
+    elif isinstance(principal, Group):
+        sql = ('(SELECT %(group_bits)s FROM %(group_table)s WHERE '
+               '%(group_table)s.content_type_id = %%s AND %(group_table)s.object_id = %(object_col)s '
+               'AND %(group_table)s.group_id = %%s)') % {
+            'group_bits': bit_or_sql('%s.permission' % group_table, nbits),
+            'group_table': group_table,
+            'object_col': object_col,
+        }
+        params = [ctype.pk, principal.pk]
+    else:
+        raise Exception("The principal should be a User or Group object.")
+    if is_hierarchical(model):
+        parts = ancestor_perms_sql(principal, ctype.pk, '= %s' % object_col,
+                                   bit_or_sql('op_perm.permission', nbits))
+        sql = '(%s | %s)' % (sql, ' | '.join(['(%s)' % part for part, part_params in parts]))
+        for part, part_params in parts:
+            params = params + part_params
+    return sql, params
+
+
+def with_perms_for(queryset, principal, name='object_perms'):
+    """
+    Annotate each object of ``queryset`` with the effective, bitwise
+    permissions of ``principal`` as the attribute ``name``\ .
+
+    :param queryset: A ``QuerySet`` of a registered model
+    :param principal: The :class:`User` or :class:`Group` whose permissions to add
+    :param name: The name of the attribute. **Default:** ``object_perms``
+    :type name: ``string``
+    """
+    sql, params = perms_sql(queryset.model, principal)
+    return queryset.extra(select={name: sql}, select_params=params)
+
+
+def filter_perm(queryset, principal, perm, require_all=False):
+    """
+    Limit ``queryset`` to the objects on which ``principal`` has the
+    permission(s) ``perm``\ .
+
+    :param queryset: A ``QuerySet`` of a registered model
+    :param principal: The :class:`User` or :class:`Group` to check
+    :param perm:     Permission(s) to check for in either an integer, a string or a list of strings
+    :type perm:      ``int``, ``string`` or ``list of string``
+    :param require_all: Must ``principal`` have all the permissions? ``True``
+                        if they do. **Default:** ``False``
+    :type require_all:  ``bool``
+    """
+    perms = queryset.model.perms.as_int(perm)
+    if isinstance(principal, User) and effective_enabled(queryset.model):
+        return _filter_effective_perm(queryset, principal, perms, require_all)
+    if stores_rows(queryset.model):
+        return _filter_perm_rows(queryset, principal, perms, require_all)
+    return _filter_perm_ids(queryset, principal, perms, require_all)
+
+
+def _filter_perm_ids(queryset, principal, perms, require_all):
+    """
+    Filter by the ids of the objects with a row of ``principal``\ , or on
+    one of their ancestors, that has any of ``perms``\ , found with the
+    index on the permission tables rather than by testing every object.
+    Having all of several permissions means a row with each of them.
+    """
+    qn = connection.ops.quote_name
+    model = queryset.model
+    ctype = ContentType.objects.get_for_model(model)
+    pk = '%s.%s' % (qn(model._meta.db_table), qn(model._meta.pk.column))
+    if require_all:
+        wanted = model.perms.as_int_list(perms)
+        if not wanted:
+            return queryset.none()
+    else:
+        wanted = [perms]
+    wheres, params = [], []
+    for bits in wanted:
+        condition, condition_params = _perm_condition(model, 'op_perm.permission', bits)
+        parts = own_perms_sql(principal, ctype.pk, None, 'op_perm.object_id', condition, condition_params)
+        if is_hierarchical(model):
+            parts += ancestor_perms_sql(principal, ctype.pk, None, 'op_anc.object_id',
+                                        condition, condition_params)
+        wheres.append('%s IN (%s)' % (pk, ' UNION '.join([part for part, part_params in parts])))
+        for part, part_params in parts:
+            params.extend(part_params)
+    return queryset.extra(where=wheres, params=params)
+
+
+def _filter_effective_perm(queryset, user, perms, require_all):
+    """
+    Filter with the effective permission table, driven by its index on
+    ``(user_id, content_type_id, object_id)``
+    """
+    qn = connection.ops.quote_name
+    model = queryset.model
+    if require_all:
+        condition = 'permission & %s = %s'
+        params = [perms, perms]
+    else:
+        condition = 'permission & %s > 0'
+        params = [perms]
+    where = ('%(pk)s IN (SELECT object_id FROM %(table)s WHERE user_id = %%s AND '
+             'content_type_id = %%s AND %(condition)s)') % {
+        'pk': '%s.%s' % (qn(model._meta.db_table), qn(model._meta.pk.column)),
+        'table': qn(EffectivePermission._meta.db_table),
+        'condition': condition,
+    }
+    params = [user.pk, ContentType.objects.get_for_model(model).pk] + params
+    return queryset.extra(where=[where], params=params)
+
+
+def _filter_perm_rows(queryset, principal, perms, require_all):
+    """
+    Filter a model with the row storage by the ids of the objects with a row
+    for the permissions, found with the index on the permission and principal.
+    All of several permissions means a row for each of them.
+    """
+    qn = connection.ops.quote_name
+    model = queryset.model
+    user_perm_model, group_perm_model = perm_models(model)
+    ctype = ContentType.objects.get_for_model(model)
+    pk = '%s.%s' % (qn(model._meta.db_table), qn(model._meta.pk.column))
+    group_table = qn(group_perm_model._meta.db_table)
+    if isinstance(principal, User):
+        sources = [('SELECT object_id FROM %s WHERE content_type_id = %%s AND user_id = %%s' %
+                    qn(user_perm_model._meta.db_table), [ctype.pk, principal.pk])]
+        group_ids = get_group_ids(principal)
+        if group_ids is None:
+            groups_field = User._meta.get_field('groups')
+            sources.append(('SELECT op_perm.object_id FROM %s op_perm INNER JOIN %s op_member ON '
+                'op_perm.group_id = op_member.%s WHERE op_perm.content_type_id = %%s AND '
+                'op_member.%s = %%s' % (group_table, qn(groups_field.m2m_db_table()),
+                                        qn(groups_field.m2m_reverse_name()), qn(groups_field.m2m_column_name())),
+                [ctype.pk, principal.pk]))
+        elif group_ids:
+            sources.append(('SELECT object_id FROM %s WHERE content_type_id = %%s AND %s' % (
+                group_table, group_ids_sql('group_id', group_ids)), [ctype.pk]))
+    elif isinstance(principal, Group):
+        sources = [('SELECT object_id FROM %s WHERE content_type_id = %%s AND group_id = %%s' % group_table,
+                    [ctype.pk, principal.pk])]
+    else:
+        raise Exception("The principal should be a User or Group object.")
+    
+    bits = model.perms.as_int_list(perms)
+    if require_all:
+        wanted = [[bit] for bit in bits]
+    else:
+        wanted = [bits]
+    wheres, params = [], []
+    for group in wanted:
+        if not group:
+            return queryset.none()
+        condition = ' AND permission IN (%s)' % ', '.join(['%d' % bit for bit in group])
+        sql = ' UNION '.join([source + condition for source, source_params in sources])
+        wheres.append('%s IN (%s)' % (pk, sql))
+        for source, source_params in sources:
+            params.extend(source_params)
+    return queryset.extra(where=wheres, params=params)
+
+
+def _perm_sources(model, principal):
+    """
+    The querysets of permission rows that make up the permissions of
+    ``principal`` on the objects of ``model``
+    """
+    ctype = ContentType.objects.get_for_model(model)
+    user_perm_model, group_perm_model = perm_models(model)
+    if isinstance(principal, User) and effective_enabled(model):
+        return [EffectivePermission.objects.filter(content_type=ctype, user=principal)]
+    elif isinstance(principal, User):
+        sources = [user_perm_model.objects.filter(content_type=ctype, user=principal)]
+        lookup = group_lookup(principal)
+        if lookup is not None:
+            sources.append(group_perm_model.objects.filter(content_type=ctype, **lookup))
+        return sources
+    elif isinstance(principal, Group):
+        return [group_perm_model.objects.filter(content_type=ctype, group=principal)]
+    raise Exception("The principal should be a User or Group object.")
+
+
+def iter_perm(queryset, principal, perm, require_all=False, chunk_size=1000):
+    """
+    Yield the objects of ``queryset`` on which ``principal`` has the
+    permission(s) ``perm``\ , in order of primary key, a chunk at a time.
+    
+    Each chunk starts from the permission rows after the last object of the
+    previous one, using the index on the permission tables, so memory stays
+    bounded and the first objects arrive quickly, however large the table
+    and however few of its rows ``principal`` can see. A chunk takes one
+    query for the object ids, one for their permissions (per permission
+    table) and one for the objects. The primary keys must be integers.
+    
+    The objects of a model that inherits permissions are instead filtered
+    with :func:`filter_perm` a chunk at a time.
+    
+    :param queryset: A ``QuerySet`` of a registered model
+    :param principal: The :class:`User` or :class:`Group` to check
+    :param perm:     Permission(s) to check for in either an integer, a string or a list of strings
+    :type perm:      ``int``, ``string`` or ``list of string``
+    :param require_all: Must ``principal`` have all the permissions? **Default:** ``False``
+    :type require_all:  ``bool``
+    :param chunk_size: The most objects fetched at a time. **Default:** ``1000``
+    :type chunk_size: ``int``
+    """
+    if is_hierarchical(queryset.model):
+        # The permissions can come from any ancestor, so go through the
+        # objects themselves
+        queryset = filter_perm(queryset, principal, perm, require_all).order_by('pk')
+        last = None
+        while True:
+            if last is None:
+                chunk = list(queryset[:chunk_size])
+            else:
+                chunk = list(queryset.filter(pk__gt=last)[:chunk_size])
+            for obj in chunk:
+                yield obj
+            if len(chunk) < chunk_size:
+                return
+            last = chunk[-1].pk
+    perms = queryset.model.perms.as_int(perm)
+    sources = _perm_sources(queryset.model, principal)
+    last = None
+    while True:
+        # The next object ids with any permission row. Only those up to the
+        # last id of a full chunk are known to be complete.
+        object_ids, boundary = set(), None
+        for rows in sources:
+            if last is not None:
+                rows = rows.filter(object_id__gt=last)
+            ids = list(rows.order_by('object_id').values_list('object_id', flat=True
+                ).distinct()[:chunk_size])
+            object_ids.update(ids)
+            if len(ids) == chunk_size and (boundary is None or ids[-1] < boundary):
+                boundary = ids[-1]
+        if boundary is not None:
+            object_ids = [object_id for object_id in object_ids if object_id <= boundary]
+        if not object_ids:
+            return
+        
+        bits = {}
+        for rows in sources:
+            for object_id, permission in rows.filter(object_id__in=list(object_ids)
+                    ).values_list('object_id', 'permission'):
+                bits[object_id] = bits.get(object_id, 0) | (permission or 0)
+        if require_all:
+            matching = [key for key, value in bits.items() if value & perms == perms]
+        else:
+            matching = [key for key, value in bits.items() if value & perms]
+        if matching:
+            for obj in queryset.filter(pk__in=matching).order_by('pk'):
+                yield obj
+        if boundary is None:
+            return
+        last = boundary
+
+
+def _perm_condition(model, column, perms, require_all=False, rows=False):
+    """
+    Return the SQL and parameters that test ``column`` for the permission(s)
+    ``perms``\ : a list of the values that qualify where the model is small
+    enough, so the index on the column can be used, else a bitwise test.
+    With ``rows``\ , ``column`` holds a single permission.
+    """
+    if rows:
+        masks = model.perms.as_int_list(perms)
+        if require_all and len(masks) > 1:
+            raise Exception("A single row can't have several permissions.")
+        if not masks:
+            return '1 = 0', []
+        # The masks are integers we generated, so they are inlined
+        return '%s IN (%s)' % (column, ', '.join(['%d' % mask for mask in masks])), []
+    condition = model.perms.masks_sql(column, perms, require_all)
+    if condition is not None:
+        return condition, []
+    if require_all:
+        return '%s & %%s = %%s' % column, [perms, perms]
+    return '%s & %%s > 0' % column, [perms]
+
+
+def _holders_sql(instance, condition, params):
+    """
+    Return the SQL and parameters of a ``SELECT`` of the ids of the users
+    with a row on ``instance``\ , directly or through a group, that matches
+    ``condition`` on ``op_perm.permission``\ . For models that inherit
+    permissions, rows on the ancestors of ``instance`` count too.
+    """
+    qn = connection.ops.quote_name
+    groups_field = User._meta.get_field('groups')
+    ctype = ContentType.objects.get_for_model(instance)
+    user_perm_model, group_perm_model = perm_models(instance.__class__)
+    sources = [
+        ('op_perm.user_id', qn(user_perm_model._meta.db_table), ''),
+        ('op_member.%s' % qn(groups_field.m2m_column_name()), qn(group_perm_model._meta.db_table),
+         ' INNER JOIN %s op_member ON op_perm.group_id = op_member.%s' % (
+            qn(groups_field.m2m_db_table()), qn(groups_field.m2m_reverse_name()))),
+    ]
+    parts, all_params = [], []
+    for user_col, table, join in sources:
+        parts.append('SELECT %s FROM %s op_perm%s WHERE op_perm.content_type_id = %%s '
+                     'AND op_perm.object_id = %%s AND %s' % (user_col, table, join, condition))
+        all_params.extend([ctype.pk, instance.pk] + params)
+        if is_hierarchical(instance.__class__):
+            parts.append('SELECT %s FROM %s op_anc INNER JOIN %s op_perm ON '
+                         'op_perm.content_type_id = op_anc.ancestor_type_id AND '
+                         'op_perm.object_id = op_anc.ancestor_id%s WHERE '
+                         'op_anc.content_type_id = %%s AND op_anc.object_id = %%s AND %s' % (
+                user_col, qn(PermissionAncestor._meta.db_table), table, join, condition))
+            all_params.extend([ctype.pk, instance.pk] + params)
+    return ' UNION '.join(parts), all_params
+
+
+def users_with_perm(instance, perm, require_all=False):
+    """
+    Return a ``QuerySet`` of the active users who have the permission(s)
+    ``perm`` on ``instance``\ , whether it was granted to them, to one of
+    their groups or, for models that inherit permissions, on an ancestor.
+    Superusers are only included if they were granted it.
+
+    It is one query. Rows are matched by listing every permission value that
+    qualifies (see :meth:`ModelPermissions.masks`), so the index on the
+    permission tables is used instead of a bitwise test on each row.
+
+    :param instance: An object of a registered model
+    :param perm:     Permission(s) to check for in either an integer, a string or a list of strings
+    :type perm:      ``int``, ``string`` or ``list of string``
+    :param require_all: Must the users have all the permissions? **Default:** ``False``
+    :type require_all:  ``bool``
+    """
+    model = instance.__class__
+    perms = model.perms.as_int(perm)
+    users = User.objects.filter(is_active=True)
+    qn = connection.ops.quote_name
+    user_pk = '%s.%s' % (qn(User._meta.db_table), qn(User._meta.pk.column))
+
+    if effective_enabled(model):
+        # The rows already combine the user's groups
+        condition, params = _perm_condition(model, 'permission', perms, require_all)
+        where = ('%s IN (SELECT user_id FROM %s WHERE content_type_id = %%s AND '
+                 'object_id = %%s AND %s)') % (user_pk, qn(EffectivePermission._meta.db_table), condition)
+        params = [ContentType.objects.get_for_model(model).pk, instance.pk] + params
+        return users.extra(where=[where], params=params)
+
+    # A user has all of several permissions if each of them is on one of
+    # their rows, not necessarily the same one
+    if require_all:
+        wanted = model.perms.as_int_list(perms)
+    else:
+        wanted = [perms]
+    wheres, params = [], []
+    for bits in wanted:
+        condition, condition_params = _perm_condition(model, 'op_perm.permission', bits,
+                                                      rows=stores_rows(model))
+        sql, sql_params = _holders_sql(instance, condition, condition_params)
+        wheres.append('%s IN (%s)' % (user_pk, sql))
+        params.extend(sql_params)
+    return users.extra(where=wheres, params=params)
+
+
+class ObjectPermissionQuerySet(QuerySet):
+    """
+    A ``QuerySet`` with :func:`with_perms_for`\ , :func:`filter_perm` and
+    :func:`iter_perm` as methods
+    """
+    def with_perms_for(self, principal, name='object_perms'):
+        return with_perms_for(self, principal, name)
+
+    def filter_perm(self, principal, perm, require_all=False):
+        return filter_perm(self, principal, perm, require_all)
+    
+    def iter_perm(self, principal, perm, require_all=False, chunk_size=1000):
+        return iter_perm(self, principal, perm, require_all, chunk_size)
+
+
+class ObjectPermissionManager(models.Manager):
+    """
+    A manager for registered models that you write yourself::
+
+        class Document(models.Model):
+            ...
+            objects = ObjectPermissionManager()
+
+        Document.objects.filter_perm(request.user, 'read').with_perms_for(request.user)
+    """
+    def get_query_set(self):
+        return ObjectPermissionQuerySet(self.model)
+
+    def with_perms_for(self, principal, name='object_perms'):
+        return self.get_query_set().with_perms_for(principal, name)
+
+    def filter_perm(self, principal, perm, require_all=False):
+        return self.get_query_set().filter_perm(principal, perm, require_all)
+    
+    def iter_perm(self, principal, perm, require_all=False, chunk_size=1000):
+        return self.get_query_set().iter_perm(principal, perm, require_all, chunk_size)
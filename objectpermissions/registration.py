@@ -1,8 +1,26 @@
-from django.db.models import FieldDoesNotExist, Q
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F, FieldDoesNotExist
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User, Group
-
-from models import UserPermission, GroupPermission, ModelPermissions, UserPermissionRelation, GroupPermissionRelation
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from models import (Permission, UserPermission, GroupPermission, ModelPermissions, UserPermissionRelation,
+                    GroupPermissionRelation, STORAGES, perm_models, stores_rows)
+from cache import (cache_key, get_request_cache, get_shared_perm, set_shared_perm,
+                   get_prefetched_perm, set_prefetched_perm, clear_prefetched_perms)
+from query import filter_perm, iter_perm, group_lookup
+from effective import enabled as effective_enabled, get_effective_perm, get_effective_perms
+from hierarchy import register_parent, is_hierarchical, descendant_models, perm_rows, query_perm_bits
+from defaults import register_defaults
+from cleanup import register_cleanup
+from utils import chunks, bulk_create, bulk_changed
+from instrumentation import instrumented, instrumented_queryset, record_cache
+from signals import (permission_changed, permissions_changed_in_bulk, send, batching, has_receivers,
+                     permission_signal_batch)
+import settings as app_settings
 
 class AlreadyRegistered(Exception):
     """
@@ -13,31 +31,298 @@ class AlreadyRegistered(Exception):
 #: Contains all the models that we've registered. A ``list`` of ``Model``\ s
 registry = []
 
-def register(model, permissions):
+def register(model, permissions, parent=None, default_perms=None, storage='bitmask'):
     """
     Register a model and permission set. It adds several functions to the model:
-    """
+    
+    ``storage`` chooses how the permissions are kept. ``'bitmask'``\ , the
+    default, keeps one :class:`UserPermission` or :class:`GroupPermission`
+    per user or group and object, with all the permissions in one integer.
+    ``'rows'`` keeps one :class:`UserPermissionRow` or
+    :class:`GroupPermissionRow` per permission instead, so finding who has a
+    permission, or where, uses an index rather than a bitwise test on every
+    row. Everything else works the same with either. Models that inherit
+    permissions, and their parents, must use ``'bitmask'``\ .
+    
+    With ``parent``\ , the name of a ``ForeignKey`` to another registered model
+    or to ``model`` itself, the objects also have every permission granted on
+    their parent and its ancestors. See :mod:`objectpermissions.hierarchy`\ .
+    
+    With ``default_perms``\ , a list of ``(principal, perm)`` rules, new
+    objects are granted each ``perm`` for the user or group the rule names.
+    See :mod:`objectpermissions.defaults`\ .
+    
+    The permissions on an object are deleted with it. See
+    :mod:`objectpermissions.cleanup`\ .
+    """
+    if storage not in STORAGES:
+        raise Exception("'%s' is not a permission storage. Use one of: %s." % (
+            storage, ', '.join(sorted(STORAGES.keys()))))
     if model in registry:
         #raise AlreadyRegistered('The model %s has already been registered.' % model.__name__)
         return
+    if storage != 'bitmask' and (parent or descendant_models(model)):
+        raise Exception("%s inherits or passes on permissions, so it must use the bitmask storage." % 
+                        model.__name__)
     registry.append(model)
     
+    user_perm_model, group_perm_model = STORAGES[storage]
     opts = model._meta
     try:
         opts.get_field('user_perms_set')
     except FieldDoesNotExist:
-        UserPermissionRelation().contribute_to_class(model, 'user_perms_set')
+        UserPermissionRelation(user_perm_model).contribute_to_class(model, 'user_perms_set')
     
     try:
         opts.get_field('group_perms_set')
     except FieldDoesNotExist:
-        GroupPermissionRelation().contribute_to_class(model, 'group_perms_set')
+        GroupPermissionRelation(group_perm_model).contribute_to_class(model, 'group_perms_set')
     
     setattr(model, 'perms', ModelPermissions(permissions))
+    register_cleanup(model)
+    if parent:
+        register_parent(model, parent)
+    if default_perms:
+        register_defaults(model, default_perms)
+
+
+def _reduce_perms(perms):
+    """
+    OR together an iterable of permission values, ignoring empty ones.
+    """
+    result = 0
+    for perm in perms:
+        if perm:
+            result |= perm
+    return result
+
+
+def _perm_matches(bits, perms, require_all=False):
+    """
+    Does the bitwise permission ``bits`` satisfy ``perms``? It must contain 
+    *all* of ``perms`` if ``require_all`` is ``True``, otherwise *any* of them.
+    """
+    if require_all:
+        return bits & perms == perms
+    return bits & perms > 0
+
+
+def _get_user_perm_bits(user, instance):
+    """
+    Resolve the effective permissions of ``user`` for ``instance``: the OR of
+    the user's own permission and those of every group the user belongs to.
+    
+    This takes two queries no matter how many groups the user is in, or one
+    with ``OBJECTPERMISSIONS_EFFECTIVE_PERMS`` set or when the user is known
+    to be in no group (see :func:`get_group_ids`).
+    Permissions loaded by :func:`user_prefetch_object_perms` are used first. If
+    the user has a request cache (see :mod:`objectpermissions.middleware`), the
+    result is kept there and reused. With ``OBJECTPERMISSIONS_CACHE`` set, it
+    is also kept in Django's cache and shared with other processes.
+    """
+    bits = get_prefetched_perm(instance, user)
+    if bits is not None:
+        record_cache(instance, user, True)
+        return bits
+    if batching():
+        # The caches aren't invalidated until the batch's signals are sent
+        return _query_user_perm_bits(user, instance)
+    cache = get_request_cache(user)
+    if cache is None and not app_settings.CACHE_ENABLED:
+        return _query_user_perm_bits(user, instance)
+    key = cache_key(instance)
+    if cache is not None and key in cache:
+        record_cache(instance, user, True)
+        return cache[key]
+    
+    if app_settings.CACHE_ENABLED:
+        bits = get_shared_perm(key, user)
+        record_cache(instance, user, bits is not None)
+        if bits is None:
+            bits = _query_user_perm_bits(user, instance)
+            set_shared_perm(key, user, bits)
+    else:
+        record_cache(instance, user, False)
+        bits = _query_user_perm_bits(user, instance)
+    if cache is not None:
+        cache[key] = bits
+    return bits
+
+
+def _get_group_perm_bits(group, instance):
+    """
+    Resolve the permissions of ``group`` for ``instance``\ , using the shared
+    cache when ``OBJECTPERMISSIONS_CACHE`` is set.
+    """
+    bits = get_prefetched_perm(instance, group)
+    if bits is not None:
+        record_cache(instance, group, True)
+        return bits
+    if not app_settings.CACHE_ENABLED or batching():
+        return _query_group_perm_bits(group, instance)
+    key = cache_key(instance)
+    bits = get_shared_perm(key, group)
+    record_cache(instance, group, bits is not None)
+    if bits is None:
+        bits = _query_group_perm_bits(group, instance)
+        set_shared_perm(key, group, bits)
+    return bits
+
+
+def _query_group_perm_bits(group, instance):
+    """
+    Query the database for the permissions of ``group`` for ``instance``
+    """
+    if is_hierarchical(instance.__class__):
+        return query_perm_bits(group, instance)
+    group_perms = instance.group_perms_set.filter(group=group).values_list('permission', flat=True)
+    return _reduce_perms(group_perms)
+
+
+def _query_user_perm_bits(user, instance):
+    """
+    Query the database for the effective permissions of ``user`` for ``instance``
+    """
+    if is_hierarchical(instance.__class__):
+        return query_perm_bits(user, instance)
+    if effective_enabled(instance.__class__):
+        return get_effective_perm(user, instance)
+    user_perms = instance.user_perms_set.filter(user=user).values_list('permission', flat=True)
+    lookup = group_lookup(user)
+    if lookup is None:
+        return _reduce_perms(user_perms)
+    group_perms = instance.group_perms_set.filter(**lookup).values_list('permission', flat=True)
+    return _reduce_perms(user_perms) | _reduce_perms(group_perms)
+
+
+def _group_by_model(objects):
+    """
+    Split ``objects`` into a dictionary of ``model: {pk: instance}``
+    """
+    by_model = {}
+    for obj in objects:
+        by_model.setdefault(obj.__class__, {})[obj.pk] = obj
+    return by_model
+
+
+def _perms_set(principal, instance):
+    """
+    Return the manager of the permissions on ``instance`` for the kind of
+    ``principal`` and the lookup that selects the row of ``principal``
+    """
+    if isinstance(principal, User):
+        return instance.user_perms_set, {'user': principal}
+    elif isinstance(principal, Group):
+        return instance.group_perms_set, {'group': principal}
+    else:
+        raise Exception("This method should only be attached to a User or Group object.")
+
+
+def _bitor(expression, value):
+    if hasattr(expression, 'bitor'):
+        return expression.bitor(value)
+    return expression | value
+
+
+def _bitand(expression, value):
+    if hasattr(expression, 'bitand'):
+        return expression.bitand(value)
+    return expression & value
+
+
+def _changed_perm(perms_set, lookup, instance):
+    """
+    Fetch the permission row that was just updated, with its ``content_object``
+    set to ``instance`` and its user or group set to the one in ``lookup``\ ,
+    so sending ``permission_changed`` doesn't query for them.
+    """
+    the_permission = perms_set.get(**lookup)
+    the_permission.content_object = instance
+    for name, principal in lookup.items():
+        setattr(the_permission, name, principal)
+    return the_permission
+
+
+def _send_changed(perms_set, lookup, instance):
+    """
+    Send ``permission_changed`` for the row in ``lookup`` after it was
+    updated. The row is only fetched if someone listens; if it is gone, it is
+    reported with no permission.
+    """
+    if not has_receivers(permission_changed):
+        return
+    try:
+        the_permission = _changed_perm(perms_set, lookup, instance)
+    except perms_set.model.DoesNotExist:
+        the_permission = perms_set.model(content_type=ContentType.objects.get_for_model(instance),
+                                         object_id=instance.pk, permission=0, **lookup)
+        the_permission.content_object = instance
+    the_permission.send_changed()
+
+
+def _update_or_create_perm(principal, instance, value, initial):
+    """
+    Set the permission of ``principal`` on ``instance`` to ``value`` with a
+    single ``UPDATE``\ , so concurrent changes can't overwrite each other.
+    ``value`` can be an expression on the current value, such as
+    ``F('permission') | 4``\ . If there is no row yet, one is created with
+    the permission ``initial``\ .
+    """
+    perms_set, lookup = _perms_set(principal, instance)
+    if not perms_set.filter(**lookup).update(permission=value):
+        sid = transaction.savepoint()
+        try:
+            perms_set.create(permission=initial, **lookup)
+            transaction.savepoint_commit(sid)
+            return
+        except IntegrityError:
+            # Someone else created it first
+            transaction.savepoint_rollback(sid)
+            perms_set.filter(**lookup).update(permission=value)
+    _send_changed(perms_set, lookup, instance)
+
+
+def _change_perm_rows(principal, instance, grant=0, revoke=0):
+    """
+    For models with the row storage: add the rows of the permissions in
+    ``grant`` that ``principal`` doesn't have on ``instance`` yet and delete
+    the rows of the permissions in ``revoke``\ . ``permission_changed`` is
+    sent once, with the permissions left, if anything changed.
+    """
+    perms_set, lookup = _perms_set(principal, instance)
+    held = set(perms_set.filter(**lookup).values_list('permission', flat=True))
+    removed = [bit for bit in held if bit & revoke]
+    if removed:
+        perms_set.filter(permission__in=removed, **lookup).delete()
+    
+    ctype = ContentType.objects.get_for_model(instance)
+    perm_model = perms_set.model
+    added = [perm_model(content_type=ctype, object_id=instance.pk, permission=bit, **lookup)
+             for bit in instance.perms.as_int_list(grant) if bit not in held]
+    sid = transaction.savepoint()
+    try:
+        bulk_create(perm_model, added)
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        # Someone else granted some of them first
+        transaction.savepoint_rollback(sid)
+        for row in added:
+            sid = transaction.savepoint()
+            try:
+                bulk_create(perm_model, [row])
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+    
+    if removed or added:
+        changed = perm_model(content_type=ctype, object_id=instance.pk, **lookup)
+        changed.content_object = instance
+        changed.send_changed()
 
 
 # The following functions are added to the User/Group objects
 
+@instrumented('grant_object_perm')
 def grant_object_perm(self, instance, perm):
     """
     Grants permission ``perm`` to object ``instance`` for the :class:`User` or 
@@ -53,24 +338,15 @@ def grant_object_perm(self, instance, perm):
     :param perm: The permission(s) to grant
     :type perm: ``integer``, ``string``, ``list of string``
     """
+    clear_prefetched_perms(instance)
     addl_perm = instance.perms.as_int(perm)
-    query_args = {}
-    if isinstance(self, User):
-        try:
-            the_permission = instance.user_perms_set.get(user=self)
-        except UserPermission.DoesNotExist:
-            the_permission = instance.user_perms_set.create(user=self)
-    elif isinstance(self, Group):
-        try:
-            the_permission = instance.group_perms_set.get(group=self)
-        except GroupPermission.DoesNotExist:
-            the_permission = instance.group_perms_set.create(group=self)
-    else:
-        raise Exception("This method should only be attached to a User or Group object.")
-    the_permission.permission |= addl_perm
-    the_permission.save()
+    if stores_rows(instance.__class__):
+        _change_perm_rows(self, instance, grant=addl_perm)
+        return
+    _update_or_create_perm(self, instance, _bitor(F('permission'), addl_perm), addl_perm)
 
 
+@instrumented('revoke_object_perm')
 def revoke_object_perm(self, instance, perm):
     """
     Remove the permission ``perm`` to object ``instance`` for the :class:`User` or 
@@ -81,23 +357,22 @@ def revoke_object_perm(self, instance, perm):
     :param perm: The name of the permission to revoke
     :type perm: ``integer``, ``string``, ``list of string``
     """
+    clear_prefetched_perms(instance)
     remove_perm = instance.perms.as_int(perm)
-    
-    try:
-        if isinstance(self, User):
-            the_permission = instance.user_perms_set.get(user=self)
-        elif isinstance(self, Group):
-            the_permission = instance.group_perms_set.get(group=self)
-    except (UserPermission.DoesNotExist, GroupPermission.DoesNotExist):
+    if stores_rows(instance.__class__):
+        _change_perm_rows(self, instance, revoke=remove_perm)
+        return
+    perms_set, lookup = _perms_set(self, instance)
+    rows = perms_set.filter(**lookup)
+    if not rows.update(permission=_bitand(F('permission'), ~remove_perm)):
         # Can't revoke what they don't have
         return 
-    the_permission.permission ^= remove_perm
-    if the_permission.permission == 0:
-        the_permission.delete()
-    else:
-        the_permission.save()
+    # Only while it is still empty, so a grant committed since isn't lost
+    rows.filter(permission=0).delete()
+    _send_changed(perms_set, lookup, instance)
 
 
+@instrumented('revoke_all_object_perm')
 def revoke_all_object_perm(self, instance):
     """
     Remove all the permissions for this :class:`User` or :class:`Group`\ .
@@ -105,16 +380,22 @@ def revoke_all_object_perm(self, instance):
     :param instance: A Django :class:`Model` instance
     :type instance: :class:`Model`
     """
+    clear_prefetched_perms(instance)
+    if stores_rows(instance.__class__):
+        _change_perm_rows(self, instance, revoke=~0)
+        return
+    perms_set, lookup = _perms_set(self, instance)
     try:
-        if isinstance(self, User):
-            instance.user_perms_set.get(user=self).delete()
-        elif isinstance(self, Group):
-            instance.group_perms_set.get(group=self).delete()
+        the_permission = perms_set.get(**lookup)
     except (UserPermission.DoesNotExist, GroupPermission.DoesNotExist):
         # Can't revoke what they don't have
         return 
+    # Receivers of permission_changed should see what is left: nothing
+    the_permission.permission = 0
+    the_permission.delete()
     
 
+@instrumented('set_object_perm')
 def set_object_perm(self, instance, perm):
     """
     Sets the permission to the ``perm`` value. Same as revoking all privileges
@@ -125,23 +406,120 @@ def set_object_perm(self, instance, perm):
     :param perm:  The permission(s) that should be set.
     :type perm:   ``int``, ``string`` or ``list of string``
     """
+    clear_prefetched_perms(instance)
     perms = instance.perms.as_int(perm)
-    if isinstance(self, User):
-        try:
-            the_permission = instance.user_perms_set.get(user=self)
-        except UserPermission.DoesNotExist:
-            the_permission = instance.user_perms_set.create(user=self)
-    elif isinstance(self, Group):
-        try:
-            the_permission = instance.group_perms_set.get(group=self)
-        except GroupPermission.DoesNotExist:
-            the_permission = instance.group_perms_set.create(group=self)
-    else:
-        raise Exception("This method should only be attached to a User or Group object.")
-    the_permission.permission = perms
-    the_permission.save()
+    if stores_rows(instance.__class__):
+        _change_perm_rows(self, instance, grant=perms, revoke=~perms)
+        return
+    _update_or_create_perm(self, instance, perms, perms)
+
+
+def _split_principals(principals):
+    """
+    Split ``principals`` into a list of :class:`User`\ s and a list of :class:`Group`\ s
+    """
+    users, groups = [], []
+    for principal in principals:
+        if isinstance(principal, User):
+            users.append(principal)
+        elif isinstance(principal, Group):
+            groups.append(principal)
+        else:
+            raise Exception("Permissions can only be granted to a User or Group object.")
+    return users, groups
+
+
+def _bulk_perm_querysets(principals, instances, perm):
+    """
+    Yield a ``QuerySet`` of the existing permission rows, the permission model,
+    the name of the principal field, the content type, the ``object_id``\ s and
+    principal ids that the rows can cover, and the permission as an integer, in
+    chunks small enough for any database.
+    """
+    users, groups = _split_principals(principals)
+    for model, objects in _group_by_model(instances).items():
+        perms = model.perms.as_int(perm)
+        ctype = ContentType.objects.get_for_model(model)
+        for perm_model, field, members in zip(perm_models(model), ('user', 'group'), (users, groups)):
+            for principal_ids in chunks([p.pk for p in members]):
+                for object_ids in chunks(objects.keys()):
+                    rows = perm_model.objects.filter(content_type=ctype, object_id__in=object_ids,
+                        **{'%s__in' % field: principal_ids})
+                    yield rows, perm_model, field, ctype, object_ids, principal_ids, perms
+
+
+def bulk_grant(principals, instances, perm):
+    """
+    Grant the permission(s) ``perm`` to each of the :class:`User`\ s and
+    :class:`Group`\ s ``principals`` on each of ``instances``\ .
+    
+    Existing rows are updated with one ``UPDATE`` and missing rows inserted
+    together, a chunk of objects and principals at a time, in one transaction.
+    A single ``permissions_changed_in_bulk`` signal is sent after the commit
+    instead of a ``permission_changed`` signal per row.
+    
+    :param principals: The users and groups to grant the permission(s) to
+    :type principals: ``list`` of :class:`User` and :class:`Group` objects
+    :param instances: The objects on which to grant the permission(s)
+    :type instances: ``QuerySet`` or ``list`` of :class:`Model` instances
+    :param perm: The permission(s) to grant
+    :type perm: ``integer``, ``string``, ``list of string``
+    """
+    principals, instances = list(principals), list(instances)
+    for rows, perm_model, field, ctype, object_ids, principal_ids, perms in \
+            _bulk_perm_querysets(principals, instances, perm):
+        if perm_model._bit_rows:
+            bits = Permission.int_to_perms(perms)
+            existing = set(rows.filter(permission__in=bits).values_list('object_id', field, 'permission'))
+            bulk_create(perm_model, [
+                perm_model(content_type=ctype, object_id=object_id, permission=bit, 
+                           **{'%s_id' % field: principal_id})
+                for object_id in object_ids for principal_id in principal_ids for bit in bits
+                if (object_id, principal_id, bit) not in existing])
+            continue
+        rows.update(permission=_bitor(F('permission'), perms))
+        existing = set(rows.values_list('object_id', field))
+        bulk_create(perm_model, [
+            perm_model(content_type=ctype, object_id=object_id, permission=perms, 
+                       **{'%s_id' % field: principal_id})
+            for object_id in object_ids for principal_id in principal_ids
+            if (object_id, principal_id) not in existing])
+    bulk_changed(principals, instances, 'grant')
+# The signal is sent after the commit, so the cache versions it moves to
+# never hold the old rows
+bulk_grant = permission_signal_batch(commit=True)(bulk_grant)
+
+
+def bulk_revoke(principals, instances, perm):
+    """
+    Revoke the permission(s) ``perm`` from each of the :class:`User`\ s and
+    :class:`Group`\ s ``principals`` on each of ``instances``\ .
+    
+    Rows are updated with one ``UPDATE`` and the ones left without any
+    permission deleted, a chunk of objects and principals at a time, in one
+    transaction. A single ``permissions_changed_in_bulk`` signal is sent
+    after the commit.
+    
+    :param principals: The users and groups to revoke the permission(s) from
+    :type principals: ``list`` of :class:`User` and :class:`Group` objects
+    :param instances: The objects on which to revoke the permission(s)
+    :type instances: ``QuerySet`` or ``list`` of :class:`Model` instances
+    :param perm: The permission(s) to revoke
+    :type perm: ``integer``, ``string``, ``list of string``
+    """
+    principals, instances = list(principals), list(instances)
+    for rows, perm_model, field, ctype, object_ids, principal_ids, perms in \
+            _bulk_perm_querysets(principals, instances, perm):
+        if perm_model._bit_rows:
+            rows.filter(permission__in=Permission.int_to_perms(perms)).delete()
+            continue
+        rows.update(permission=_bitand(F('permission'), ~perms))
+        rows.filter(permission=0).delete()
+    bulk_changed(principals, instances, 'revoke')
+bulk_revoke = permission_signal_batch(commit=True)(bulk_revoke)
 
 
+@instrumented('has_object_perm')
 def user_has_object_perm(self, instance, perm, require_all=False):
     """
     Basic testing of user permissions. Permissions can be passed as an int, using the 
@@ -180,27 +558,13 @@ def user_has_object_perm(self, instance, perm, require_all=False):
         return False
     
     perms = instance.perms.as_int(perm)
-    
-    try:
-        user_perm = instance.user_perms_set.get(user=self)
-        if require_all:
-            if user_perm.permission & perms == perms:
-                return True
-        else:
-            if user_perm.permission & perms > 0:
-                return True
-    except UserPermission.DoesNotExist:
-        pass # either the group check will return true, or it returns false at the end
-    
-    for group in self.groups.all():
-        if group.has_object_perm(instance, perms, require_all):
-            return True
-    return False
+    return _perm_matches(_get_user_perm_bits(self, instance), perms, require_all)
 
 
 def user_has_all_object_perm(self, instance, perm):
     return self.has_object_perm(instance, perm, True)
 
+@instrumented('get_object_perm')
 def user_get_object_permissions(self, instance, format='int'):
     """
     Get the user's permissions for this object, formatted in a specific way.
@@ -220,25 +584,12 @@ def user_get_object_permissions(self, instance, format='int'):
     :param format: 'int', 'string_list', 'int_list', 'choices'. **Default:** 'int'
     :type format: ``string``
     """
-    try:
-        user_perm = instance.user_perms_set.get(user=self)
-        group_ids = self.groups.all().values_list('id', flat=True)
-        group_perms = instance.group_perms_set.filter(group__id__in=group_ids).values_list('permission', flat=True)
-        if group_perms:
-            gperm = reduce(lambda x,y: x|y,group_perms)
-        else:
-            gperm = 0
-        formatter = getattr(instance.perms, "as_%s" % format, False)
-        if formatter:
-            return formatter(user_perm.permission|gperm)
-        else:
-            return user_perm.permission|gperm
-
-    except UserPermission.DoesNotExist:
-        if format == 'int':
-            return 0
-        else:
-            return []
+    perm = _get_user_perm_bits(self, instance)
+    formatter = getattr(instance.perms, "as_%s" % format, False)
+    if formatter:
+        return formatter(perm)
+    else:
+        return perm
 
 
 def user_get_object_permissions_as_string_list(self, instance):
@@ -262,38 +613,144 @@ def user_get_object_permissions_as_choices(self, instance):
     return self.get_object_perm(instance, 'choices')
 
 
+def _object_perm_rows(principal, model, object_ids):
+    """
+    Return the ``(object_id, permission)`` rows that make up the permissions
+    of ``principal`` on the objects of ``model`` with ids ``object_ids``\ ,
+    in one query for each table they come from. An object can have several
+    rows, to be ORed together, or none.
+    """
+    object_ids = list(object_ids)
+    if is_hierarchical(model):
+        return perm_rows(principal, model, object_ids)
+    user_perm_model, group_perm_model = perm_models(model)
+    ctype = ContentType.objects.get_for_model(model)
+    if isinstance(principal, Group):
+        return list(group_perm_model.objects.filter(content_type=ctype,
+            object_id__in=object_ids, group=principal).values_list('object_id', 'permission'))
+    if effective_enabled(model):
+        return get_effective_perms(principal, model, object_ids).items()
+    rows = list(user_perm_model.objects.filter(content_type=ctype, 
+        object_id__in=object_ids, user=principal).values_list('object_id', 'permission'))
+    lookup = group_lookup(principal)
+    if lookup is not None:
+        rows += list(group_perm_model.objects.filter(content_type=ctype,
+            object_id__in=object_ids, **lookup).values_list('object_id', 'permission'))
+    return rows
+
+
+def user_prefetch_object_perms(self, objects):
+    """
+    Load the user's permissions for all of ``objects`` at once and keep them on
+    each object, so later calls to :func:`user_has_object_perm` or
+    :func:`user_get_object_permissions` for them don't hit the database.
+    
+    It takes two queries per model: one for the user's own permissions and one
+    for the permissions of all the user's groups, or just one with
+    ``OBJECTPERMISSIONS_EFFECTIVE_PERMS`` set or for models that inherit
+    permissions. Granting or revoking a
+    permission on an object through this user or group forgets what was
+    prefetched for that object.
+    
+    :param objects: The objects to load permissions for
+    :type objects: ``QuerySet`` or ``list`` of :class:`Model` instances
+    :result: ``objects`` as a ``list``
+    """
+    objects = list(objects)
+    for model, instances in _group_by_model(objects).items():
+        bits = dict.fromkeys(instances.keys(), 0)
+        for object_id, perm in _object_perm_rows(self, model, instances.keys()):
+            if perm:
+                bits[object_id] |= perm
+        for object_id, instance in instances.items():
+            set_prefetched_perm(instance, self, bits[object_id])
+    return objects
+
+
+@instrumented('check_many')
+def check_many(principal, model, ids, perm, require_all=False):
+    """
+    Check the permission(s) ``perm`` of a :class:`User` or :class:`Group` on
+    many objects of ``model`` at once, such as the results of a search.
+    
+    The rows of all the objects are read a chunk of ids at a time, one or two
+    queries per chunk, and ORed together. With NumPy installed this is done
+    with array operations and a boolean ``numpy.ndarray`` is returned,
+    otherwise a ``list`` of ``bool``\ . Either way the answers are in the
+    order of ``ids``\ ; ``dict(zip(ids, result))`` keys them by id.
+    
+    :param principal: The user or group
+    :type principal: :class:`User` or :class:`Group`
+    :param model: A registered model
+    :type model: ``Model`` class
+    :param ids: The primary keys of the objects to check
+    :type ids: ``list`` of ``integer``
+    :param perm: Permission(s) to check for
+    :type perm: ``int``, ``string`` or ``list of string``
+    :param require_all: Does the user or group need all the permissions?
+                        **Default:** ``False``
+    :type require_all: ``bool``
+    """
+    ids = list(ids)
+    perms = model.perms.as_int(perm)
+    if isinstance(principal, User) and (principal.is_superuser or not principal.is_active):
+        answer = principal.is_active or principal.is_superuser
+        if numpy is not None:
+            return numpy.repeat(bool(answer), len(ids))
+        return [bool(answer)] * len(ids)
+    
+    rows = []
+    for chunk in chunks(set(ids)):
+        rows.extend(_object_perm_rows(principal, model, chunk))
+    
+    if numpy is None:
+        bits = {}
+        for object_id, bit in rows:
+            if bit:
+                bits[object_id] = bits.get(object_id, 0) | bit
+        return [_perm_matches(bits.get(object_id, 0), perms, require_all) for object_id in ids]
+    
+    unique_ids, positions = numpy.unique(numpy.asarray(ids, dtype=numpy.int64), return_inverse=True)
+    bits = numpy.zeros(len(unique_ids), dtype=numpy.int64)
+    if rows:
+        row_ids = numpy.fromiter([object_id for object_id, bit in rows], numpy.int64, len(rows))
+        row_bits = numpy.fromiter([bit or 0 for object_id, bit in rows], numpy.int64, len(rows))
+        numpy.bitwise_or.at(bits, numpy.searchsorted(unique_ids, row_ids), row_bits)
+    matched = bits[positions] & perms
+    if require_all:
+        return matched == perms
+    return matched != 0
+
+
+@instrumented_queryset('get_objects_with_perms')
 def user_get_objects_with_permission(self, model, permission):
     """
     Return all objects of type model where the user has the passed permissions
     """
-    ctype = ContentType.objects.get_for_model(model)
-    perms = model.perms.as_int(permission)
-    return model.objects.filter(
-        Q(pk__in=self.userpermission_set.filter(content_type=ctype).extra(
-            where=['permission & %s > 0'], params=[perms]
-            ).values_list('object_id', flat=True)) |
-        Q(pk__in=GroupPermission.objects.filter(content_type=ctype).filter(
-            group__in=self.groups.all()).extra(
-            where=['permission & %s > 0'], params=[perms]
-            ).values_list('object_id', flat=True)))
+    return filter_perm(model.objects.all(), self, permission)
 
 
+def iter_objects_with_permission(self, model, permission, require_all=False, chunk_size=1000):
+    """
+    Yield all objects of type model where the user or group has the passed
+    permissions, in order of primary key, ``chunk_size`` at a time. Use it
+    instead of :func:`user_get_objects_with_permission` to go through very
+    many objects without loading them all.
+    """
+    return iter_perm(model.objects.all(), self, permission, require_all, chunk_size)
+
+
+@instrumented('get_object_perm')
 def group_get_object_permissions(self, instance, format='int'):
     """
     Get the user's permissions for this object, formatted in a specific way
     """
-    try:
-        group_perm = instance.group_perms_set.get(group=self)
-        formatter = getattr(instance.perms, "as_%s" % format, False)
-        if formatter:
-            return formatter(group_perm.permission)
-        else:
-            return group_perm.permission
-    except GroupPermission.DoesNotExist:
-        if format == 'int':
-            return 0
-        else:
-            return []
+    perm = _get_group_perm_bits(self, instance)
+    formatter = getattr(instance.perms, "as_%s" % format, False)
+    if formatter:
+        return formatter(perm)
+    else:
+        return perm
 
 
 def group_get_object_permissions_as_string_list(self, instance):
@@ -317,6 +774,27 @@ def group_get_object_permissions_as_choices(self, instance):
     return self.get_object_perm(instance, 'choices')
 
 
+def group_prefetch_object_perms(self, objects):
+    """
+    Load the group's permissions for all of ``objects`` at once and keep them
+    on each object. It takes one query per model.
+    
+    :param objects: The objects to load permissions for
+    :type objects: ``QuerySet`` or ``list`` of :class:`Model` instances
+    :result: ``objects`` as a ``list``
+    """
+    objects = list(objects)
+    for model, instances in _group_by_model(objects).items():
+        bits = dict.fromkeys(instances.keys(), 0)
+        for object_id, perm in _object_perm_rows(self, model, instances.keys()):
+            if perm:
+                bits[object_id] |= perm
+        for object_id, instance in instances.items():
+            set_prefetched_perm(instance, self, bits[object_id])
+    return objects
+
+
+@instrumented('has_object_perm')
 def group_has_object_permission(self, instance, perm, require_all=False):
     """
     Basic testing of permissions. Permissions can be passed as an int, using the 
@@ -345,32 +823,19 @@ def group_has_object_permission(self, instance, perm, require_all=False):
     :type require_all:  ``bool``
     """
     perms = instance.perms.as_int(perm)
-    
-    try:
-        group_perm = instance.group_perms_set.get(group=self)
-        
-        # Check if it has ANY of the permissions
-        if group_perm.permission & perms > 0:
-            return True
-    except GroupPermission.DoesNotExist:
-        pass
-    return False
+    return _perm_matches(_get_group_perm_bits(self, instance), perms, require_all)
 
 
 def group_has_all_object_permissions(self, instance, perm):
     return self.has_object_perm(instance, perm, True)
 
 
+@instrumented_queryset('get_objects_with_perms')
 def group_get_objects_with_permission(self, model, permission):
     """
     Return all objects of type model where the group has the passed permissions
     """
-    ctype = ContentType.objects.get_for_model(model)
-    perms = model.perms.as_int(permission)
-    obj_ids = self.grouppermission_set.filter(content_type=ctype).extra(
-                where=['permission & %s > 0'], params=[perms]
-                ).values_list('object_id', flat=True)
-    return model.objects.filter(pk__in=obj_ids)
+    return filter_perm(model.objects.all(), self, permission)
 
 # The following are added to registered models
 
@@ -388,6 +853,9 @@ if User not in registry:
     setattr(User, 'get_object_perm_as_int_list', user_get_object_permissions_as_int_list)
     setattr(User, 'get_object_perm_as_choices', user_get_object_permissions_as_choices)
     setattr(User, 'get_objects_with_perms', user_get_objects_with_permission)
+    setattr(User, 'iter_objects_with_perms', iter_objects_with_permission)
+    setattr(User, 'check_many', check_many)
+    setattr(User, 'prefetch_object_perms', user_prefetch_object_perms)
 if Group not in registry:
     registry.append(Group)
     setattr(Group, 'grant_object_perm', grant_object_perm)
@@ -402,3 +870,6 @@ if Group not in registry:
     setattr(Group, 'get_object_perm_as_int_list', group_get_object_permissions_as_int_list)
     setattr(Group, 'get_object_perm_as_choices', group_get_object_permissions_as_choices)
     setattr(Group, 'get_objects_with_perms', group_get_objects_with_permission)
+    setattr(Group, 'iter_objects_with_perms', iter_objects_with_permission)
+    setattr(Group, 'check_many', check_many)
+    setattr(Group, 'prefetch_object_perms', group_prefetch_object_perms)
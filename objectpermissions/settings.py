@@ -0,0 +1,21 @@
+from django.conf import settings
+
+#: Keep resolved permissions in Django's cache, shared between processes
+CACHE_ENABLED = getattr(settings, 'OBJECTPERMISSIONS_CACHE', False)
+
+#: How long, in seconds, the resolved permissions are kept in the cache
+CACHE_TIMEOUT = getattr(settings, 'OBJECTPERMISSIONS_CACHE_TIMEOUT', 300)
+
+#: Prepended to every cache key
+CACHE_PREFIX = getattr(settings, 'OBJECTPERMISSIONS_CACHE_PREFIX', 'objperms')
+
+#: Keep the group ids of each user in Django's cache, shared between processes
+GROUP_CACHE = getattr(settings, 'OBJECTPERMISSIONS_GROUP_CACHE', False)
+
+#: Keep a table of the effective permission of every user on every object, so
+#: checks are a single indexed lookup instead of resolving groups each time
+EFFECTIVE_PERMS = getattr(settings, 'OBJECTPERMISSIONS_EFFECTIVE_PERMS', False)
+
+#: The dotted path of the ``objectpermissions.instrumentation.Collector`` that
+#: receives the timings and counts of the whole process
+COLLECTOR = getattr(settings, 'OBJECTPERMISSIONS_COLLECTOR', None)
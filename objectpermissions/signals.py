@@ -1,5 +1,143 @@
+import sys
+import threading
+
 import django.dispatch
+from django.db import transaction
+try:
+    from functools import wraps
+except ImportError:
+    from django.utils.functional import wraps  # Python 2.3, 2.4 fallback.
 
 # Whenever a permission object is saved, it sends out the signal. This allows
 # models to keep their permissions in sync
-permission_changed = django.dispatch.Signal(providing_args=('to_whom', 'to_what'))
\ No newline at end of file
+permission_changed = django.dispatch.Signal(providing_args=('to_whom', 'to_what'))
+
+# Sent once by ``bulk_grant`` and ``bulk_revoke`` instead of sending
+# ``permission_changed`` for each row. ``to_whom`` and ``to_what`` are lists.
+permissions_changed_in_bulk = django.dispatch.Signal(providing_args=('to_whom', 'to_what', 'action'))
+
+# The signals held back by each open permission_signal_batch in this thread
+_local = threading.local()
+
+
+def _batches():
+    if not hasattr(_local, 'batches'):
+        _local.batches = []
+    return _local.batches
+
+
+def has_receivers(signal):
+    """
+    Is anything connected to ``signal``\ ?
+    """
+    if hasattr(signal, 'has_listeners'):
+        return signal.has_listeners()
+    return bool(signal.receivers)
+
+
+def batching():
+    """
+    Is a :class:`permission_signal_batch` open in this thread?
+    """
+    return bool(_batches())
+
+
+def send(signal, sender, **kwargs):
+    """
+    Send ``signal`` if anything is connected to it. Inside a
+    :class:`permission_signal_batch` it is held back until the batch ends.
+    """
+    if not has_receivers(signal):
+        return
+    batches = _batches()
+    if batches:
+        batches[-1].append((signal, sender, kwargs))
+    else:
+        signal.send(sender=sender, **kwargs)
+
+
+def _deliver(pending):
+    """
+    Send the held back signals. A permission that changed several times is
+    only reported once, with its final state.
+    """
+    def key(sender):
+        return (sender.__class__, sender.content_type_id, sender.object_id, 
+                sender._get_principal_id())
+    
+    latest = {}
+    for i, (signal, sender, kwargs) in enumerate(pending):
+        if signal is permission_changed:
+            latest[key(sender)] = i
+    for i, (signal, sender, kwargs) in enumerate(pending):
+        if signal is permission_changed and latest[key(sender)] != i:
+            continue
+        signal.send(sender=sender, **kwargs)
+
+
+class permission_signal_batch(object):
+    """
+    Hold back the ``permission_changed`` and ``permissions_changed_in_bulk``
+    signals sent inside it and deliver them together when it ends. If it ends
+    with an error, the changes made so far are still reported, unless the
+    block ran in its own transaction, which is rolled back. Use it as a
+    context manager or a decorator::
+
+        with permission_signal_batch(commit=True):
+            for doc in documents:
+                user.grant_object_perm(doc, 'read')
+
+    With ``commit=True`` it also runs the block in a transaction, like
+    ``commit_on_success``\ , and the signals are delivered after the commit
+    or dropped with a rollback.
+    While a batch is open, permission checks skip the caches and go to the
+    database, since the caches are only invalidated when the signals are
+    delivered.
+    """
+    def __init__(self, commit=False):
+        self.commit = commit
+
+    def __enter__(self):
+        _batches().append([])
+        if self.commit:
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pending = _batches().pop()
+        if self.commit:
+            try:
+                if exc_type is not None:
+                    if transaction.is_dirty():
+                        transaction.rollback()
+                elif transaction.is_dirty():
+                    try:
+                        transaction.commit()
+                    except:
+                        transaction.rollback()
+                        raise
+            finally:
+                transaction.leave_transaction_management()
+        if exc_type is None or not self.commit:
+            # Without a rollback, the changes made before an error stand,
+            # and the caches must hear about them
+            if batching():
+                # Nested: the outer batch delivers them
+                _batches()[-1].extend(pending)
+            else:
+                _deliver(pending)
+        return False
+
+    def __call__(self, func):
+        commit = self.commit
+        def _batched(*args, **kwargs):
+            batch = permission_signal_batch(commit)
+            batch.__enter__()
+            try:
+                result = func(*args, **kwargs)
+            except:
+                batch.__exit__(*sys.exc_info())
+                raise
+            batch.__exit__(None, None, None)
+            return result
+        return wraps(func)(_batched)
@@ -1,13 +1,37 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.test.client import Client
 from django.contrib.flatpages.models import FlatPage
-from django.contrib.auth.models import User, Group
+from django.contrib.auth.models import User, Group, AnonymousUser
 from django.contrib.contenttypes.models import ContentType
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.models import signals
+from django.core.signals import request_finished
+from django.http import HttpRequest, Http404
+from django.template import TemplateDoesNotExist
 # Test against flat pages
 
 import objectpermissions
-from models import ModelPermissions, UserPermission, GroupPermission
-from simpleapp.models import SimpleText, SimpleTaggedItem
+from models import (ModelPermissions, UserPermission, GroupPermission, EffectivePermission,
+                    PermissionAncestor, UnknownPermission, UserPermissionRow, GroupPermissionRow,
+                    perm_models)
+from cache import (cache_key, enable_request_cache, disable_request_cache, get_request_cache,
+                   connect_shared_cache, disconnect_shared_cache, get_shared_perm, set_shared_perm,
+                   get_version, get_prefetched_perm, get_group_ids, invalidate_group_ids,
+                   bump_pending_versions)
+import settings as app_settings
+from middleware import PermissionCacheMiddleware
+from query import with_perms_for, filter_perm, iter_perm, users_with_perm
+from signals import permission_changed, permissions_changed_in_bulk, permission_signal_batch
+from instrumentation import collect_permission_stats
+from decorators import permission_required
+from effective import (connect_effective_perms, disconnect_effective_perms, rebuild_effective_perms,
+                       m2m_changed)
+from hierarchy import rebuild_ancestors
+from defaults import register_defaults, default_perms, group_named, grant_default_perms
+from cleanup import compact_permissions, merge_duplicates, delete_orphans, delete_object_perms
+from simpleapp.models import SimpleText, SimpleTaggedItem, Folder, Document, Ticket
 
 class TestModelPermissions(TestCase):
     perms = ['Perm1', 'Perm2', 'Perm3', 'Perm4']
@@ -42,6 +66,49 @@ class TestModelPermissions(TestCase):
         self.assertEquals(mp.as_int(['Perm1', 'Perm2', 'Perm4']), 1 | 2 | 8)
         self.assertEquals(mp.as_int(['Perm3', 'Perm2', 'Perm4']), 4 | 2 | 8)
         self.assertRaises(AttributeError, mp.as_int, ['Perm5', 'Perm2', 'Perm4'])
+    
+    def testDecoding(self):
+        mp = ModelPermissions(self.perms)
+        
+        self.assertEquals(mp.as_string_list(13), ['Perm1', 'Perm3', 'Perm4'])
+        self.assertEquals(mp.as_int_list(13 | 64), [1, 4, 8])
+        self.assertEquals(mp.as_choices(6), [(2, 'Perm2'), (4, 'Perm3')])
+        self.assertTrue(mp.decode(5) is mp.decode(5))
+        self.assertEquals(mp.name(4), 'Perm3')
+        self.assertRaises(UnknownPermission, mp.as_string_list, 'Perm1')
+        
+        many = ModelPermissions(['Perm%s' % i for i in range(20)])
+        self.assertEquals(many.as_int_list((1 << 19) | 1), [1, 1 << 19])
+        self.assertEquals(many.as_string_list((1 << 19) | 1), ['Perm0', 'Perm19'])
+        self.assertEquals(many.as_int(['Perm19', 2, ('Perm0',)]), (1 << 19) | 3)
+    
+    def testMasks(self):
+        mp = ModelPermissions(self.perms)
+        
+        self.assertEquals(mp.masks(5, True), [5, 7, 13, 15])
+        self.assertEquals(mp.masks(6), [2, 3, 4, 5, 6, 7, 10, 11, 12, 13, 14, 15])
+        self.assertEquals(mp.masks(0), [])
+        self.assertTrue(mp.masks(1) is mp.masks(1))
+        self.assertEquals(ModelPermissions(['Perm%s' % i for i in range(9)]).masks(1), None)
+
+class TestPermissionBits(TestCase):
+    def testBits(self):
+        self.assertEquals(UserPermission.bits(0), [])
+        self.assertEquals(UserPermission.bits(10), [0, 0, 1, 0, 1, 0])
+        self.assertEquals(UserPermission.bits(8), [0, 0, 1, 0, 0, 0])
+        self.assertEquals(len(UserPermission.bits((1 << 63) - 1)), 63)
+        self.assertEquals(UserPermission.bits(1 << 62)[:3], [1, 0, 0])
+    
+    def testIntToPerms(self):
+        self.assertEquals(UserPermission.int_to_perms(0), [])
+        self.assertEquals(UserPermission.int_to_perms(None), [])
+        self.assertEquals(UserPermission.int_to_perms(10), [8, 2])
+        self.assertEquals(UserPermission.int_to_perms((1 << 62) | 5), [1 << 62, 4, 1])
+        self.assertEquals(len(UserPermission.int_to_perms((1 << 63) - 1)), 63)
+        self.assertRaises(ValueError, UserPermission.int_to_perms, -1)
+        
+        p = UserPermission(permission=13)
+        self.assertEquals(p.perm_list, [8, 4, 1])
 
 class TestRegistration(TestCase):
     perms = ['Perm1', 'Perm2', 'Perm3', 'Perm4']
@@ -111,6 +178,23 @@ class TestRegistration(TestCase):
         self.assertFalse(u.has_object_perm(fp, fp.perms.Perm1))
     
     
+    def testRevokeUnheldPermission(self):
+        fp = self.fp
+        u = self.u
+        
+        u.grant_object_perm(fp, ['Perm1', 'Perm3'])
+        u.revoke_object_perm(fp, ['Perm2', 'Perm3'])
+        self.assertEquals(u.get_object_perm(fp), fp.perms.Perm1)
+        u.set_object_perm(fp, 'Perm4')
+        u.grant_object_perm(fp, 'Perm2')
+        self.assertEquals(UserPermission.objects.filter(user=u).count(), 1)
+        self.assertEquals(u.get_object_perm(fp), fp.perms.Perm2 | fp.perms.Perm4)
+        
+        u.revoke_object_perm(fp, ['Perm2', 'Perm4'])
+        self.assertEquals(UserPermission.objects.filter(user=u).count(), 0)
+        u.revoke_object_perm(fp, 'Perm1')
+        self.assertEquals(UserPermission.objects.filter(user=u).count(), 0)
+    
     def testGetUserPermissions(self):
         fp = self.fp
         u = self.u
@@ -143,6 +227,160 @@ class TestRegistration(TestCase):
         g.revoke_object_perm(fp, fp.perms.Perm1)
         self.assertEquals(u.get_object_perm(fp), fp.perms.Perm3+fp.perms.Perm4)
     
+    def testEffectivePermissions(self):
+        fp = self.fp
+        u = self.u
+        g = self.g
+        g2 = Group.objects.create(name="other_group")
+        g.user_set.add(u)
+        g2.user_set.add(u)
+        
+        # Permissions granted only through groups still count
+        g.grant_object_perm(fp, fp.perms.Perm1)
+        g2.grant_object_perm(fp, fp.perms.Perm2)
+        self.assertEquals(u.get_object_perm(fp), fp.perms.Perm1 | fp.perms.Perm2)
+        self.assertTrue(u.has_object_perm(fp, fp.perms.Perm2))
+        self.assertTrue(u.has_all_object_perm(fp, [fp.perms.Perm1, fp.perms.Perm2]))
+        self.assertFalse(u.has_all_object_perm(fp, [fp.perms.Perm1, fp.perms.Perm3]))
+        
+        # A group must have all the permissions when require_all is set
+        self.assertTrue(g.has_any_object_perm(fp, [fp.perms.Perm1, fp.perms.Perm2]))
+        self.assertFalse(g.has_all_object_perm(fp, [fp.perms.Perm1, fp.perms.Perm2]))
+        
+        u.grant_object_perm(fp, fp.perms.Perm3)
+        self.assertTrue(u.has_all_object_perm(fp, [fp.perms.Perm1, fp.perms.Perm3]))
+        self.assertFalse(u.has_object_perm(fp, fp.perms.Perm4))
+    
+    def testPrefetchObjectPerms(self):
+        fp = self.fp
+        u = self.u
+        g = self.g
+        g.user_set.add(u)
+        fp2 = FlatPage.objects.create(url='dummy2/', title="dummy2", enable_comments=False, registration_required=False)
+        
+        u.grant_object_perm(fp, fp.perms.Perm1)
+        g.grant_object_perm(fp2, fp.perms.Perm2)
+        
+        pages = u.prefetch_object_perms(FlatPage.objects.filter(pk__in=[fp.pk, fp2.pk]).order_by('pk'))
+        self.assertEquals([get_prefetched_perm(p, u) for p in pages], [fp.perms.Perm1, fp.perms.Perm2])
+        self.assertTrue(u.has_object_perm(pages[0], 'Perm1'))
+        self.assertEquals(u.get_object_perm(pages[1]), fp.perms.Perm2)
+        
+        pages = g.prefetch_object_perms([fp, fp2])
+        self.assertEquals(get_prefetched_perm(fp, g), 0)
+        self.assertTrue(g.has_object_perm(fp2, 'Perm2'))
+        
+        # Changing a permission forgets what was prefetched
+        u.grant_object_perm(fp, fp.perms.Perm3)
+        self.assertEquals(get_prefetched_perm(fp, u), None)
+        self.assertEquals(u.get_object_perm(fp), fp.perms.Perm1 | fp.perms.Perm3)
+    
+    def testInstrumentation(self):
+        fp = self.fp
+        u = self.u
+        
+        with collect_permission_stats() as stats:
+            u.grant_object_perm(fp, fp.perms.Perm1)
+            self.assertTrue(u.has_object_perm(fp, 'Perm1'))
+            pages = u.prefetch_object_perms([fp])
+            self.assertTrue(u.has_object_perm(fp, 'Perm1'))
+            self.assertEquals(u.get_object_perm(fp), fp.perms.Perm1)
+        u.has_object_perm(fp, 'Perm1')
+        
+        by_model = stats.by_model()
+        self.assertEquals(by_model[('grant_object_perm', 'flatpages.FlatPage')]['calls'], 1)
+        self.assertEquals(by_model[('has_object_perm', 'flatpages.FlatPage')]['calls'], 2)
+        self.assertEquals(by_model[('cache', 'flatpages.FlatPage')]['hits'], 2)
+        self.assertEquals(by_model[('cache', 'flatpages.FlatPage')]['misses'], 0)
+        by_principal = stats.by_principal()
+        self.assertEquals(by_principal[('get_object_perm', 'user:%s' % u.pk)]['calls'], 1)
+        
+        # A QuerySet is measured when it is evaluated, including its clones
+        settings.DEBUG, debug = True, settings.DEBUG
+        try:
+            with collect_permission_stats() as stats:
+                pages = u.get_objects_with_perms(FlatPage, 'Perm1')
+                self.assertEquals(stats.by_model(), {})
+                self.assertEquals(list(pages.order_by('pk')), [fp])
+        finally:
+            settings.DEBUG = debug
+        totals = stats.by_model()[('get_objects_with_perms', 'flatpages.FlatPage')]
+        self.assertEquals((totals['calls'], totals['queries']), (1, 1))
+        
+        # So is counting it, or reading it with values()
+        settings.DEBUG, debug = True, settings.DEBUG
+        try:
+            with collect_permission_stats() as stats:
+                pages = u.get_objects_with_perms(FlatPage, 'Perm1')
+                self.assertEquals(pages.count(), 1)
+                self.assertEquals(list(pages.values_list('pk', flat=True)), [fp.pk])
+                self.assertEquals(pages.values('pk').count(), 1)
+        finally:
+            settings.DEBUG = debug
+        totals = stats.by_model()[('get_objects_with_perms', 'flatpages.FlatPage')]
+        self.assertEquals((totals['calls'], totals['queries']), (3, 3))
+    
+    def testPermissionRequired(self):
+        fp = self.fp
+        u = self.u
+        seen = []
+        
+        def view(request, page_id, page=None):
+            seen.append((page, request.permission_object, u.has_object_perm(page, 'Perm1')))
+            return 'OK'
+        view = permission_required(['Perm1', 'Perm2'], ('flatpages.flatpage', 'pk', 'page_id'), 
+                                   object_name='page')(view)
+        request = HttpRequest()
+        request.user = u
+        
+        u.grant_object_perm(fp, ['Perm1', 'Perm2'])
+        connection.queries = []
+        settings.DEBUG, debug = True, settings.DEBUG
+        try:
+            self.assertEquals(view(request, page_id=fp.pk), 'OK')
+            self.assertEquals(len(connection.queries), 1)
+        finally:
+            settings.DEBUG = debug
+        self.assertEquals(seen, [(fp, fp, True)])
+        
+        self.assertRaises(Http404, view, request, page_id=fp.pk + 100)
+        u.revoke_object_perm(fp, 'Perm2')
+        # Denied with the 403 page, which the test project doesn't have
+        self.assertRaises(TemplateDoesNotExist, view, request, page_id=fp.pk)
+        self.assertEquals(len(seen), 1)
+        
+        request.user = AnonymousUser()
+        self.assertEquals(view(request, page_id=fp.pk).status_code, 302)
+    
+    def testChangesWithoutReceivers(self):
+        fp, u = self.fp, self.u
+        u.grant_object_perm(fp, 'Perm1')
+        receivers, permission_changed.receivers = permission_changed.receivers, []
+        settings.DEBUG, debug = True, settings.DEBUG
+        try:
+            connection.queries = []
+            u.grant_object_perm(fp, 'Perm2')
+            # The UPDATE, without fetching the row for the signal
+            self.assertEquals(len(connection.queries), 1)
+            u.revoke_object_perm(fp, 'Perm1')
+            self.assertEquals(u.get_object_perm(fp), fp.perms.Perm2)
+            u.revoke_object_perm(fp, 'Perm2')
+        finally:
+            settings.DEBUG = debug
+            permission_changed.receivers = receivers
+        self.assertEquals(UserPermission.objects.filter(user=u).count(), 0)
+        
+        changes = []
+        def handler(sender, **kwargs):
+            changes.append(sender.permission)
+        permission_changed.connect(handler)
+        try:
+            u.grant_object_perm(fp, ['Perm1', 'Perm2'])
+            u.revoke_object_perm(fp, ['Perm1', 'Perm2'])
+        finally:
+            permission_changed.disconnect(handler)
+        self.assertEquals(changes, [3, 0])
+    
     def testGetObjectsWithPermission(self):
         fp = self.fp
         u = self.u
@@ -165,6 +403,195 @@ class TestRegistration(TestCase):
         self.assertEquals(len(objs), 0)
         
     
+    def testQuerySetPermissions(self):
+        fp = self.fp
+        u = self.u
+        g = self.g
+        g.user_set.add(u)
+        fp2 = FlatPage.objects.create(url='dummy2/', title="dummy2", enable_comments=False, registration_required=False)
+        fp3 = FlatPage.objects.create(url='dummy3/', title="dummy3", enable_comments=False, registration_required=False)
+        
+        u.grant_object_perm(fp, fp.perms.Perm1)
+        g.grant_object_perm(fp, fp.perms.Perm2)
+        g.grant_object_perm(fp2, fp.perms.Perm2 | fp.perms.Perm3)
+        
+        pages = with_perms_for(FlatPage.objects.filter(pk__in=[fp.pk, fp2.pk, fp3.pk]), u).order_by('pk')
+        self.assertEquals([p.object_perms for p in pages], [3, 6, 0])
+        pages = with_perms_for(FlatPage.objects.filter(pk__in=[fp.pk, fp2.pk, fp3.pk]), g, 'bits')
+        self.assertEquals([p.bits for p in pages.order_by('-bits')], [6, 2, 0])
+        
+        self.assertEquals(list(filter_perm(FlatPage.objects.all(), u, 'Perm2').order_by('pk')), [fp, fp2])
+        self.assertEquals(list(filter_perm(FlatPage.objects.all(), u, ['Perm1', 'Perm2'], True)), [fp])
+        self.assertEquals(list(filter_perm(FlatPage.objects.all(), g, ['Perm2', 'Perm3'], True)), [fp2])
+        self.assertEquals(filter_perm(FlatPage.objects.all(), u, 'Perm4').count(), 0)
+    
+    def testIterObjectsWithPermission(self):
+        u = self.u
+        g = self.g
+        g.user_set.add(u)
+        pages = [FlatPage.objects.create(url='iter%s/' % i, title="iter", enable_comments=False, 
+                                         registration_required=False) for i in range(7)]
+        u.grant_object_perm(pages[0], 'Perm1')
+        g.grant_object_perm(pages[0], 'Perm2')
+        u.grant_object_perm(pages[2], 'Perm1')
+        g.grant_object_perm(pages[3], 'Perm1')
+        g.grant_object_perm(pages[4], 'Perm3')
+        u.grant_object_perm(pages[6], ['Perm1', 'Perm2'])
+        
+        for chunk_size in (1, 2, 3, 100):
+            self.assertEquals(list(u.iter_objects_with_perms(FlatPage, 'Perm1', chunk_size=chunk_size)),
+                              [pages[0], pages[2], pages[3], pages[6]])
+            self.assertEquals(list(u.iter_objects_with_perms(FlatPage, ['Perm1', 'Perm2'], True, chunk_size)),
+                              [pages[0], pages[6]])
+            self.assertEquals(list(g.iter_objects_with_perms(FlatPage, ['Perm1', 'Perm3'], chunk_size=chunk_size)),
+                              [pages[3], pages[4]])
+        self.assertEquals(list(iter_perm(FlatPage.objects.filter(pk__gt=pages[2].pk), u, 'Perm1', chunk_size=2)),
+                          [pages[3], pages[6]])
+    
+    def testCheckMany(self):
+        u = self.u
+        g = self.g
+        g.user_set.add(u)
+        pages = [FlatPage.objects.create(url='many%s/' % i, title="many", enable_comments=False, 
+                                         registration_required=False) for i in range(5)]
+        u.grant_object_perm(pages[0], 'Perm1')
+        g.grant_object_perm(pages[0], 'Perm2')
+        g.grant_object_perm(pages[1], 'Perm1')
+        u.grant_object_perm(pages[3], 'Perm3')
+        ids = [p.pk for p in pages] + [pages[1].pk, 99999]
+        
+        self.assertEquals(list(u.check_many(FlatPage, ids, 'Perm1')),
+                          [True, True, False, False, False, True, False])
+        self.assertEquals(list(objectpermissions.check_many(u, FlatPage, ids, ['Perm1', 'Perm2'], True)),
+                          [True, False, False, False, False, False, False])
+        self.assertEquals(list(g.check_many(FlatPage, ids, ['Perm1', 'Perm2'])),
+                          [True, True, False, False, False, True, False])
+        self.assertEquals(list(u.check_many(FlatPage, [], 'Perm1')), [])
+        u.is_superuser = True
+        self.assertEquals(list(u.check_many(FlatPage, ids[:2], 'Perm4')), [True, True])
+        u.is_superuser = False
+        u.is_active = False
+        self.assertEquals(list(u.check_many(FlatPage, ids[:2], 'Perm1')), [False, False])
+    
+    def testUsersWithPermission(self):
+        fp = self.fp
+        u = self.u
+        g = self.g
+        g.user_set.add(u)
+        u2 = User.objects.create_user('member_guy','member@guy.com', 'password')
+        g.user_set.add(u2)
+        inactive = User.objects.create_user('inactive_guy','inactive@guy.com', 'password')
+        inactive.is_active = False
+        inactive.save()
+        u.grant_object_perm(fp, 'Perm1')
+        g.grant_object_perm(fp, 'Perm2')
+        inactive.grant_object_perm(fp, 'Perm1')
+        
+        def names(users):
+            return sorted([user.username for user in users])
+        
+        self.assertEquals(names(users_with_perm(fp, 'Perm1')), ['simple_guy'])
+        self.assertEquals(names(users_with_perm(fp, ['Perm1', 'Perm2'])), ['member_guy', 'simple_guy'])
+        self.assertEquals(names(users_with_perm(fp, ['Perm1', 'Perm2'], True)), ['simple_guy'])
+        self.assertEquals(names(users_with_perm(fp, 'Perm3')), [])
+        self.assertEquals(names(users_with_perm(fp, 'Perm2').filter(username__startswith='member')),
+                          ['member_guy'])
+        
+        self.assertEquals([p.user for p in fp.user_perms_set.all_with_perm('Perm1')], [u, inactive])
+        self.assertEquals([p.group for p in fp.group_perms_set.all_with_perm(['Perm1', 'Perm2'])], [])
+        u.grant_object_perm(fp, 'Perm2')
+        self.assertEquals([p.user for p in fp.user_perms_set.all_with_perm(['Perm1', 'Perm2'])], [u])
+    
+    def testUnregisteredBits(self):
+        fp, u, g = self.fp, self.u, self.g
+        # Left by a permission that is no longer registered
+        u.grant_object_perm(fp, 'Perm1')
+        g.grant_object_perm(fp, 'Perm2')
+        UserPermission.objects.filter(user=u).update(permission=16 | 1)
+        GroupPermission.objects.filter(group=g).update(permission=32 | 2)
+        g.user_set.add(u)
+        
+        self.assertEquals([p.user for p in fp.user_perms_set.all_with_perm('Perm1')], [u])
+        self.assertEquals([p.group for p in fp.group_perms_set.all_with_perm('Perm2')], [g])
+        self.assertEquals(list(users_with_perm(fp, ['Perm1', 'Perm2'], True)), [u])
+        self.assertEquals(list(filter_perm(FlatPage.objects.all(), u, 'Perm1')), [fp])
+        self.assertEquals(list(filter_perm(FlatPage.objects.all(), g, 'Perm2')), [fp])
+        self.assertEquals(list(filter_perm(FlatPage.objects.all(), u, 'Perm3')), [])
+    
+    def testBulkGrantRevoke(self):
+        fp = self.fp
+        u = self.u
+        g = self.g
+        u2 = User.objects.create_user('other_guy','other@guy.com', 'password')
+        fp2 = FlatPage.objects.create(url='dummy2/', title="dummy2", enable_comments=False, registration_required=False)
+        self.create_simpletext()
+        st = self.st
+        u.grant_object_perm(fp, 'Perm4')
+        
+        calls = []
+        def bulk_handler(sender, to_whom, to_what, action, **kwargs):
+            calls.append((len(to_whom), len(to_what), action))
+        permissions_changed_in_bulk.connect(bulk_handler)
+        try:
+            objectpermissions.bulk_grant([u, u2, g], FlatPage.objects.filter(pk__in=[fp.pk, fp2.pk]), ['Perm1', 'Perm2'])
+            objectpermissions.bulk_grant([g], [st], 'perm3')
+            self.assertEquals(calls, [(3, 2, 'grant'), (1, 1, 'grant')])
+            self.assertEquals(UserPermission.objects.filter(content_type=ContentType.objects.get_for_model(FlatPage)).count(), 4)
+            self.assertEquals(u.get_object_perm(fp), fp.perms.Perm1 | fp.perms.Perm2 | fp.perms.Perm4)
+            self.assertEquals(u2.get_object_perm(fp2), fp.perms.Perm1 | fp.perms.Perm2)
+            self.assertEquals(g.get_object_perm(fp2), fp.perms.Perm1 | fp.perms.Perm2)
+            self.assertEquals(g.get_object_perm(st), st.perms.perm3)
+            
+            objectpermissions.bulk_revoke([u, u2, g], [fp, fp2], ['Perm1', 'Perm2'])
+            self.assertEquals(calls[-1], (3, 2, 'revoke'))
+            self.assertEquals(u.get_object_perm(fp), fp.perms.Perm4)
+            self.assertEquals(UserPermission.objects.filter(content_type=ContentType.objects.get_for_model(FlatPage)).count(), 1)
+            self.assertEquals(GroupPermission.objects.filter(group=g).count(), 1)
+        finally:
+            permissions_changed_in_bulk.disconnect(bulk_handler)
+    
+    def testSignalBatch(self):
+        fp = self.fp
+        u = self.u
+        g = self.g
+        g.user_set.add(u)
+        
+        calls = []
+        def handler(sender, to_whom, to_what, **kwargs):
+            calls.append((to_whom, to_what, sender.permission))
+        permission_changed.connect(handler)
+        try:
+            batch = permission_signal_batch()
+            batch.__enter__()
+            u.grant_object_perm(fp, 'Perm1')
+            u.grant_object_perm(fp, 'Perm2')
+            g.grant_object_perm(fp, 'Perm3')
+            self.assertEquals(calls, [])
+            self.assertEquals(u.get_object_perm(fp), fp.perms.Perm1 | fp.perms.Perm2 | fp.perms.Perm3)
+            batch.__exit__(None, None, None)
+            self.assertEquals(calls, [(u, fp, fp.perms.Perm1 | fp.perms.Perm2), (g, fp, fp.perms.Perm3)])
+            
+            # The changes made before an error are still reported
+            del calls[:]
+            def failing():
+                u.revoke_object_perm(fp, 'Perm1')
+                raise ValueError
+            self.assertRaises(ValueError, permission_signal_batch()(failing))
+            self.assertEquals(calls, [(u, fp, fp.perms.Perm2)])
+            
+            # Unless they were rolled back
+            del calls[:]
+            self.assertRaises(ValueError, permission_signal_batch(commit=True)(failing))
+            self.assertEquals(calls, [])
+            
+            # Outside a batch, objects not loaded yet are passed lazily
+            UserPermission.objects.get(user=u).save()
+            self.assertEquals(calls[0][0], u)
+            self.assertTrue(isinstance(calls[0][1], FlatPage))
+            self.assertEquals(calls[0][1].pk, fp.pk)
+        finally:
+            permission_changed.disconnect(handler)
+    
     def testSignals(self):
         self.create_simpletext()
         st = self.st
@@ -203,3 +630,680 @@ class TestRegistration(TestCase):
             self.assertEquals(u.get_object_perm(item), u.get_object_perm(st))
         
         
+
+class TestRequestCache(TestCase):
+    perms = ['Perm1', 'Perm2', 'Perm3', 'Perm4']
+    
+    def setUp(self):
+        self.fp = FlatPage.objects.create(url='cached/', title="cached", enable_comments=False, registration_required=False)
+        objectpermissions.register(FlatPage, self.perms)
+        self.u = User.objects.create_user('cached_guy','cached@guy.com', 'password')
+        self.g = Group.objects.create(name="cached_group")
+        self.g.user_set.add(self.u)
+    
+    def tearDown(self):
+        disable_request_cache(self.u)
+    
+    def testCacheInvalidation(self):
+        fp = self.fp
+        u = self.u
+        enable_request_cache(u)
+        
+        self.assertFalse(u.has_object_perm(fp, fp.perms.Perm1))
+        self.assertEquals(get_request_cache(u)[cache_key(fp)], 0)
+        
+        u.grant_object_perm(fp, fp.perms.Perm1)
+        self.assertTrue(u.has_object_perm(fp, fp.perms.Perm1))
+        self.g.grant_object_perm(fp, fp.perms.Perm2)
+        self.assertEquals(u.get_object_perm_as_str_list(fp), ['Perm1', 'Perm2'])
+        
+        u.revoke_all_object_perm(fp)
+        self.assertEquals(u.get_object_perm(fp), fp.perms.Perm2)
+        self.g.revoke_object_perm(fp, fp.perms.Perm2)
+        self.assertEquals(u.get_object_perm(fp), 0)
+    
+    def testMiddleware(self):
+        class FakeRequest(object):
+            pass
+        request = FakeRequest()
+        request.user = self.u
+        mw = PermissionCacheMiddleware()
+        mw.process_request(request)
+        self.assertEquals(get_request_cache(self.u), {})
+        self.u.has_object_perm(self.fp, 'Perm1')
+        self.assertTrue(cache_key(self.fp) in get_request_cache(self.u))
+        response = object()
+        self.assertTrue(mw.process_response(request, response) is response)
+        self.assertEquals(get_request_cache(self.u), None)
+
+    def testGroupSnapshot(self):
+        fp, u, g = self.fp, self.u, self.g
+        fp2 = FlatPage.objects.create(url='cached2/', title="cached2", enable_comments=False, registration_required=False)
+        g.grant_object_perm(fp2, 'Perm2')
+        loner = User.objects.create_user('lonely_guy','lonely@guy.com', 'password')
+        # Only kept where a change to the groups can reach it
+        self.assertEquals(get_group_ids(loner), None)
+        self.assertFalse(hasattr(loner, '_object_perm_groups'))
+        
+        enable_request_cache(loner)
+        enable_request_cache(u)
+        settings.DEBUG, debug = True, settings.DEBUG
+        try:
+            if m2m_changed is None:
+                self.assertEquals(get_group_ids(loner), None)
+            else:
+                self.assertEquals(get_group_ids(loner), frozenset())
+                connection.queries = []
+                self.assertFalse(loner.has_object_perm(fp, 'Perm1'))
+                # No group query for a user without groups
+                self.assertEquals(len(connection.queries), 1)
+                
+                self.assertEquals(get_group_ids(u), frozenset([g.pk]))
+                connection.queries = []
+                self.assertTrue(u.has_object_perm(fp2, 'Perm2'))
+                self.assertEquals(len(connection.queries), 2)
+            self.assertEquals([p.pk for p in u.get_objects_with_perms(FlatPage, 'Perm2')], [fp2.pk])
+            
+            # Changed from the group's side, which only knows the user's id
+            g.user_set.add(loner)
+            self.assertTrue(loner.has_object_perm(fp2, 'Perm2'))
+            if m2m_changed is not None:
+                self.assertEquals(get_group_ids(loner), frozenset([g.pk]))
+                g.user_set.remove(loner)
+                self.assertFalse(loner.has_object_perm(fp2, 'Perm2'))
+                g.user_set.add(loner)
+        finally:
+            settings.DEBUG = debug
+            disable_request_cache(loner)
+            disable_request_cache(u)
+        
+        app_settings.GROUP_CACHE = True
+        try:
+            self.assertEquals(get_group_ids(User.objects.get(pk=loner.pk)), frozenset([g.pk]))
+            g.user_set.remove(loner)
+            other = User.objects.get(pk=loner.pk)
+            if m2m_changed is None:
+                self.assertEquals(get_group_ids(other), frozenset([g.pk]))
+            else:
+                self.assertEquals(get_group_ids(other), frozenset())
+            invalidate_group_ids([loner.pk])
+            self.assertEquals(get_group_ids(User.objects.get(pk=loner.pk)), frozenset())
+        finally:
+            app_settings.GROUP_CACHE = False
+    
+class TestSharedCache(TestCase):
+    perms = ['Perm1', 'Perm2', 'Perm3', 'Perm4']
+    
+    def setUp(self):
+        self.fp = FlatPage.objects.create(url='shared/', title="shared", enable_comments=False, registration_required=False)
+        objectpermissions.register(FlatPage, self.perms)
+        self.u = User.objects.create_user('shared_guy','shared@guy.com', 'password')
+        self.g = Group.objects.create(name="shared_group")
+        self.g.user_set.add(self.u)
+        app_settings.CACHE_ENABLED = True
+        connect_shared_cache()
+    
+    def tearDown(self):
+        app_settings.CACHE_ENABLED = False
+        disconnect_shared_cache()
+    
+    def testVersionedKeys(self):
+        fp = self.fp
+        u = self.u
+        key = cache_key(fp)
+        
+        self.assertFalse(u.has_object_perm(fp, fp.perms.Perm1))
+        self.assertEquals(get_shared_perm(key, u), 0)
+        version = get_version(key)
+        
+        u.grant_object_perm(fp, fp.perms.Perm1)
+        self.assertNotEquals(get_version(key), version)
+        self.assertEquals(get_shared_perm(key, u), None)
+        self.assertTrue(u.has_object_perm(fp, fp.perms.Perm1))
+        
+        # A stale value left in the cache is never read again
+        set_shared_perm(key, u, fp.perms.Perm4)
+        self.g.set_object_perm(fp, fp.perms.Perm2)
+        self.assertEquals(u.get_object_perm(fp), fp.perms.Perm1 | fp.perms.Perm2)
+        self.assertEquals(self.g.get_object_perm(fp), fp.perms.Perm2)
+        
+        u.revoke_object_perm(fp, fp.perms.Perm1)
+        self.assertEquals(u.get_object_perm(fp), fp.perms.Perm2)
+        self.g.revoke_all_object_perm(fp)
+        self.assertEquals(u.get_object_perm(fp), 0)
+        self.assertFalse(self.g.has_object_perm(fp, fp.perms.Perm2))
+    
+    def testPendingVersions(self):
+        fp, u = self.fp, self.u
+        key = cache_key(fp)
+        # Tests run in a transaction, like a request with TransactionMiddleware
+        u.grant_object_perm(fp, fp.perms.Perm1)
+        
+        # Another process read the rows before the commit
+        set_shared_perm(key, u, 0)
+        request_finished.send(sender=None)
+        self.assertEquals(get_shared_perm(key, u), None)
+        
+        # Only the versions moved since are moved again
+        version = get_version(key)
+        bump_pending_versions()
+        self.assertEquals(get_version(key), version)
+    
+    def testGroupChanges(self):
+        fp, u, g = self.fp, self.u, self.g
+        g.grant_object_perm(fp, fp.perms.Perm1)
+        self.assertTrue(u.has_object_perm(fp, fp.perms.Perm1))
+        self.assertEquals(get_shared_perm(cache_key(fp), u), fp.perms.Perm1)
+        
+        g.user_set.remove(u)
+        if m2m_changed is None:
+            invalidate_group_ids([u.pk])
+        self.assertEquals(get_shared_perm(cache_key(fp), u), None)
+        self.assertFalse(u.has_object_perm(fp, fp.perms.Perm1))
+        
+        other = User.objects.create_user('other_guy','other@guy.com', 'password')
+        self.assertFalse(other.has_object_perm(fp, fp.perms.Perm2))
+        objectpermissions.bulk_grant([other], [fp], 'Perm2')
+        self.assertTrue(other.has_object_perm(fp, fp.perms.Perm2))
+        
+        g.user_set.add(other)
+        if m2m_changed is None:
+            invalidate_group_ids([other.pk])
+        self.assertTrue(other.has_object_perm(fp, fp.perms.Perm1))
+        g.delete()
+        self.assertFalse(other.has_object_perm(fp, fp.perms.Perm1))
+
+class TestEffectivePermissions(TestCase):
+    perms = ['Perm1', 'Perm2', 'Perm3', 'Perm4']
+    
+    def setUp(self):
+        objectpermissions.register(FlatPage, self.perms)
+        self.fp = FlatPage.objects.create(url='effective/', title="effective", enable_comments=False, registration_required=False)
+        self.fp2 = FlatPage.objects.create(url='effective2/', title="effective2", enable_comments=False, registration_required=False)
+        self.u = User.objects.create_user('effective_guy','effective@guy.com', 'password')
+        self.g = Group.objects.create(name="effective_group")
+        app_settings.EFFECTIVE_PERMS = True
+        connect_effective_perms()
+    
+    def tearDown(self):
+        app_settings.EFFECTIVE_PERMS = False
+        disconnect_effective_perms()
+    
+    def join_group(self, user, group):
+        group.user_set.add(user)
+    
+    def effective(self, instance):
+        return list(EffectivePermission.objects.filter(user=self.u, object_id=instance.pk
+            ).values_list('permission', flat=True))
+    
+    def testIncrementalUpdates(self):
+        fp, fp2, u, g = self.fp, self.fp2, self.u, self.g
+        
+        u.grant_object_perm(fp, 'Perm1')
+        self.assertEquals(self.effective(fp), [fp.perms.Perm1])
+        g.grant_object_perm(fp, 'Perm2')
+        self.assertEquals(self.effective(fp), [fp.perms.Perm1])
+        
+        self.join_group(u, g)
+        self.assertEquals(self.effective(fp), [fp.perms.Perm1 | fp.perms.Perm2])
+        self.assertTrue(u.has_all_object_perm(fp, ['Perm1', 'Perm2']))
+        
+        objectpermissions.bulk_grant([g], [fp, fp2], 'Perm3')
+        self.assertEquals(self.effective(fp2), [fp.perms.Perm3])
+        self.assertEquals(list(u.get_objects_with_perms(FlatPage, 'Perm3').order_by('pk')), [fp, fp2])
+        self.assertEquals(list(u.iter_objects_with_perms(FlatPage, 'Perm3', chunk_size=1)), [fp, fp2])
+        self.assertEquals(list(u.get_objects_with_perms(FlatPage, 'Perm1')), [fp])
+        self.assertEquals([p.object_perms for p in with_perms_for(FlatPage.objects.filter(pk=fp2.pk), u)],
+                          [fp.perms.Perm3])
+        
+        u.revoke_all_object_perm(fp)
+        g.revoke_object_perm(fp2, 'Perm3')
+        self.assertEquals(self.effective(fp), [fp.perms.Perm2 | fp.perms.Perm3])
+        self.assertEquals(self.effective(fp2), [])
+        self.assertFalse(u.has_object_perm(fp2, 'Perm3'))
+        
+        u.prefetch_object_perms([fp, fp2])
+        self.assertEquals(get_prefetched_perm(fp, u), fp.perms.Perm2 | fp.perms.Perm3)
+        self.assertEquals(get_prefetched_perm(fp2, u), 0)
+    
+    def testDeletePrincipals(self):
+        fp, fp2, u, g = self.fp, self.fp2, self.u, self.g
+        self.join_group(u, g)
+        u.grant_object_perm(fp, 'Perm1')
+        g.grant_object_perm(fp, 'Perm2')
+        g.grant_object_perm(fp2, 'Perm3')
+        self.assertEquals(self.effective(fp), [fp.perms.Perm1 | fp.perms.Perm2])
+        
+        g.delete()
+        self.assertEquals(self.effective(fp), [fp.perms.Perm1])
+        self.assertEquals(self.effective(fp2), [])
+        self.assertFalse(u.has_object_perm(fp2, 'Perm3'))
+        self.assertEquals(list(u.get_objects_with_perms(FlatPage, ['Perm1', 'Perm2', 'Perm3'])), [fp])
+        
+        u.delete()
+        self.assertEquals(EffectivePermission.objects.count(), 0)
+    
+    def testUsersWithPermission(self):
+        fp, u, g = self.fp, self.u, self.g
+        self.join_group(u, g)
+        u.grant_object_perm(fp, 'Perm1')
+        g.grant_object_perm(fp, 'Perm2')
+        self.assertEquals(list(users_with_perm(fp, ['Perm1', 'Perm2'], True)), [u])
+        self.assertEquals(list(users_with_perm(fp, 'Perm3')), [])
+    
+    def testRebuild(self):
+        fp, u, g = self.fp, self.u, self.g
+        self.join_group(u, g)
+        u.grant_object_perm(fp, 'Perm1')
+        g.grant_object_perm(fp, 'Perm4')
+        
+        EffectivePermission.objects.all().delete()
+        self.assertFalse(u.has_object_perm(fp, 'Perm1'))
+        rebuild_effective_perms()
+        self.assertEquals(self.effective(fp), [fp.perms.Perm1 | fp.perms.Perm4])
+        
+        # Inside a batch the table isn't updated yet, so it isn't used
+        with permission_signal_batch():
+            g.revoke_all_object_perm(fp)
+            self.assertEquals(u.get_object_perm(fp), fp.perms.Perm1)
+        self.assertEquals(self.effective(fp), [fp.perms.Perm1])
+
+if m2m_changed is None:
+    class TestEffectivePermissions(TestCase):
+        def testRefused(self):
+            # It couldn't follow changes to group membership
+            self.assertRaises(ImproperlyConfigured, connect_effective_perms)
+
+
+class TestHierarchy(TestCase):
+    def setUp(self):
+        self.root = Folder.objects.create(name='root')
+        self.sub = Folder.objects.create(name='sub', parent=self.root)
+        self.doc = Document.objects.create(title='doc', folder=self.sub)
+        self.u = User.objects.create_user('tree_guy','tree@guy.com', 'password')
+        self.g = Group.objects.create(name="tree_group")
+        self.g.user_set.add(self.u)
+    
+    def ancestors(self, obj):
+        return sorted(PermissionAncestor.objects.filter(object_id=obj.pk,
+            content_type=ContentType.objects.get_for_model(obj)).values_list('ancestor_id', 'depth'))
+    
+    def testInheritance(self):
+        root, sub, doc, u, g = self.root, self.sub, self.doc, self.u, self.g
+        self.assertEquals(self.ancestors(doc), sorted([(root.pk, 2), (sub.pk, 1)]))
+        self.assertFalse(u.has_object_perm(doc, 'read'))
+        
+        g.grant_object_perm(root, 'read')
+        connection.queries = []
+        settings.DEBUG, debug = True, settings.DEBUG
+        try:
+            self.assertTrue(u.has_object_perm(doc, 'read'))
+            self.assertEquals(len(connection.queries), 1)
+        finally:
+            settings.DEBUG = debug
+        self.assertTrue(g.has_object_perm(doc, 'read'))
+        self.assertFalse(u.has_object_perm(doc, 'write'))
+        
+        u.grant_object_perm(sub, 'write')
+        u.grant_object_perm(doc, 'delete')
+        self.assertEquals(u.get_object_perm_as_str_list(doc), ['read', 'write', 'delete'])
+        self.assertEquals(list(u.get_objects_with_perms(Document, 'write')), [doc])
+        self.assertEquals(list(u.iter_objects_with_perms(Document, 'read', chunk_size=1)), [doc])
+        self.assertEquals(list(g.get_objects_with_perms(Folder, 'read').order_by('pk')), [root, sub])
+        self.assertEquals([d.object_perms for d in with_perms_for(Document.objects.all(), u)], [7])
+        self.assertEquals(list(filter_perm(Document.objects.all(), u, ['read', 'write', 'delete'], True)), [doc])
+        self.assertEquals(list(filter_perm(Folder.objects.all(), u, ['read', 'write'], True)), [sub])
+        self.assertEquals(list(filter_perm(Folder.objects.all(), g, ['read', 'write'], True)), [])
+        u.prefetch_object_perms([doc])
+        self.assertEquals(get_prefetched_perm(doc, u), 7)
+        g.prefetch_object_perms([doc])
+        self.assertEquals(get_prefetched_perm(doc, g), doc.perms.read)
+    
+    def testMoveAndDelete(self):
+        root, sub, doc, u, g = self.root, self.sub, self.doc, self.u, self.g
+        other = Folder.objects.create(name='other')
+        g.grant_object_perm(root, 'read')
+        enable_request_cache(u)
+        try:
+            self.assertTrue(u.has_object_perm(doc, 'read'))
+            
+            sub.parent = other
+            sub.save()
+            self.assertEquals(self.ancestors(doc), sorted([(other.pk, 2), (sub.pk, 1)]))
+            self.assertFalse(u.has_object_perm(doc, 'read'))
+            
+            u.grant_object_perm(other, 'write')
+            self.assertTrue(u.has_object_perm(doc, 'write'))
+        finally:
+            disable_request_cache(u)
+        
+        other.parent = sub
+        self.assertRaises(Exception, other.save)
+        other.parent = None
+        
+        PermissionAncestor.objects.all().delete()
+        rebuild_ancestors(Document)
+        self.assertEquals(self.ancestors(doc), sorted([(other.pk, 2), (sub.pk, 1)]))
+        self.assertEquals(self.ancestors(sub), [(other.pk, 1)])
+        
+        other.delete()
+        self.assertEquals(PermissionAncestor.objects.count(), 0)
+    
+    def testUsersWithPermission(self):
+        root, sub, doc, u, g = self.root, self.sub, self.doc, self.u, self.g
+        other = User.objects.create_user('leaf_guy','leaf@guy.com', 'password')
+        g.grant_object_perm(root, 'read')
+        other.grant_object_perm(doc, 'read')
+        other.grant_object_perm(sub, 'write')
+        
+        self.assertEquals(sorted([user.pk for user in users_with_perm(doc, 'read')]), [u.pk, other.pk])
+        self.assertEquals(list(users_with_perm(doc, ['read', 'write'], True)), [other])
+        self.assertEquals(list(users_with_perm(sub, 'read')), [u])
+    
+    def testSharedCache(self):
+        root, doc, u = self.root, self.doc, self.u
+        app_settings.CACHE_ENABLED = True
+        connect_shared_cache()
+        try:
+            self.assertFalse(u.has_object_perm(doc, 'write'))
+            self.g.grant_object_perm(root, 'write')
+            self.assertTrue(u.has_object_perm(doc, 'write'))
+            self.g.revoke_object_perm(root, 'write')
+            self.assertFalse(u.has_object_perm(doc, 'write'))
+        finally:
+            app_settings.CACHE_ENABLED = False
+            disconnect_shared_cache()
+
+class TestDefaultPerms(TestCase):
+    def setUp(self):
+        self.folder = Folder.objects.create(name='defaults')
+        self.u = User.objects.create_user('default_guy','default@guy.com', 'password')
+        self.staff = Group.objects.create(name="staff")
+        register_defaults(Document, [
+            ('creator', ['read', 'write', 'delete']),
+            (group_named('staff'), 'read'),
+            (lambda doc: doc.creator, 'write'),
+        ])
+    
+    def tearDown(self):
+        del default_perms[Document]
+        signals.post_save.disconnect(grant_default_perms, sender=Document,
+                                     dispatch_uid='objectpermissions.defaults.simpleapp.Document')
+    
+    def rows(self, doc):
+        ctype = ContentType.objects.get_for_model(doc)
+        return (list(UserPermission.objects.filter(content_type=ctype, object_id=doc.pk).values_list('user', 'permission')),
+                list(GroupPermission.objects.filter(content_type=ctype, object_id=doc.pk).values_list('group', 'permission')))
+    
+    def testCreate(self):
+        doc = Document(title='new', folder=self.folder)
+        doc.creator = self.u
+        changes = []
+        def bulk_handler(sender, to_whom, to_what, action, **kwargs):
+            changes.append((sorted([p.pk for p in to_whom]), to_what, action))
+        permissions_changed_in_bulk.connect(bulk_handler)
+        try:
+            doc.save()
+        finally:
+            permissions_changed_in_bulk.disconnect(bulk_handler)
+        
+        self.assertEquals(self.rows(doc), ([(self.u.pk, 7)], [(self.staff.pk, 1)]))
+        self.assertEquals(changes, [(sorted([self.u.pk, self.staff.pk]), [doc], 'grant')])
+        self.assertTrue(self.u.has_all_object_perm(doc, ['read', 'write', 'delete']))
+        
+        # Saving it again doesn't grant anything
+        doc.save()
+        self.assertEquals(self.rows(doc), ([(self.u.pk, 7)], [(self.staff.pk, 1)]))
+    
+    def testApplyInBulk(self):
+        docs = []
+        for i in range(3):
+            doc = Document(title='bulk%s' % i, folder=self.folder)
+            doc.creator = i and self.u or None
+            docs.append(doc)
+        signals.post_save.disconnect(grant_default_perms, sender=Document,
+                                     dispatch_uid='objectpermissions.defaults.simpleapp.Document')
+        for doc in docs:
+            doc.save()
+        
+        objectpermissions.apply_default_perms(docs + [self.folder])
+        self.assertEquals(self.rows(docs[0]), ([], [(self.staff.pk, 1)]))
+        self.assertEquals(self.rows(docs[2]), ([(self.u.pk, 7)], [(self.staff.pk, 1)]))
+        self.assertEquals(self.rows(self.folder), ([], []))
+    
+    def testMissingGroup(self):
+        self.staff.delete()
+        doc = Document(title='nostaff', folder=self.folder)
+        doc.creator = self.u
+        doc.save()
+        self.assertEquals(self.rows(doc), ([(self.u.pk, 7)], []))
+
+
+class TestRowStorage(TestCase):
+    def setUp(self):
+        self.ticket = Ticket.objects.create(title='ticket')
+        self.ticket2 = Ticket.objects.create(title='ticket2')
+        self.u = User.objects.create_user('row_guy','row@guy.com', 'password')
+        self.g = Group.objects.create(name="row_group")
+        self.g.user_set.add(self.u)
+    
+    def rows(self, instance):
+        return sorted(UserPermissionRow.objects.filter(object_id=instance.pk).values_list('user', 'permission'))
+    
+    def testGrantRevoke(self):
+        ticket, u, g = self.ticket, self.u, self.g
+        self.assertEquals(perm_models(Ticket), (UserPermissionRow, GroupPermissionRow))
+        
+        changes = []
+        def handler(sender, **kwargs):
+            changes.append(sender.permission)
+        permission_changed.connect(handler)
+        try:
+            u.grant_object_perm(ticket, ['read', 'write'])
+            u.grant_object_perm(ticket, 'read')
+            self.assertEquals(self.rows(ticket), [(u.pk, 1), (u.pk, 2)])
+            self.assertEquals(changes, [3])
+            
+            u.revoke_object_perm(ticket, 'read')
+            self.assertEquals(self.rows(ticket), [(u.pk, 2)])
+            u.set_object_perm(ticket, ['read', 'close'])
+            self.assertEquals(self.rows(ticket), [(u.pk, 1), (u.pk, 4)])
+            self.assertEquals(changes, [3, 2, 5])
+            
+            g.grant_object_perm(ticket, 'write')
+            self.assertEquals(u.get_object_perm(ticket), 7)
+            self.assertTrue(u.has_all_object_perm(ticket, ['read', 'write', 'close']))
+            self.assertEquals(g.get_object_perm_as_str_list(ticket), ['write'])
+            
+            u.revoke_all_object_perm(ticket)
+            self.assertEquals(self.rows(ticket), [])
+            self.assertEquals(changes[-1], 0)
+            self.assertEquals(u.get_object_perm(ticket), 2)
+        finally:
+            permission_changed.disconnect(handler)
+        
+        self.assertRaises(Exception, objectpermissions.register, Ticket, ['read'], storage='columns')
+    
+    def testQueries(self):
+        ticket, ticket2, u, g = self.ticket, self.ticket2, self.u, self.g
+        u.grant_object_perm(ticket, 'read')
+        g.grant_object_perm(ticket, 'close')
+        g.grant_object_perm(ticket2, ['read', 'write'])
+        
+        self.assertEquals(list(u.get_objects_with_perms(Ticket, 'close')), [ticket])
+        self.assertEquals(list(filter_perm(Ticket.objects.all(), u, ['read', 'close'], True)), [ticket])
+        self.assertEquals(list(filter_perm(Ticket.objects.order_by('pk'), u, 'read')), [ticket, ticket2])
+        self.assertEquals(list(filter_perm(Ticket.objects.all(), g, ['read', 'close'], True)), [])
+        self.assertEquals([t.object_perms for t in with_perms_for(Ticket.objects.order_by('pk'), u)], [5, 3])
+        self.assertEquals(list(u.iter_objects_with_perms(Ticket, 'write', chunk_size=1)), [ticket2])
+        self.assertEquals(list(u.check_many(Ticket, [ticket.pk, ticket2.pk], ['read', 'close'], True)),
+                          [True, False])
+        self.assertEquals(list(users_with_perm(ticket, ['read', 'close'], True)), [u])
+        self.assertEquals([p.permission for p in ticket.group_perms_set.all_with_perm('close')], [4])
+        u.prefetch_object_perms([ticket, ticket2])
+        self.assertEquals(get_prefetched_perm(ticket2, u), 3)
+        
+        u.grant_object_perm(ticket, 'close')
+        g.grant_object_perm(ticket, 'write')
+        self.assertEquals([p.user for p in ticket.user_perms_set.all_with_perm(['read', 'close'])], [u])
+        self.assertEquals([p.group for p in ticket.group_perms_set.all_with_perm(['read', 'close'])], [])
+        self.assertEquals([p.group for p in ticket.group_perms_set.all_with_perm(['write', 'close'])], [g])
+    
+    def testBulk(self):
+        ticket, ticket2, u, g = self.ticket, self.ticket2, self.u, self.g
+        u.grant_object_perm(ticket, 'read')
+        objectpermissions.bulk_grant([u, g], [ticket, ticket2], ['read', 'write'])
+        self.assertEquals(self.rows(ticket), [(u.pk, 1), (u.pk, 2)])
+        self.assertEquals(GroupPermissionRow.objects.filter(object_id=ticket2.pk).count(), 2)
+        objectpermissions.bulk_revoke([u, g], [ticket, ticket2], 'read')
+        self.assertEquals(self.rows(ticket), [(u.pk, 2)])
+        self.assertEquals(u.get_object_perm(ticket2), 2)
+
+    
+    def testEffectivePermissions(self):
+        ticket, u, g = self.ticket, self.u, self.g
+        if m2m_changed is None:
+            return
+        app_settings.EFFECTIVE_PERMS = True
+        connect_effective_perms()
+        try:
+            u.grant_object_perm(ticket, 'read')
+            g.grant_object_perm(ticket, 'close')
+            self.assertEquals(list(EffectivePermission.objects.filter(user=u, object_id=ticket.pk
+                ).values_list('permission', flat=True)), [5])
+            g.revoke_object_perm(ticket, 'close')
+            rebuild_effective_perms()
+            self.assertEquals(u.get_object_perm(ticket), 1)
+            self.assertEquals(list(users_with_perm(ticket, 'close')), [])
+        finally:
+            app_settings.EFFECTIVE_PERMS = False
+            disconnect_effective_perms()
+
+
+class TestCompactPermissions(TestCase):
+    def setUp(self):
+        self.ticket = Ticket.objects.create(title='ticket')
+        self.folder = Folder.objects.create(name='folder')
+        self.u = User.objects.create_user('compact_guy','compact@guy.com', 'password')
+        self.g = Group.objects.create(name="compact_group")
+    
+    def testCompact(self):
+        ticket, folder, u, g = self.ticket, self.folder, self.u, self.g
+        folder_type = ContentType.objects.get_for_model(Folder)
+        gone = ContentType.objects.create(name='gone', app_label='gone', model='gone')
+        u.grant_object_perm(folder, 'read')
+        g.grant_object_perm(ticket, 'close')
+        UserPermission.objects.create(content_type=folder_type, object_id=folder.pk + 100, user=u, permission=1)
+        UserPermission.objects.create(content_type=gone, object_id=1, user=u, permission=1)
+        UserPermission.objects.create(content_type=folder_type, object_id=folder.pk, user_id=u.pk + 100, permission=1)
+        GroupPermission.objects.create(content_type=folder_type, object_id=folder.pk, group=g, permission=0)
+        GroupPermissionRow.objects.create(content_type=ContentType.objects.get_for_model(Ticket),
+                                          object_id=ticket.pk + 100, group=g, permission=2)
+        
+        report = dict([(model, counts) for model, counts in
+                       [(item[0], item[1:]) for item in compact_permissions(batch_size=1)]])
+        self.assertEquals(report[UserPermission], (0, 0, 3))
+        self.assertEquals(report[GroupPermission], (0, 1, 0))
+        self.assertEquals(report[GroupPermissionRow], (0, 0, 1))
+        self.assertEquals(list(UserPermission.objects.values_list('object_id', 'user')), [(folder.pk, u.pk)])
+        self.assertEquals(GroupPermission.objects.count(), 0)
+        self.assertEquals(list(GroupPermissionRow.objects.values_list('object_id', flat=True)), [ticket.pk])
+        self.assertEquals(merge_duplicates(UserPermission, 'user'), 0)
+        self.assertEquals(delete_orphans(UserPermission, 'user'), 0)
+        self.assertTrue(u.has_object_perm(folder, 'read'))
+    
+    def testDeleteObjects(self):
+        u, g = self.u, self.g
+        tickets = [Ticket.objects.create(title='ticket %d' % i) for i in range(3)]
+        ticket_type = ContentType.objects.get_for_model(Ticket)
+        objectpermissions.bulk_grant([u, g], tickets, ['read', 'write'])
+        UserPermission.objects.create(content_type=ticket_type, object_id=tickets[0].pk, user=u, permission=1)
+        EffectivePermission.objects.create(content_type=ticket_type, object_id=tickets[1].pk, user=u, permission=3)
+        enable_request_cache(u)
+        try:
+            self.assertTrue(u.has_object_perm(tickets[0], 'read'))
+            
+            changes = []
+            def handler(sender, to_whom, to_what, action, **kwargs):
+                changes.append((to_whom, sorted([obj.pk for obj in to_what]), action))
+            permissions_changed_in_bulk.connect(handler)
+            try:
+                Ticket.objects.filter(pk__in=[tickets[0].pk, tickets[1].pk]).delete()
+            finally:
+                permissions_changed_in_bulk.disconnect(handler)
+            self.assertEquals(changes, [([], [tickets[0].pk, tickets[1].pk], 'delete')])
+            remaining = lambda model: list(model.objects.filter(content_type=ticket_type
+                ).values_list('object_id', flat=True).distinct())
+            self.assertEquals(remaining(UserPermissionRow), [tickets[2].pk])
+            self.assertEquals(remaining(GroupPermissionRow), [tickets[2].pk])
+            self.assertEquals(remaining(UserPermission), [])
+            self.assertEquals(remaining(EffectivePermission), [])
+            self.assertFalse(u.has_object_perm(Ticket(pk=tickets[0].pk), 'read'))
+        finally:
+            disable_request_cache(u)
+        
+        tickets[2].delete()
+        self.assertEquals(UserPermissionRow.objects.count(), 0)
+        
+        ticket = Ticket.objects.create(title='raw')
+        u.grant_object_perm(ticket, 'close')
+        connection.cursor().execute('DELETE FROM %s WHERE id = %%s' % Ticket._meta.db_table, [ticket.pk])
+        delete_object_perms(Ticket, [ticket.pk])
+        self.assertEquals(UserPermissionRow.objects.count(), 0)
+
+
+class TestCommits(TransactionTestCase):
+    """
+    Writes that must be committed without a managed transaction
+    """
+    def setUp(self):
+        self.u = User.objects.create_user('commit_guy','commit@guy.com', 'password')
+        self.ticket = Ticket.objects.create(title='ticket')
+    
+    def discard_uncommitted(self):
+        # What isn't committed is lost when the connection closes
+        connection._rollback()
+    
+    def testBulkGrant(self):
+        objectpermissions.bulk_grant([self.u], [self.ticket], ['read', 'write'])
+        self.discard_uncommitted()
+        self.assertEquals(UserPermissionRow.objects.filter(object_id=self.ticket.pk).count(), 2)
+    
+    def testAncestors(self):
+        root = Folder.objects.create(name='root')
+        other = Folder.objects.create(name='other')
+        sub = Folder.objects.create(name='sub', parent=root)
+        doc = Document.objects.create(title='doc', folder=sub)
+        self.discard_uncommitted()
+        doc_type = ContentType.objects.get_for_model(Document)
+        ancestors = PermissionAncestor.objects.filter(content_type=doc_type, object_id=doc.pk)
+        self.assertEquals(sorted(ancestors.values_list('ancestor_id', 'depth')), sorted([(root.pk, 2), (sub.pk, 1)]))
+        
+        sub.parent = other
+        sub.save()
+        self.discard_uncommitted()
+        self.assertEquals(sorted(ancestors.values_list('ancestor_id', 'depth')), sorted([(other.pk, 2), (sub.pk, 1)]))
+    
+    def testDefaultPerms(self):
+        staff = Group.objects.create(name="staff")
+        register_defaults(Document, [('creator', 'write'), (group_named('staff'), 'read')])
+        try:
+            doc = Document(title='new', folder=Folder.objects.create(name='defaults'))
+            doc.creator = self.u
+            doc.save()
+        finally:
+            del default_perms[Document]
+            signals.post_save.disconnect(grant_default_perms, sender=Document,
+                                         dispatch_uid='objectpermissions.defaults.simpleapp.Document')
+        self.discard_uncommitted()
+        self.assertTrue(self.u.has_object_perm(doc, 'write'))
+        self.assertTrue(staff.has_object_perm(doc, 'read'))
+    
+    def testRowStorage(self):
+        u, ticket = self.u, self.ticket
+        u.grant_object_perm(ticket, ['read', 'write'])
+        self.discard_uncommitted()
+        self.assertEquals(u.get_object_perm(ticket), 3)
+        u.set_object_perm(ticket, 'close')
+        self.discard_uncommitted()
+        self.assertEquals(u.get_object_perm(ticket), 4)
@@ -0,0 +1,61 @@
+"""
+Helpers shared by the modules that write or aggregate permission rows.
+"""
+from django.db import connection, transaction
+from django.db.models import AutoField
+
+import cache
+from signals import send, permissions_changed_in_bulk
+
+#: The most ids put in one ``IN`` clause by the bulk functions
+CHUNK_SIZE = 400
+
+
+def chunks(items, size=CHUNK_SIZE):
+    """
+    Yield ``items`` as lists of at most ``size``
+    """
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def bulk_create(model, objs):
+    """
+    Insert all of ``objs`` with as few statements as the database allows,
+    without sending any signals. Like ``save()``\ , it commits unless a
+    transaction is being managed.
+    """
+    if not objs:
+        return
+    if hasattr(model.objects, 'bulk_create'):
+        model.objects.bulk_create(objs)
+        return
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.local_fields if not isinstance(f, AutoField)]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(model._meta.db_table),
+        ', '.join([qn(f.column) for f in fields]), ', '.join(['%s'] * len(fields)))
+    connection.cursor().executemany(sql, [[getattr(obj, f.attname) for f in fields] for obj in objs])
+    transaction.commit_unless_managed()
+
+
+def bulk_changed(principals, instances, action):
+    """
+    Forget the prefetched permissions of ``instances`` and send one
+    ``permissions_changed_in_bulk`` signal for them.
+    """
+    # cache imports hierarchy, which imports this module, so the function
+    # is looked up when it is called
+    for instance in instances:
+        cache.clear_prefetched_perms(instance)
+    send(permissions_changed_in_bulk, None, to_whom=principals, to_what=instances, action=action)
+
+
+def bit_or_sql(column, nbits):
+    """
+    A portable aggregate for the bitwise OR of ``column``\ : the sum of the
+    highest value of each bit, since most databases lack a ``BIT_OR``\ .
+    """
+    if not nbits:
+        return '0'
+    return ' + '.join(['COALESCE(MAX(%s & %d), 0)' % (column, 1 << i) for i in range(nbits)])
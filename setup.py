@@ -23,7 +23,8 @@ setup(name='django-objectpermissions',
       author='Corey Oordt',
       author_email='coordt@washingtontimes.com',
       url='http://opensource.washingtontimes.com/projects/objectpermissions/',
-      packages=['objectpermissions'],
+      packages=['objectpermissions', 'objectpermissions.management',
+                'objectpermissions.management.commands'],
       include_package_data=True,
       classifiers=[
           'Framework :: Django',